@@ -10,7 +10,6 @@ License: BSD (3-clause)
 import os.path as op
 
 import pandas as pd
-import matplotlib.pyplot as plt
 
 from mne.io import read_raw_bdf
 from mne import find_events, Annotations, open_report
@@ -18,8 +17,14 @@ from mne import find_events, Annotations, open_report
 from mne_bids import write_raw_bids, BIDSPath
 
 # All parameters are defined in config.py
-from config import fname, task_name, montage, parser, \
-    LoggingFormat
+from config import fname, make_output_dirs, task_name, montage, parser, \
+    figure_cache_size, qc_wal, LoggingFormat
+from figcache import FigureCache, digest
+from overview import compute_overview
+from viz import plot_raw_envelope
+from profiling import StepProfiler
+from qc import QCIndex
+from utils import atomic_write
 
 ###############################################################################
 # Start processing step
@@ -33,6 +38,12 @@ print(LoggingFormat.PURPLE +
       'Converting subject %s to BIDS' % subject +
       LoggingFormat.END)
 
+# record runtime of the processing stages
+profiler = StepProfiler('eeg_to_bids', subject=subject,
+                        log_file=fname.profile_log)
+# quality-control records of this step
+qc = QCIndex(fname.qc_index, wal=qc_wal)
+
 # Subject information (e.g., age, sex)
 demo_path = fname.source(source_type='demographics',
                          subject=subject)
@@ -43,8 +54,9 @@ demo = pd.read_csv(demo_path, sep='\t', header=0)
 input_file = fname.source(source_type='eeg',
                           subject=subject)
 # 1) Import the data
-raw = read_raw_bdf(input_file,
-                   preload=False)
+with profiler.stage('read_raw'):
+    raw = read_raw_bdf(input_file,
+                       preload=False)
 
 # sampling rate
 sfreq = raw.info['sfreq']
@@ -95,10 +107,11 @@ raw.info['lowpass'] = raw.info['sfreq'] / 2
 ###############################################################################
 # 4) Create events info
 # extract events
-events = find_events(raw,
-                     stim_channel='Status',
-                     output='onset',
-                     min_duration=0.002)
+with profiler.stage('find_events'):
+    events = find_events(raw,
+                         stim_channel='Status',
+                         output='onset',
+                         min_duration=0.002)
 
 ###############################################################################
 # 5) Extract events from the status channel and save them as file annotations
@@ -129,37 +142,71 @@ bids_path = BIDSPath(
     root=fname.data_dir)
 
 # save in bids format
-write_raw_bids(raw,
-               bids_path,
-               overwrite=True)
+with profiler.stage('write_bids'):
+    write_raw_bids(raw,
+                   bids_path,
+                   overwrite=True)
 
 ###############################################################################
 # 7) Plot the data for report
-raw_plot = raw.plot(scalings=dict(eeg=50e-6, eog=50e-6),
-                    n_channels=len(raw.info['ch_names']),
-                    show=True
-                    )
-plt.close('all')
+# rendered figures are reused as long as the data they show does not change
+figures = FigureCache(fname.figure_cache, max_bytes=figure_cache_size)
+scalings = dict(eeg=50e-6, eog=50e-6)
+
+# per-channel min/max/RMS at several time scales, saved next to the data
+with profiler.stage('overview'):
+    overview = compute_overview(raw)
+
+with profiler.stage('plot_raw'):
+    # min/max envelope of the full recording
+    raw_image = figures.get(
+        'raw_envelope',
+        lambda: plot_raw_envelope(raw, scalings=scalings, title='Raw data',
+                                  overview=overview),
+        digest(overview.data), raw.annotations.onset,
+        raw.annotations.duration, list(raw.annotations.description),
+        raw.info['bads'], scalings=scalings)
 
 ###############################################################################
 # 8) Export data to .fif for further processing
+# create output directory (if missing, dodo.py creates them for all
+# subjects)
+make_output_dirs('raw_files', [subject])
 # output path
 output_path = fname.output(processing_step='raw_files',
                            subject=subject,
                            file_type='raw.fif')
 
 # save file
-raw.save(output_path, overwrite=True)
+with profiler.stage('save'):
+    with atomic_write(output_path) as tmp:
+        raw.save(tmp, overwrite=True)
+    overview.save(fname.output(processing_step='raw_files',
+                               subject=subject,
+                               file_type='overview.npy'))
 
 ###############################################################################
 # 9) Create HTML report
-with open_report(fname.report(subject=subject)[0]) as report:
-    report.parse_folder(op.dirname(output_path),
-                        pattern='*.fif',
-                        render_bem=False)
-    report.add_figs_to_section(raw_plot,
-                               'Raw data',
-                               section='Raw data',
-                               replace=True)
-    report.save(fname.report(subject=subject)[1], overwrite=True,
-                open_browser=False)
+with profiler.stage('report'):
+    with open_report(fname.report(subject=subject)[0]) as report:
+        report.parse_folder(op.dirname(output_path),
+                            pattern='*.fif',
+                            render_bem=False)
+        report.add_images_to_section(raw_image,
+                                     captions='Raw data',
+                                     section='Raw data',
+                                     replace=True)
+        report.add_htmls_to_section(htmls=profiler.to_html(),
+                                    captions='Runtime profile (step 00)',
+                                    section='Profiling',
+                                    replace=True)
+        report.save(fname.report(subject=subject)[1], overwrite=True,
+                    open_browser=False)
+
+###############################################################################
+# 10) Record quality-control facts in the cohort index
+qc.record('eeg_to_bids', subject,
+          sfreq=sfreq,
+          duration=raw.times[-1],
+          n_events=len(events))
+qc.mark('eeg_to_bids', subject)
@@ -16,9 +16,16 @@ from mne import Annotations, open_report
 from mne.io import read_raw_fif
 
 # All parameters are defined in config.py
-from config import fname, parser, n_jobs, LoggingFormat
-from bads import find_bad_channels
-from viz import plot_z_scores
+from config import fname, make_output_dirs, parser, n_jobs, \
+    figure_cache_size, qc_wal, LoggingFormat
+from bads import find_bad_channels, find_artefacts, robust_reference
+from checkpoint import Checkpoints, input_key
+from viz import plot_z_scores, plot_raw_envelope
+from figcache import FigureCache, digest
+from overview import compute_overview
+from profiling import StepProfiler
+from qc import QCIndex
+from utils import atomic_write
 
 # Handle command line arguments
 args = parser.parse_args()
@@ -29,12 +36,28 @@ print(LoggingFormat.PURPLE +
       'Initialise bad channel detection for subject %s' % subject +
       LoggingFormat.END)
 
+# record runtime of the processing stages
+profiler = StepProfiler('repair_bads', subject=subject,
+                        log_file=fname.profile_log)
+# quality-control records of this step
+qc = QCIndex(fname.qc_index, wal=qc_wal)
+
+# rendered figures are reused as long as the data they show does not change
+figures = FigureCache(fname.figure_cache, max_bytes=figure_cache_size)
+
 ###############################################################################
 # 1) Import the output from previous processing step
 input_file = fname.output(subject=subject,
                           processing_step='raw_files',
                           file_type='raw.fif')
-raw = read_raw_fif(input_file, preload=True)
+with profiler.stage('read_raw'):
+    raw = read_raw_fif(input_file, preload=True)
+
+# results of the expensive stages are kept until the step completes, so that
+# an interrupted run resumes from the last completed stage (the key covers
+# bads.py, which computes the robust reference)
+checkpoints = Checkpoints(fname.checkpoints, 'repair_bads', subject,
+                          key=input_key(input_file, __file__, 'bads.py'))
 
 # drop status channel
 raw.drop_channels('Status')
@@ -54,59 +77,62 @@ raw.drop_channels('Status')
 # - Upper passband edge: 40.00 Hz
 # - Upper transition bandwidth: 10.00 Hz (-6 dB cutoff frequency: 45.00 Hz)
 # - Filter length: 8449 samples (33.004 sec)
-raw = raw.filter(l_freq=0.1, h_freq=40.,
-                 picks=['eeg', 'eog'],
-                 filter_length='auto',
-                 l_trans_bandwidth='auto',
-                 h_trans_bandwidth='auto',
-                 method='fir',
-                 phase='zero',
-                 fir_window='hamming',
-                 fir_design='firwin',
-                 n_jobs=n_jobs)
-
-# plot filtered data
-filt_plot = raw.plot(scalings=dict(eeg=50e-6, eog=50e-6),
-                     n_channels=len(raw.info['ch_names']),
-                     show=False)
-plt.close('all')
+with profiler.stage('filter'):
+    raw = checkpoints.get(
+        'filtered_raw',
+        lambda: raw.filter(l_freq=0.1, h_freq=40.,
+                           picks=['eeg', 'eog'],
+                           filter_length='auto',
+                           l_trans_bandwidth='auto',
+                           h_trans_bandwidth='auto',
+                           method='fir',
+                           phase='zero',
+                           fir_window='hamming',
+                           fir_design='firwin',
+                           n_jobs=n_jobs),
+        kind='raw')
 
 ###############################################################################
 # 3) Check if there are any flat EOG channels
-flat_eogs = find_bad_channels(raw, picks='eog', method='flat')['flat']
+with profiler.stage('find_flat_eogs'):
+    flat_eogs = find_bad_channels(raw, picks='eog', method='flat')['flat']
 
 # remove flat eog channels from data
 raw.drop_channels(flat_eogs)
 
 ###############################################################################
 # 4) Plot power spectral density
-fig, ax = plt.subplots(figsize=(10, 5))
-raw.plot_psd(fmax=70, show=False, ax=ax)
-plt.close('all')
+with profiler.stage('plot_psd'):
+    fig, ax = plt.subplots(figsize=(10, 5))
+    raw.plot_psd(fmax=70, show=False, ax=ax)
+    plt.close('all')
 
 ###############################################################################
 # 5) Find noisy channels and compute robust average reference
 sfreq = raw.info['sfreq']
 channels = raw.copy().pick_types(eeg=True).ch_names
 
-# extract eeg signal
-eeg_signal = raw.get_data(picks='eeg')
-
-# reference signal to robust estimate of central tendency
-ref_signal = np.nanmedian(eeg_signal, axis=0)
+with profiler.stage('robust_reference'):
+    reference = checkpoints.load('robust_reference')
+    if reference is None:
+        ref_signal, noisy = robust_reference(raw,
+                                             r_threshold=0.45,
+                                             percent_threshold=0.05,
+                                             time_step=1.0)
+        reference = dict(ref_signal=ref_signal,
+                         noisy=np.array(noisy, dtype=str))
+        checkpoints.save('robust_reference', reference)
 
-i = 0
-noisy = []
-while True:
-    # remove reference
-    eeg_temp = eeg_signal - ref_signal
+ref_signal = reference['ref_signal']
 
-    # find bad channels by deviation (high variability in amplitude)
-    bad_dev = find_bad_channels(eeg_temp,
-                                channels=channels,
-                                method='deviation')['deviation']
+###############################################################################
+# 6) Compute robust average reference for EEG data
+# remove robust reference
+eeg_signal = raw.get_data(picks='eeg')
+eeg_temp = eeg_signal - ref_signal
 
-    # find channels that don't well with other channels
+with profiler.stage('detect_bad_channels'):
+    # bad by (un)correlation
     bad_corr = find_bad_channels(eeg_temp,
                                  channels=channels,
                                  sfreq=sfreq,
@@ -115,65 +141,30 @@ while True:
                                  time_step=1.0,
                                  method='correlation')['correlation']
 
-    # only keep unique values
-    bads = set(bad_dev) | set(bad_corr)
-
-    # save identified noisy channels
-    if bads:
-        noisy.extend(bads)
-        print('Found bad channels %s'
-              % (', '.join([str(chan) for chan in bads])))
-
-        # interpolate noisy channels
-        raw_copy = raw.copy()
-        raw_copy.info['bads'] = noisy
-        raw_copy.interpolate_bads(mode='accurate')
-        eeg_signal = raw_copy.get_data(picks='eeg')
-
-    # compute new reference (mean of signal with interpolated channels)
-    ref_signal = np.nanmean(eeg_signal, axis=0)
-
-    # break if no (more) bad channels found
-    if (i > 0 and len(bads) == 0) or i > 4:
-        print('Finishing after i == %s' % i)
-        break
-
-    i = i + 1
-
-###############################################################################
-# 6) Compute robust average reference for EEG data
-# remove robust reference
-eeg_signal = raw.get_data(picks='eeg')
-eeg_temp = eeg_signal - ref_signal
-
-# bad by (un)correlation
-bad_corr = find_bad_channels(eeg_temp,
-                             channels=channels,
-                             sfreq=sfreq,
-                             r_threshold=0.45,
-                             percent_threshold=0.05,
-                             time_step=1.0,
-                             method='correlation')['correlation']
-
-# bad by deviation
-bad_dev = find_bad_channels(eeg_temp,
-                            channels=channels,
-                            method='deviation',
-                            return_z_scores=True)
+    # bad by deviation
+    bad_dev = find_bad_channels(eeg_temp,
+                                channels=channels,
+                                method='deviation',
+                                return_z_scores=True)
 
-z_scores = bad_dev['deviation_z_scores']
-bad_dev = bad_dev['deviation']
+    z_scores = bad_dev['deviation_z_scores']
+    bad_dev = bad_dev['deviation']
 
 # only keep unique values
 bad_channels = set(bad_dev) | set(bad_corr)
 
 # create plot showing channels z-scores
-fig = plot_z_scores(z_scores, channels=channels, bads=bad_channels, show=False)
-plt.close('all')
+with profiler.stage('plot_z_scores'):
+    z_scores_image = figures.get(
+        'z_scores',
+        lambda: plot_z_scores(z_scores, channels=channels,
+                              bads=bad_channels, show=False),
+        z_scores, channels, sorted(bad_channels))
 
 # interpolate channels identified by deviation criterion
-raw.info['bads'] = list(bad_channels)
-raw.interpolate_bads(mode='accurate')
+with profiler.stage('interpolate_bads'):
+    raw.info['bads'] = list(bad_channels)
+    raw.interpolate_bads(mode='accurate')
 
 ###############################################################################
 # 7) Reference eeg data to average of all eeg channels
@@ -196,25 +187,14 @@ raw_copy.apply_proj()
 data = raw_copy.get_data(eeg_channels)
 
 # detect artifacts (i.e., absolute amplitude > 500 microV)
-times = []
-annotations_df = pd.DataFrame(times)
-onsets = []
 duration = []
-annotated_channels = []
-bad_chans = []
-
-# loop through samples
-for sample in range(0, data.shape[1]):
-    if len(times) > 0:
-        if sample <= (times[-1] + int(1 * sfreq)):
-            continue
-    peak = []
-    for channel in picks:
-        peak.append(abs(data[channel][sample]))
-    if max(peak) >= 250e-6:
-        times.append(float(sample))
-        annotated_channels.append(raw_copy.ch_names[picks[int(np.argmax(
-            peak))]])
+
+with profiler.stage('artefact_detection'):
+    times, artefact_channels = find_artefacts(data, picks, sfreq,
+                                              threshold=250e-6)
+annotated_channels = [raw_copy.ch_names[channel]
+                      for channel in artefact_channels]
+
 # if artifact found create annotations for raw data
 if len(times) > 0:
     # get first time
@@ -257,21 +237,39 @@ frequency_of_annotation = {x: annotated_channels.count(x) * 2
                            for x in annotated_channels}
 
 # create plot with clean data
-plot_artefacts = raw.plot(scalings=dict(eeg=50e-6, eog=50e-6),
-                          n_channels=len(raw.info['ch_names']),
-                          title='Robust reference applied Sub-%s' % subject,
-                          show=False)
-plt.close('all')
+scalings = dict(eeg=50e-6, eog=50e-6)
+title = 'Robust reference applied Sub-%s' % subject
+# per-channel min/max/RMS at several time scales, saved next to the data
+with profiler.stage('overview'):
+    overview = compute_overview(raw)
+
+with profiler.stage('plot_clean'):
+    # min/max envelope of the full recording
+    clean_image = figures.get(
+        'clean_envelope',
+        lambda: plot_raw_envelope(raw, scalings=scalings, title=title,
+                                  overview=overview),
+        digest(overview.data), raw.annotations.onset,
+        raw.annotations.duration, list(raw.annotations.description),
+        raw.info['bads'], scalings=scalings, title=title)
 
 ###############################################################################
 # 8) Export data to .fif for further processing
+# create output directory (if missing, dodo.py creates them for all
+# subjects)
+make_output_dirs('repair_bads', [subject])
 # output path
 output_path = fname.output(processing_step='repair_bads',
                            subject=subject,
                            file_type='raw.fif')
 
 # save file
-raw.save(output_path, overwrite=True)
+with profiler.stage('save'):
+    with atomic_write(output_path) as tmp:
+        raw.save(tmp, overwrite=True)
+    overview.save(fname.output(processing_step='repair_bads',
+                               subject=subject,
+                               file_type='overview.npy'))
 
 ###############################################################################
 # 6) Create HTML report
@@ -279,15 +277,34 @@ bad_channels_identified = '<p>Channels_interpolated:<br>'\
                           '%s <p>' \
                           % (', '.join([str(chan) for chan in bad_channels]))
 
-with open_report(fname.report(subject=subject)[0]) as report:
-    report.add_htmls_to_section(htmls=bad_channels_identified,
-                                captions='Bad channels',
-                                section='Bad channel detection')
-    report.add_figs_to_section(fig, 'Robust Z-Scores',
-                               section='Bad channel detection',
-                               replace=True)
-    report.add_figs_to_section(plot_artefacts, 'Clean data',
-                               section='Bad channel detection',
-                               replace=True)
-    report.save(fname.report(subject=subject)[1], overwrite=True,
-                open_browser=False)
+with profiler.stage('report'):
+    with open_report(fname.report(subject=subject)[0]) as report:
+        report.add_htmls_to_section(htmls=bad_channels_identified,
+                                    captions='Bad channels',
+                                    section='Bad channel detection')
+        report.add_images_to_section(z_scores_image,
+                                     captions='Robust Z-Scores',
+                                     section='Bad channel detection',
+                                     replace=True)
+        report.add_images_to_section(clean_image,
+                                     captions='Clean data',
+                                     section='Bad channel detection',
+                                     replace=True)
+        report.add_htmls_to_section(htmls=profiler.to_html(),
+                                    captions='Runtime profile (step 01)',
+                                    section='Profiling',
+                                    replace=True)
+        report.save(fname.report(subject=subject)[1], overwrite=True,
+                    open_browser=False)
+
+###############################################################################
+# 7) Record quality-control facts in the cohort index
+qc.record('repair_bads', subject,
+          bad_channels=sorted(bad_channels),
+          flat_eogs=list(flat_eogs),
+          total_time=total_time,
+          frequency_of_annotation=frequency_of_annotation)
+qc.mark('repair_bads', subject)
+
+# the step has completed, its checkpoints are no longer needed
+checkpoints.clear()
@@ -12,7 +12,13 @@ from mne.io import read_raw_fif
 from mne.preprocessing import ICA
 
 # All parameters are defined in config.py
-from config import fname, parser, n_jobs
+from config import fname, make_output_dirs, parser, n_jobs, \
+    figure_cache_size, qc_wal
+from figcache import FigureCache
+from profiling import StepProfiler
+from qc import QCIndex
+from utils import atomic_write
+
 # check if NVIDIA CUDA GPU processing should be used
 if n_jobs == 'cuda':
     from mne.utils import set_config
@@ -24,15 +30,19 @@ subject = args.subject
 
 print('Fitting ICA for subject %s' % subject)
 
+# record runtime of the processing stages
+profiler = StepProfiler('fit_ica', subject=subject,
+                        log_file=fname.profile_log)
+# quality-control records of this step
+qc = QCIndex(fname.qc_index, wal=qc_wal)
+
 ###############################################################################
 # 1) Import the output from previous processing step
 input_file = fname.output(processing_step='repair_bads',
                           subject=subject,
                           file_type='raw.fif')
-raw = read_raw_fif(input_file, preload=True)
-
-# filter data to remove drifts
-raw_filt = raw.copy().filter(l_freq=1.0, h_freq=None, n_jobs=n_jobs)
+with profiler.stage('read_raw'):
+    raw = read_raw_fif(input_file, preload=True)
 
 ###############################################################################
 #  2) Set ICA parameters
@@ -42,32 +52,63 @@ reject = dict(eeg=250e-6)
 
 ###############################################################################
 # 3) Fit ICA
+# filter data to remove drifts
+with profiler.stage('filter'):
+    raw_filt = raw.copy().filter(l_freq=1.0, h_freq=None, n_jobs=n_jobs)
+
 ica = ICA(n_components=n_components,
           method=method,
           fit_params=dict(extended=True))
 
-ica.fit(raw_filt,
-        reject=reject,
-        reject_by_annotation=True)
+with profiler.stage('fit_ica'):
+    ica.fit(raw_filt,
+            reject=reject,
+            reject_by_annotation=True)
 
 ###############################################################################
 # 4) Plot ICA components
-ica_fig = ica.plot_components(picks=range(0, 20), show=False)
+# rendered figures are reused as long as the data they show does not change
+figures = FigureCache(fname.figure_cache, max_bytes=figure_cache_size)
+
+with profiler.stage('plot_components'):
+    ica_image = figures.get(
+        'ica_components',
+        lambda: ica.plot_components(picks=range(0, 20), show=False),
+        ica.get_components(), ica.ch_names,
+        picks=list(range(0, 20)))
 
 ###############################################################################
 # 5) Save ICA solution
+# create output directory (if missing, dodo.py creates them for all
+# subjects)
+make_output_dirs('fit_ica', [subject])
 # output path
 output_path = fname.output(processing_step='fit_ica',
                            subject=subject,
                            file_type='ica.fif')
 # save file
-ica.save(output_path)
+with profiler.stage('save'):
+    with atomic_write(output_path) as tmp:
+        ica.save(tmp, overwrite=True)
 
 ###############################################################################
 # 6) Create HTML report
-with open_report(fname.report(subject=subject)[0]) as report:
-    report.add_figs_to_section(ica_fig, 'ICA solution',
-                               section='ICA',
-                               replace=True)
-    report.save(fname.report(subject=subject)[1], overwrite=True,
-                open_browser=False)
+with profiler.stage('report'):
+    with open_report(fname.report(subject=subject)[0]) as report:
+        report.add_images_to_section(ica_image,
+                                     captions='ICA solution',
+                                     section='ICA',
+                                     replace=True)
+        report.add_htmls_to_section(htmls=profiler.to_html(),
+                                    captions='Runtime profile (step 02)',
+                                    section='Profiling',
+                                    replace=True)
+        report.save(fname.report(subject=subject)[1], overwrite=True,
+                    open_browser=False)
+
+###############################################################################
+# 7) Record quality-control facts in the cohort index
+qc.record('fit_ica', subject,
+          n_components=ica.n_components_,
+          n_iterations=ica.n_iter_)
+qc.mark('fit_ica', subject)
@@ -12,14 +12,18 @@ License: BSD (3-clause)
 """
 import numpy as np
 
-import matplotlib.pyplot as plt
-
 from mne import events_from_annotations, Epochs, open_report
 from mne.io import read_raw_fif
 from mne.preprocessing import read_ica, corrmap
 
 # All parameters are defined in config.py
-from config import fname, parser, LoggingFormat
+from config import fname, make_output_dirs, parser, figure_cache_size, \
+    qc_wal, LoggingFormat
+from figcache import FigureCache, digest
+from overview import compute_overview
+from profiling import StepProfiler
+from qc import QCIndex
+from utils import atomic_write
 
 # Handle command line arguments
 args = parser.parse_args()
@@ -30,19 +34,27 @@ print(LoggingFormat.PURPLE +
       'Finding and removing bad components for subject %s' % subject +
       LoggingFormat.END)
 
+# record runtime of the processing stages
+profiler = StepProfiler('repaired_with_ica', subject=subject,
+                        log_file=fname.profile_log)
+# quality-control records of this step
+qc = QCIndex(fname.qc_index, wal=qc_wal)
+
 ###############################################################################
 # 1) Import the output from previous processing step
 input_file = fname.output(subject=subject,
                           processing_step='repair_bads',
                           file_type='raw.fif')
-raw = read_raw_fif(input_file, preload=True)
+with profiler.stage('read_raw'):
+    raw = read_raw_fif(input_file, preload=True)
 
 ###############################################################################
 # 2) Import ICA weights from precious processing step
 input_file = fname.output(subject=subject,
                           processing_step='fit_ica',
                           file_type='ica.fif')
-ica = read_ica(input_file)
+with profiler.stage('read_ica'):
+    ica = read_ica(input_file)
 
 ###############################################################################
 # 3) Find bad components via correlation with template ICA
@@ -60,67 +72,116 @@ for subj in temp_subjs:
                                            file_type='ica.fif')))
 
 # compute correlations with template ocular movements up/down and left/right
-corrmap(icas=[temp_icas[0], ica],
-        template=(0, 0), threshold=0.85, label='blink_up', plot=False)
-corrmap(icas=[temp_icas[0], ica],
-        template=(0, 7), threshold=0.85, label='blink_side', plot=False)
+with profiler.stage('corrmap'):
+    corrmap(icas=[temp_icas[0], ica],
+            template=(0, 0), threshold=0.85, label='blink_up', plot=False)
+    corrmap(icas=[temp_icas[0], ica],
+            template=(0, 7), threshold=0.85, label='blink_side', plot=False)
 
 ###############################################################################
 # 4) Create summary plots to show signal correction on main experimental
 # condition
 
 # create target epochs
-target_evs = events_from_annotations(raw, regexp='(11)|(12)|(21)|(22)')[0]
-target_epo = Epochs(raw, target_evs,
-                    tmin=-1.5,
-                    tmax=1.5,
-                    reject_by_annotation=True,
-                    proj=False,
-                    preload=True)
-target_epo.apply_baseline(baseline=(-0.3, -0.05))
-target_evo = target_epo.average()
+with profiler.stage('target_epochs'):
+    target_evs = events_from_annotations(raw, regexp='(11)|(12)|(21)|(22)')[0]
+    target_epo = Epochs(raw, target_evs,
+                        tmin=-1.5,
+                        tmax=1.5,
+                        reject_by_annotation=True,
+                        proj=False,
+                        preload=True)
+    target_epo.apply_baseline(baseline=(-0.3, -0.05))
+    target_evo = target_epo.average()
 
 # loop over identified "bad" components
 bad_components = []
 for label in ica.labels_:
     bad_components.extend(ica.labels_[label])
 
-for bad_comp in np.unique(bad_components):
-    # show component frequency spectrum
-    fig_comp = ica.plot_properties(target_epo,
-                                   picks=bad_comp,
-                                   psd_args={'fmax': 35.},
-                                   show=False)[0]
-
-    # show how the signal is affected by component rejection
-    fig_evoked = ica.plot_overlay(target_evo, exclude=[bad_comp], show=False)
-    plt.close('all')
-
-    # create HTML report
-    with open_report(fname.report(subject=subject)[0]) as report:
-        report.add_figs_to_section(fig_comp, 'Component %s identified ' 
-                                             'by correlation with template'
-                                   % bad_comp,
-                                   section='ICA',
-                                   replace=True)
-        report.add_figs_to_section(fig_evoked, 'Component %s rejected'
-                                   % bad_comp,
-                                   section='ICA',
-                                   replace=True)
-        report.save(fname.report(subject=subject)[1], overwrite=True,
-                    open_browser=False)
+# rendered figures are reused as long as the data they show does not change
+figures = FigureCache(fname.figure_cache, max_bytes=figure_cache_size)
+
+with profiler.stage('component_reports'):
+    # hash the ICA solution and the data once for all components
+    ica_digest = digest(ica.unmixing_matrix_, ica.pca_components_,
+                        ica.pca_mean_, ica.ch_names)
+    epochs_digest = digest(target_epo.get_data())
+    evoked_digest = digest(target_evo.data)
+
+    for bad_comp in np.unique(bad_components):
+        # show component frequency spectrum
+        comp_image = figures.get(
+            'ica_properties',
+            lambda: ica.plot_properties(target_epo,
+                                        picks=bad_comp,
+                                        psd_args={'fmax': 35.},
+                                        show=False)[0],
+            ica_digest, epochs_digest, int(bad_comp), fmax=35.)
+
+        # show how the signal is affected by component rejection
+        evoked_image = figures.get(
+            'ica_overlay',
+            lambda: ica.plot_overlay(target_evo, exclude=[bad_comp],
+                                     show=False),
+            ica_digest, evoked_digest, int(bad_comp))
+
+        # create HTML report
+        with open_report(fname.report(subject=subject)[0]) as report:
+            report.add_images_to_section(comp_image,
+                                         captions='Component %s identified '
+                                                  'by correlation with '
+                                                  'template' % bad_comp,
+                                         section='ICA',
+                                         replace=True)
+            report.add_images_to_section(evoked_image,
+                                         captions='Component %s rejected'
+                                                  % bad_comp,
+                                         section='ICA',
+                                         replace=True)
+            report.save(fname.report(subject=subject)[1], overwrite=True,
+                        open_browser=False)
 
 # add bad components  to exclusion list
 ica.exclude = np.unique(bad_components)
 
 # apply ica weights to data
-ica.apply(raw)
+with profiler.stage('apply_ica'):
+    ica.apply(raw)
 
 ###############################################################################
 # 5) Save repaired data set
+# create output directory (if missing, dodo.py creates them for all
+# subjects)
+make_output_dirs('repaired_with_ica', [subject])
 # output path
 output_path = fname.output(processing_step='repaired_with_ica',
                            subject=subject,
                            file_type='raw.fif')
 
-raw.save(output_path, overwrite=True)
+with profiler.stage('save'):
+    with atomic_write(output_path) as tmp:
+        raw.save(tmp, overwrite=True)
+
+# per-channel min/max/RMS at several time scales, saved next to the data
+with profiler.stage('overview'):
+    overview = compute_overview(raw)
+    overview.save(fname.output(processing_step='repaired_with_ica',
+                               subject=subject,
+                               file_type='overview.npy'))
+
+###############################################################################
+# 6) Add runtime profile to HTML report
+with open_report(fname.report(subject=subject)[0]) as report:
+    report.add_htmls_to_section(htmls=profiler.to_html(),
+                                captions='Runtime profile (step 03)',
+                                section='Profiling',
+                                replace=True)
+    report.save(fname.report(subject=subject)[1], overwrite=True,
+                open_browser=False)
+
+###############################################################################
+# 7) Record quality-control facts in the cohort index
+qc.record('repaired_with_ica', subject,
+          excluded_components=ica.exclude)
+qc.mark('repaired_with_ica', subject)
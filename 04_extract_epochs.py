@@ -11,14 +11,21 @@ José C. García Alanis <alanis.jcg@gmail.com>
 
 License: BSD (3-clause)
 """
-import pandas as pd
 import numpy as np
 
-from mne import events_from_annotations, Epochs
+from mne import events_from_annotations, Epochs, open_report
 from mne.io import read_raw_fif
 
 # All parameters are defined in config.py
-from config import fname, parser, LoggingFormat
+from bads import epoch_quality, find_bad_epochs, repair_epochs
+from config import fname, make_output_dirs, parser, reject_ptp, \
+    reject_gradient, reject_z, reject_max_interpolate, qc_wal, LoggingFormat
+from epochstore import write_epoch_store
+from profiling import StepProfiler
+from qc import QCIndex
+from trials import empty_trials, encode, has_reaction, reaction_events, \
+    reaction_event_ids, to_dataframe
+from utils import atomic_write
 
 # Handle command line arguments
 args = parser.parse_args()
@@ -29,12 +36,19 @@ print(LoggingFormat.PURPLE +
       'Extracting epochs for subject %s' % subject +
       LoggingFormat.END)
 
+# record runtime of the processing stages
+profiler = StepProfiler('reaction_epochs', subject=subject,
+                        log_file=fname.profile_log)
+# quality-control records of this step
+qc = QCIndex(fname.qc_index, wal=qc_wal)
+
 ###############################################################################
 # 1) Import the output from previous processing step
 input_file = fname.output(subject=subject,
                           processing_step='repaired_with_ica',
                           file_type='raw.fif')
-raw = read_raw_fif(input_file, preload=True)
+with profiler.stage('read_raw'):
+    raw = read_raw_fif(input_file, preload=True)
 
 # only keep EEG channels
 raw.pick_types(eeg=True)
@@ -68,168 +82,113 @@ new_evs = events[0].copy()
 sfreq = raw.info['sfreq']
 block_end = new_evs[new_evs[:, 2] == 1, 0] / sfreq
 
-# initialise place holders for metadata entries
-flanker = []
-target = []
-block = []
-rt = []
-reaction = []
-triallist = []
-too_soon = []
-missed = []
+# one record per trial (see trials.py), a trial starts with the onset of the
+# flanker stimuli
+records = empty_trials(int((new_evs[:, 2] == 2).sum()))
 trial = 0
 
+# subjects with cond 2 first (i.e., positive interaction)
+positive_first = {2, 4, 6, 8, 10, 11, 13, 15, 17, 19, 21,
+                  23, 27, 29, 31, 33, 37, 38}  # 39 too
+
 # recode trigger events
-for event in range(len(new_evs[:, 2])):
-    # if event is a flanker
-    if new_evs[event, 2] == 2:
-        # save trial idx
-        triallist.append(trial)
-
-        # first check if the subsequent target if followed by a response
-        if new_evs[event+2, 2] \
-                not in {7, 8, 9, 10}:
-            # if no response followed, the trial is missed (i.e., there will be
-            # no corresponding eeg segment for analysis)
-            print('response missed in trial %s' % trial)
-            # append nan for reaction dependent measures
-            reaction.append(np.nan)
-            missed.append(trial)
-            rt.append(np.nan)
-        elif new_evs[event+1, 2] in {7, 8, 9, 10}:
-            # if a response followed the flankers (before target onset)
-            # the trial is too_soon (i.e., there will be
-            # no corresponding eeg segment for analysis)
-            print('response to soon in trial %s' % trial)
-            # append nan for reaction dependent measures
-            reaction.append(np.nan)
-            too_soon.append(trial)
-            rt.append(np.nan)
-
-        # if an answer followed, check if it was correct or incorrect
-        else:
-            # correct reactions
-            if new_evs[event + 2, 2] in {7, 8}:
-                reaction.append('correct')
-                # if target congruent
-                if new_evs[event + 1, 2] in {3, 4}:
-                    # correct congruent
-                    new_evs[event + 2, 2] = 11
-                elif new_evs[event + 1, 2] in {5, 6}:
-                    # correct incongruent
-                    new_evs[event + 2, 2] = 12
-            # incorrect reactions
-            elif new_evs[event + 2, 2] in {9, 10}:
-                reaction.append('incorrect')
-                # if target congruent
-                if new_evs[event + 1, 2] in {3, 4}:
-                    # incorrect congruent
-                    new_evs[event + 2, 2] = 13
-                elif new_evs[event + 1, 2] in {5, 6}:
-                    # incorrect incongruent
-                    new_evs[event + 2, 2] = 14
-
-            # save trial rt
-            trial_rt = (new_evs[event+2, 0] - new_evs[event+1, 0]) / sfreq
-            rt.append(trial_rt)
-        # append block variable identifying the ongoing condition
-        if trial < 48:
-            # practice
-            block.append(0)
-        elif trial < 448:
-            # individual condition
-            block.append(1)
-        elif trial < 848:
-            # subjects with cond 2 first (i.e., positive interaction)
-            if subject in {2, 4, 6, 8, 10, 11, 13, 15, 17, 19, 21,
-                           23, 27, 29, 31, 33, 37, 38}:  # 39 too
-                block.append(2)
+with profiler.stage('parse_events'):
+    for event in range(len(new_evs[:, 2])):
+        # if event is a flanker
+        if new_evs[event, 2] == 2:
+            record = records[trial]
+            # save trial idx
+            record['trial'] = trial
+
+            # add information about the flanker-target combination
+            i = 1
+            while new_evs[event + i, 2] not in {3, 4, 5, 6}:
+                i += 1
+            # 3: congruent left, 4: congruent right, 5: incongruent left,
+            # 6: incongruent right
+            record['target'] = encode(
+                'target',
+                'congruent' if new_evs[event + i, 2] in {3, 4}
+                else 'incongruent')
+            record['flanker'] = encode(
+                'flanker',
+                'left' if new_evs[event + i, 2] in {3, 5} else 'right')
+
+            # first check if the subsequent target if followed by a response
+            if new_evs[event+2, 2] \
+                    not in {7, 8, 9, 10}:
+                # if no response followed, the trial is missed (i.e., there
+                # will be no corresponding eeg segment for analysis)
+                print('response missed in trial %s' % trial)
+            elif new_evs[event+1, 2] in {7, 8, 9, 10}:
+                # if a response followed the flankers (before target onset)
+                # the trial is too_soon (i.e., there will be
+                # no corresponding eeg segment for analysis)
+                print('response to soon in trial %s' % trial)
+
+            # if an answer followed, check if it was correct or incorrect
+            # (7, 8: correct, 9, 10: incorrect), and recode the response
+            # into the reaction to the target (see `reaction_event_ids`)
             else:
-                block.append(3)
-        elif trial < 1248:
-            # subjects with cond 3 first (i.e., negative interaction)
-            if subject in {2, 4, 6, 8, 10, 11, 13, 15, 17, 19, 21,
-                           23, 27, 29, 31, 33, 37, 38}:
-                block.append(3)
-            else:
-                block.append(2)
-
-        i = 1
-        while new_evs[event + i, 2] not in {3, 4, 5, 6}:
-            i += 1
-        # add information about the flanker-target combination
-        if new_evs[event + i, 2] == 3:
-            flanker.append('left')
-            target.append('congruent')
-        elif new_evs[event + i, 2] == 4:
-            flanker.append('right')
-            target.append('congruent')
-        elif new_evs[event + i, 2] == 5:
-            flanker.append('left')
-            target.append('incongruent')
-        elif new_evs[event + i, 2] == 6:
-            flanker.append('right')
-            target.append('incongruent')
-
-        # add 1 to trial counter
-        trial += 1
+                record['reaction'] = encode(
+                    'reaction',
+                    'correct' if new_evs[event + 2, 2] in {7, 8}
+                    else 'incorrect')
+                new_evs[event + 2, 2] = reaction_events(record)
+
+                # save trial rt
+                record['rt'] = \
+                    (new_evs[event+2, 0] - new_evs[event+1, 0]) / sfreq
+
+            # block variable identifying the ongoing condition
+            if trial < 48:
+                # practice
+                record['block'] = 0
+            elif trial < 448:
+                # individual condition
+                record['block'] = 1
+            elif trial < 848:
+                # subjects with cond 2 first (i.e., positive interaction)
+                record['block'] = 2 if subject in positive_first else 3
+            elif trial < 1248:
+                # subjects with cond 3 first (i.e., negative interaction)
+                record['block'] = 3 if subject in positive_first else 2
+
+            # add 1 to trial counter
+            trial += 1
 
 ###############################################################################
 # check if subjects performed the positive condition first
-if subject in {2, 4, 6, 8, 10, 11, 13, 15, 17, 19, 21,
-               23, 27, 29, 31, 33, 37, 38}:
-    neg = False
-else:
-    neg = True
+neg = subject not in positive_first
 
 # 4) Create data frame with epochs metadata
-try:
-    # try to build metadata-df
-    metadata = {'trial': triallist,
-                'condition': block,
-                'reaction': reaction,
-                'rt': rt,
-                'target': target,
-                'flanker': flanker,
-                'block': block,
-                'subject': np.repeat(subject, len(triallist)),
-                'negative_first': np.repeat(neg, len(triallist))}
-    metadata = pd.DataFrame(metadata)
-
-    # save metadata structure for further analysis
-    subj = str(subject).rjust(3, '0')
-    metadata_export = fname.dataframes + '/rt_data_sub-%s.tsv' % subj
-except ValueError:
-      # print which variable in metadata is of unequal size to others and breaks df creation
-        print("ValueError: unequal size of lists, can't create metadata dataframe")
-        for k in metadata:
-            print('length of list ' + k +  ': ' + str(len(metadata[k])))
+# (reaction, target and flanker are categorical columns)
+metadata = to_dataframe(records)
+metadata.insert(1, 'condition', records['block'])
+metadata['subject'] = subject
+metadata['negative_first'] = neg
 
 # save metadata structure for further analysis
 subj = str(subject).rjust(3, '0')
 metadata_export = fname.dataframes + '/rt_data_sub-%s.tsv' % subj
 
 # save metadata to df
-metadata.to_csv(metadata_export,
-                sep='\t')
+with atomic_write(metadata_export) as tmp:
+    metadata.to_csv(tmp,
+                    sep='\t')
 
 ###############################################################################
 # 5) Set descriptive event names for extraction of epochs
-reaction_ids = {'correct_congruent': 11,
-                'correct_incongruent': 12,
-                'incorrect_congruent': 13,
-                'incorrect_incongruent': 14}
+reaction_ids = reaction_event_ids
 
 # only keep reaction events
 react_events = new_evs[np.where((new_evs[:, 2] >= 11) & (new_evs[:, 2] <= 14))]
 
 ###############################################################################
 # 6) Extract the epochs
-# drop metadata rows that contain nas (e.g., missed reactions)
-metadata = metadata.dropna()
-
-# rejection threshold
-reject = dict(eeg=250-6)
+# only keep the metadata of trials with a reaction (e.g., not of missed
+# reactions)
+metadata = metadata[has_reaction(records)]
 
 # set decimation rate to achieve desired sampling freq
 decim = 1
@@ -240,24 +199,86 @@ elif raw.info['sfreq'] == 512.0:
 elif raw.info['sfreq'] == 1024.0:
     decim = 8
 
-reaction_epochs = Epochs(raw,
-                         react_events,
-                         reaction_ids,
-                         on_missing='ignore',
-                         metadata=metadata,
-                         tmin=-1.5,
-                         tmax=1.5,
-                         baseline=None,
-                         preload=True,
-                         reject_by_annotation=True,
-                         reject=reject,
-                         decim=decim)
+with profiler.stage('epochs'):
+    reaction_epochs = Epochs(raw,
+                             react_events,
+                             reaction_ids,
+                             on_missing='ignore',
+                             metadata=metadata,
+                             tmin=-1.5,
+                             tmax=1.5,
+                             baseline=None,
+                             preload=True,
+                             reject_by_annotation=True,
+                             decim=decim)
+
+# find bad channels of each trial (thresholds in config.py), interpolate them
+# in trials with only a few, drop trials with more
+with profiler.stage('reject'):
+    quality = epoch_quality(reaction_epochs.get_data())
+    bad_epochs = find_bad_epochs(quality, reaction_epochs.ch_names,
+                                 ptp_threshold=reject_ptp,
+                                 gradient_threshold=reject_gradient,
+                                 z_threshold=reject_z,
+                                 max_interpolate=reject_max_interpolate)
+    repair_epochs(reaction_epochs, bad_epochs)
 
 ###############################################################################
 # 7) Save epochs
+# create output directory (if missing, dodo.py creates them for all
+# subjects)
+make_output_dirs('reaction_epochs', [subject])
 # output path for cues
 reaction_output_path = fname.output(processing_step='reaction_epochs',
                                     subject=subject,
                                     file_type='epo.fif')
 # save to disk
-reaction_epochs.save(reaction_output_path, overwrite=True)
+with profiler.stage('save'):
+    with atomic_write(reaction_output_path) as tmp:
+        reaction_epochs.save(tmp, overwrite=True)
+    # the same data as an array, trials sorted by block and condition, for
+    # group-level analyses
+    write_epoch_store(fname.output(processing_step='reaction_epochs',
+                                   subject=subject,
+                                   file_type='epo.npy'),
+                      reaction_epochs, sort_by=['block'])
+    # amplitude measures and bad channels of all trials (before rejection),
+    # e.g., for tuning the rejection thresholds
+    with atomic_write(fname.output(processing_step='reaction_epochs',
+                                   subject=subject,
+                                   file_type='quality.npz')) as tmp:
+        with open(tmp, 'wb') as f:
+            np.savez(f, ch_names=reaction_epochs.ch_names,
+                     bad=bad_epochs['bad'], **quality)
+
+###############################################################################
+# 8) Add runtime profile to HTML report
+with open_report(fname.report(subject=subject)[0]) as report:
+    report.add_htmls_to_section(htmls=profiler.to_html(),
+                                captions='Runtime profile (step 04)',
+                                section='Profiling',
+                                replace=True)
+    report.save(fname.report(subject=subject)[1], overwrite=True,
+                open_browser=False)
+
+###############################################################################
+# 9) Record quality-control facts in the cohort index
+# reasons for dropping epochs (e.g., 'BAD', 'EEG'), events not extracted as
+# epochs (e.g., conditions missing in the data) are not counted
+drop_reasons = {}
+for log in reaction_epochs.drop_log:
+    for reason in log:
+        if reason != 'IGNORED':
+            drop_reasons[reason] = drop_reasons.get(reason, 0) + 1
+
+qc.record('reaction_epochs', subject,
+          n_events=len(react_events),
+          n_epochs=len(reaction_epochs),
+          n_dropped=sum(1 for log in reaction_epochs.drop_log
+                        if log and 'IGNORED' not in log),
+          n_interpolated=len(bad_epochs['interpolate']),
+          drop_reasons=drop_reasons,
+          epochs_per_condition={
+              condition: int((reaction_epochs.events[:, 2] == code).sum())
+              for condition, code in reaction_epochs.event_id.items()})
+qc.mark('reaction_epochs', subject)
@@ -12,82 +12,167 @@ Authors: José C. García Alanis <alanis.jcg@gmail.com>
 License: BSD (3-clause)
 """
 
-import numpy as np
+import os
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from matplotlib.colorbar import ColorbarBase
-from matplotlib.colors import Normalize
+import numpy as np
 
-from mne import read_epochs, combine_evoked, grand_average
-from mne.channels import make_1020_channel_selections
+from mne import create_info, combine_evoked, EvokedArray
 from mne.viz import plot_compare_evokeds
 
 # All parameters are defined in config.py
-from config import subjects, fname, LoggingFormat
-from stats import within_subject_cis
-
-incongruent_incorrect_neu = dict()
-incongruent_correct_neu = dict()
-incongruent_incorrect_erps_neu = dict()
-incongruent_correct_erps_neu = dict()
-incongruent_incorrect_pos = dict()
-incongruent_correct_pos = dict()
-incongruent_incorrect_erps_pos = dict()
-incongruent_correct_erps_pos = dict()
-incongruent_incorrect_neg = dict()
-incongruent_correct_neg = dict()
-incongruent_incorrect_erps_neg = dict()
-incongruent_correct_erps_neg = dict()
-
-baseline = (-0.800, -0.500)
-
-###############################################################################
-# 1) loop through subjects and compute ERPs for A and B cues
-for subj in subjects:
+from config import subjects, fname, montage, n_jobs, erp_windows, \
+    baseline, prefetch_subjects, prefetch_max_bytes, LoggingFormat
+from stats import GrandAverage, bootstrap_erp_measures, bootstrap_ci, \
+    baseline_correct, condition_averages
+from clusters import montage_adjacency, permutation_cluster_test
+from epochstore import read_epoch_store
+from profiling import StepProfiler
+from utils import prefetch
+
+# record runtime of the group-level stages
+profiler = StepProfiler('analysis', log_file=fname.profile_log)
+
+# streaming grand averages, subjects are folded in one at a time so that
+# only the current subject's epochs need to be kept in memory
+# (block and event of the trials in each condition, found with the bitmap
+# index of the subject's epochs, see conditions.py)
+conditions = {
+    'incongruent_incorrect_neu': dict(block=1, event='incorrect_incongruent'),
+    'incongruent_correct_neu': dict(block=1, event='correct_incongruent'),
+    'incongruent_incorrect_pos': dict(block=2, event='incorrect_incongruent'),
+    'incongruent_correct_pos': dict(block=2, event='correct_incongruent'),
+    'incongruent_incorrect_neg': dict(block=3, event='incorrect_incongruent'),
+    'incongruent_correct_neg': dict(block=3, event='correct_incongruent')}
+grand_averages = {cond: GrandAverage(weights='equal') for cond in conditions}
+
+# ERN difference waves (incorrect - correct) of each subject and block
+blocks = ['neu', 'pos', 'neg']
+difference_waves = {block: [] for block in blocks}
+
+# single-trial data at FCz for bootstrapping the ERN and Pe measures
+fcz_trials = {cond: [] for cond in conditions}
+
+
+def epochs_file(subj):
+    # the output from previous processing step (the epochs as an array,
+    # trials sorted by block and condition, see epochstore.py)
+    return fname.output(subject=subj,
+                        processing_step='reaction_epochs',
+                        file_type='epo.npy')
+
+
+def load_epochs(subj):
     # log progress
     print(LoggingFormat.PURPLE +
           LoggingFormat.BOLD +
           'Loading epochs for subject %s' % subj +
           LoggingFormat.END)
+    # read into memory (rather than memory-mapped), so that reading happens
+    # in the background
+    return read_epoch_store(epochs_file(subj), mmap_mode=None)
+
 
-    # import the output from previous processing step
-    input_file = fname.output(subject=subj,
-                              processing_step='reaction_epochs',
-                              file_type='epo.fif')
-    target_epo = read_epochs(input_file, preload=True)
-
-    # extract a and b epochs (only those with correct responses)
-    # and apply baseline
-    incongruent_incorrect_neu['subj_%s' % subj] = target_epo['block == 1']['incorrect_incongruent'].apply_baseline(baseline)
-    incongruent_correct_neu['subj_%s' % subj] = target_epo['block == 1']['correct_incongruent'].apply_baseline(baseline)
-    incongruent_incorrect_pos['subj_%s' % subj] = target_epo['block == 2']['incorrect_incongruent'].apply_baseline(baseline)
-    incongruent_correct_pos['subj_%s' % subj] = target_epo['block == 2']['correct_incongruent'].apply_baseline(baseline)
-    incongruent_incorrect_neg['subj_%s' % subj] = target_epo['block == 3']['incorrect_incongruent'].apply_baseline(baseline)
-    incongruent_correct_neg['subj_%s' % subj] = target_epo['block == 3']['correct_incongruent'].apply_baseline(baseline)
-
-    # compute ERP
-    incongruent_incorrect_erps_neu['subj_%s' % subj] = incongruent_incorrect_neu['subj_%s' % subj].average()
-    incongruent_correct_erps_neu['subj_%s' % subj] = incongruent_correct_neu['subj_%s' % subj].average()
-    incongruent_incorrect_erps_pos['subj_%s' % subj] = incongruent_incorrect_pos['subj_%s' % subj].average()
-    incongruent_correct_erps_pos['subj_%s' % subj] = incongruent_correct_pos['subj_%s' % subj].average()
-    incongruent_incorrect_erps_neg['subj_%s' % subj] = incongruent_incorrect_neg['subj_%s' % subj].average()
-    incongruent_correct_erps_neg['subj_%s' % subj] = incongruent_correct_neg['subj_%s' % subj].average()
+# the epochs of the next subjects are read in the background while the
+# current one is processed
+epochs = prefetch(load_epochs, subjects,
+                  n_ahead=prefetch_subjects,
+                  max_bytes=prefetch_max_bytes,
+                  size=lambda subj: os.path.getsize(epochs_file(subj)))
+
+###############################################################################
+# 1) loop through subjects and compute ERPs for A and B cues
+info = None
+for subj in subjects:
+    # time spent waiting for the subject's epochs
+    with profiler.stage('read_epochs', subject=subj):
+        _, store = next(epochs)
+
+    if info is None:
+        info = create_info(store.ch_names, store.info['sfreq'],
+                           store.info['ch_types'])
+        info.set_montage(montage)
+        times = store.times
+
+    # baseline corrected ERPs of all conditions in one pass over the
+    # subject's data, added to the conditions' grand averages
+    labels = np.full(len(store.data), None, dtype=object)
+    for cond, levels in conditions.items():
+        labels[store.trials(**levels)] = cond
+    averages, counts = condition_averages(store.data, labels, times,
+                                          baseline=baseline)
+
+    erps = dict()
+    for cond, levels in conditions.items():
+        fcz_trials[cond].append(baseline_correct(
+            store.get_data(picks=['FCz'], **levels), times, baseline))
+        erps[cond] = EvokedArray(averages[cond], info, tmin=times[0],
+                                 nave=counts[cond], verbose=False)
+        grand_averages[cond].add(erps[cond])
+
+    for block in blocks:
+        difference_waves[block].append(
+            erps['incongruent_incorrect_%s' % block].data -
+            erps['incongruent_correct_%s' % block].data)
 
 # create evokeds dict
 ga_incongruent_incorrect_neu = \
-    grand_average(list(incongruent_incorrect_erps_neu.values()))
+    grand_averages['incongruent_incorrect_neu'].to_evoked()
 ga_incongruent_correct_neu = \
-    grand_average(list(incongruent_correct_erps_neu.values()))
+    grand_averages['incongruent_correct_neu'].to_evoked()
 ga_incongruent_incorrect_pos = \
-    grand_average(list(incongruent_incorrect_erps_pos.values()))
+    grand_averages['incongruent_incorrect_pos'].to_evoked()
 ga_incongruent_correct_pos = \
-    grand_average(list(incongruent_correct_erps_pos.values()))
+    grand_averages['incongruent_correct_pos'].to_evoked()
 ga_incongruent_incorrect_neg = \
-    grand_average(list(incongruent_incorrect_erps_neg.values()))
+    grand_averages['incongruent_incorrect_neg'].to_evoked()
 ga_incongruent_correct_neg = \
-    grand_average(list(incongruent_correct_erps_neg.values()))
+    grand_averages['incongruent_correct_neg'].to_evoked()
+
+
+###############################################################################
+# 2) Cluster-based permutation test of ERN difference waves
+# channel adjacency from the montage
+adjacency = montage_adjacency(ga_incongruent_incorrect_neu.ch_names, montage)
+# time window to test
+test_times = (ga_incongruent_incorrect_neu.times >= -0.1) & \
+             (ga_incongruent_incorrect_neu.times <= 0.6)
+
+cluster_results = dict()
+for block in blocks:
+    with profiler.stage('cluster_test', block=block):
+        t_obs, clusters, cluster_pv, h0 = permutation_cluster_test(
+            np.stack(difference_waves[block])[..., test_times],
+            adjacency,
+            n_permutations=10000,
+            seed=42,
+            n_jobs=n_jobs if isinstance(n_jobs, int) else 1)
+    cluster_results[block] = t_obs, clusters, cluster_pv
+
+    print(LoggingFormat.CYAN +
+          'ERN difference (%s): %s of %s clusters with p < 0.05'
+          % (block, np.sum(cluster_pv < 0.05), len(clusters)) +
+          LoggingFormat.END)
+
+###############################################################################
+# 3) Bootstrap ERN and Pe peak amplitude, latency and mean amplitude at FCz
+measures = dict()
+for cond in conditions:
+    with profiler.stage('bootstrap', condition=cond):
+        measures[cond] = bootstrap_erp_measures(
+            fcz_trials[cond],
+            ga_incongruent_incorrect_neu.times,
+            erp_windows,
+            n_resamples=5000,
+            seed=42,
+            n_jobs=n_jobs if isinstance(n_jobs, int) else 1)
+
+    for component in erp_windows:
+        lower, upper = bootstrap_ci(
+            measures[cond][component]['peak_latency'])[:, 0]
+        print(LoggingFormat.CYAN +
+              '%s %s peak latency: %.3f - %.3f s (95%% CI)'
+              % (cond, component, lower, upper) +
+              LoggingFormat.END)
 
 
 # create and plot difference ERP
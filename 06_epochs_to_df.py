@@ -11,23 +11,18 @@ Authors: José C. García Alanis <alanis.jcg@gmail.com>
 
 License: BSD (3-clause)
 """
+import os
 
-import numpy as np
-import pandas as pd
+from mne import read_epochs
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from matplotlib.colorbar import ColorbarBase
-from matplotlib.colors import Normalize
-
-from mne import read_epochs, combine_evoked, grand_average, epochs
-from mne.channels import make_1020_channel_selections
-from mne.viz import plot_compare_evokeds
-import mne
 # All parameters are defined in config.py
-from config import subjects, fname, LoggingFormat
-from stats import within_subject_cis
+from config import subjects, fname, baseline, prefetch_subjects, \
+    prefetch_max_bytes, LoggingFormat
+from profiling import StepProfiler
+from utils import prefetch
+
+# record runtime of the group-level stages
+profiler = StepProfiler('epochs_to_df', log_file=fname.profile_log)
 
 incongruent_incorrect_neu = dict()
 incongruent_correct_neu = dict()
@@ -42,32 +37,48 @@ incongruent_correct_neg = dict()
 incongruent_incorrect_erps_neg = dict()
 incongruent_correct_erps_neg = dict()
 
-baseline = (-0.800, -0.500)
 
-###############################################################################
-# 1) loop through subjects and compute ERPs for A and B cues
-for sub in subjects:
+def epochs_file(sub):
+    # the output from previous processing step
+    return fname.output(subject=sub,
+                        processing_step='reaction_epochs',
+                        file_type='epo.fif')
+
+
+def load_epochs(sub):
     # log progress
     print(LoggingFormat.PURPLE +
           LoggingFormat.BOLD +
           'Loading epochs for subject %s' % sub +
           LoggingFormat.END)
+    return read_epochs(epochs_file(sub), preload=True)
+
+
+###############################################################################
+# 1) loop through subjects and compute ERPs for A and B cues
+# (the epochs of the next subjects are read in the background while the
+# current one is processed)
+epochs = prefetch(load_epochs, subjects,
+                  n_ahead=prefetch_subjects,
+                  max_bytes=prefetch_max_bytes,
+                  size=lambda sub: 2 * os.path.getsize(epochs_file(sub)))
+
+for sub in subjects:
+    # time spent waiting for the subject's epochs
+    with profiler.stage('read_epochs', subject=sub):
+        _, ern_epo = next(epochs)
+
+    with profiler.stage('to_data_frame', subject=sub):
+        df_epo = ern_epo.copy().apply_baseline(baseline)
+        df_epo.crop(tmin=0, tmax=.1)
+        df = df_epo.to_data_frame(picks='FCz', index=['epoch'])
+        df = df[['time', 'FCz']]
+        df = df.merge(df_epo.metadata, left_index=True, right_index=True)
 
-    # import the output from previous processing step
-    input_file = fname.output(subject=sub,
-                              processing_step='reaction_epochs',
-                              file_type='epo.fif')
-    ern_epo = read_epochs(input_file, preload=True)
-
-
-    df_epo = ern_epo.copy().apply_baseline(baseline)
-    df_epo.crop(tmin=0, tmax=.1)
-    df = df_epo.to_data_frame(picks='FCz', index=['epoch'])
-    df = df[['time', 'FCz']]
-    df = df.merge(df_epo.metadata, left_index=True, right_index=True)
-    df.to_csv(
-        '/Users/philipplange/PycharmProjects/social_flanker/ernsoc_data_bids/derivatives/results/dataframes/epoch_frames/epoch_subject%s' % sub +
-        '.tsv')
+    with profiler.stage('write', subject=sub):
+        df.to_csv(
+            '/Users/philipplange/PycharmProjects/social_flanker/ernsoc_data_bids/derivatives/results/dataframes/epoch_frames/epoch_subject%s' % sub +
+            '.tsv')
 
 # create evokeds dict
 
@@ -0,0 +1,62 @@
+"""
+===================================
+Extract single-trial ERP features
+===================================
+
+Compute ERN and Pe mean amplitudes, peak amplitudes and peak latencies, as
+well as the pre-response baseline, for each trial in the reaction epochs.
+The result is one row per trial joined with the behavioural metadata
+(i.e., the rt_data), ready for mixed-model analyses.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import pandas as pd
+
+from mne import read_epochs
+
+# All parameters are defined in config.py
+from config import fname, parser, erp_windows, baseline, feature_channels, \
+    LoggingFormat
+from stats import trial_features
+from utils import atomic_write
+
+# Handle command line arguments
+args = parser.parse_args()
+subject = args.subject
+
+print(LoggingFormat.PURPLE +
+      LoggingFormat.BOLD +
+      'Extracting single-trial features for subject %s' % subject +
+      LoggingFormat.END)
+
+###############################################################################
+# 1) Import the output from previous processing step
+input_file = fname.output(subject=subject,
+                          processing_step='reaction_epochs',
+                          file_type='epo.fif')
+reaction_epochs = read_epochs(input_file, preload=True)
+
+###############################################################################
+# 2) Compute features for all trials at once
+data = reaction_epochs.get_data(picks=feature_channels) * 1e6  # microvolt
+features = trial_features(data,
+                          times=reaction_epochs.times,
+                          ch_names=feature_channels,
+                          windows=erp_windows,
+                          baseline=baseline)
+
+###############################################################################
+# 3) Join with trial metadata
+metadata = reaction_epochs.metadata.reset_index(drop=True)
+features = pd.concat([metadata, pd.DataFrame(features)], axis=1)
+
+###############################################################################
+# 4) Save features
+subj = str(subject).rjust(3, '0')
+features_export = fname.dataframes + '/features_sub-%s.tsv' % subj
+with atomic_write(features_export) as tmp:
+    features.to_csv(tmp,
+                    sep='\t',
+                    index=False)
@@ -0,0 +1,118 @@
+"""
+==============================================
+Time-frequency analysis of the reaction epochs
+==============================================
+
+Compute power and inter-trial phase coherence (e.g., of frontal-midline
+theta after erroneous responses) of each condition, and the single-trial
+power at the frontal-midline channels, with Morlet wavelets (see tfr.py).
+
+Subjects are independent, run them in parallel with, e.g.,
+``doit -n 4 time_frequency``.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import numpy as np
+
+# All parameters are defined in config.py
+from config import fname, parser, make_output_dirs, feature_channels, \
+    n_jobs, tfr_freqs, tfr_n_cycles, tfr_decim, tfr_max_bytes, LoggingFormat
+from epochstore import read_epoch_store
+from profiling import StepProfiler
+from tfr import stack_conditions, tfr_morlet, write_tfr
+from utils import atomic_write
+
+# Handle command line arguments
+args = parser.parse_args()
+subject = args.subject
+
+print(LoggingFormat.PURPLE +
+      LoggingFormat.BOLD +
+      'Time-frequency analysis for subject %s' % subject +
+      LoggingFormat.END)
+
+# record runtime of the processing stages
+profiler = StepProfiler('time_frequency', subject=subject,
+                        log_file=fname.profile_log)
+
+# block and event of the trials in each condition
+conditions = {
+    'incongruent_incorrect_neu': dict(block=1, event='incorrect_incongruent'),
+    'incongruent_correct_neu': dict(block=1, event='correct_incongruent'),
+    'incongruent_incorrect_pos': dict(block=2, event='incorrect_incongruent'),
+    'incongruent_correct_pos': dict(block=2, event='correct_incongruent'),
+    'incongruent_incorrect_neg': dict(block=3, event='incorrect_incongruent'),
+    'incongruent_correct_neg': dict(block=3, event='correct_incongruent')}
+
+###############################################################################
+# 1) Import the output from previous processing step (the epochs as an array,
+# memory-mapped, see epochstore.py)
+input_file = fname.output(subject=subject,
+                          processing_step='reaction_epochs',
+                          file_type='epo.npy')
+store = read_epoch_store(input_file)
+
+labels = np.full(len(store.data), None, dtype=object)
+for cond, levels in conditions.items():
+    labels[store.trials(**levels)] = cond
+
+###############################################################################
+# 2) Compute power and ITC of each condition, and the single-trial power at
+# the frontal-midline channels
+make_output_dirs('time_frequency', [subject])
+single_trial_file = fname.output(processing_step='time_frequency',
+                                 subject=subject,
+                                 file_type='tfr_trials.npy')
+picks = [store.ch_names.index(ch) for ch in feature_channels]
+times = store.times[::tfr_decim]
+
+with profiler.stage('tfr_morlet'):
+    with atomic_write(single_trial_file) as tmp:
+        single_trials = np.lib.format.open_memmap(
+            tmp, mode='w+', dtype=np.float32,
+            shape=(len(store.data), len(picks), len(tfr_freqs), len(times)))
+        power, itc, counts = tfr_morlet(
+            store.data, store.info['sfreq'], tfr_freqs, labels,
+            n_cycles=tfr_n_cycles,
+            decim=tfr_decim,
+            single_trials=single_trials,
+            single_trial_picks=picks,
+            max_bytes=tfr_max_bytes,
+            workers=n_jobs if isinstance(n_jobs, int) else 1)
+        single_trials.flush()
+        del single_trials
+
+###############################################################################
+# 3) Save the results
+info = dict(freqs=tfr_freqs,
+            tmin=float(times[0]),
+            sfreq=store.info['sfreq'] / tfr_decim)
+
+# conditions with trials, in the order defined above
+conditions = [cond for cond in conditions if cond in counts]
+
+with profiler.stage('save'):
+    # condition averages, shape (n_conditions, 2, n_channels, n_freqs,
+    # n_times), empty if the subject has no trials in any condition
+    write_tfr(fname.output(processing_step='time_frequency',
+                           subject=subject,
+                           file_type='tfr.npy'),
+              stack_conditions(power, itc, conditions,
+                               (len(store.ch_names), len(tfr_freqs),
+                                len(times))),
+              dict(info,
+                   conditions=conditions,
+                   counts=[counts[cond] for cond in conditions],
+                   measures=['power', 'itc'],
+                   ch_names=store.ch_names))
+
+    # the single trials (written above), shape (n_trials, n_picks, n_freqs,
+    # n_times), in the order of the epochs store
+    write_tfr(single_trial_file, None,
+              dict(info,
+                   ch_names=feature_channels,
+                   events=store.info['events'],
+                   **({'metadata': store.info['metadata']}
+                      if 'metadata' in store.info else {})))
@@ -3,7 +3,8 @@
 Find bad channels
 =================
 
-Methods for finding bad (e.g., noisy) channels in EEG data.
+Methods for finding bad (e.g., noisy) channels in EEG data, and bad
+channels and trials in epochs.
 
 Authors: José C. García Alanis <alanis.jcg@gmail.com>
 
@@ -12,12 +13,12 @@ License: BSD (3-clause)
 import warnings
 
 import numpy as np
-from scipy.stats import median_abs_deviation as mad
 
-from mne.io.base import BaseRaw
+from profiling import profiled
 
 
 # main function which implements different methods
+@profiled('find_bad_channels')
 def find_bad_channels(inst, picks='eeg',
                       method='correlation',
                       mad_threshold=1,
@@ -28,6 +29,9 @@ def find_bad_channels(inst, picks='eeg',
                       sfreq=None,
                       return_z_scores=False,
                       channels=None):
+    from scipy.stats import median_abs_deviation as mad
+
+    from mne.io.base import BaseRaw
 
     # arguments to be passed to pick_types
     kwargs = {pick: True for pick in [picks]}
@@ -66,7 +70,7 @@ def find_bad_channels(inst, picks='eeg',
         std_flats = np.std(dat, axis=1) < std_threshold
 
         # flat channels identified
-        flats = np.argwhere(np.logical_or(mad_flats, std_flats))
+        flats = np.flatnonzero(np.logical_or(mad_flats, std_flats))
         flats = np.asarray([channels[int(flat)] for flat in flats])
 
         # warn user if too many channels were identified as flat
@@ -158,9 +162,291 @@ def find_bad_channels(inst, picks='eeg',
         frac_bad_corr_windows = np.mean(thresholded_correlations, axis=1)
 
         # find the corresponding channel names and return
-        bad_idxs = np.argwhere(frac_bad_corr_windows > percent_threshold)
+        bad_idxs = np.flatnonzero(frac_bad_corr_windows > percent_threshold)
         uncorrelated_channels = [channels[int(bad)] for bad in bad_idxs]
 
         bad_channels.update(correlation=np.asarray(uncorrelated_channels))  # noqa: E501
 
     return bad_channels
+
+
+def find_artefacts(data, picks, sfreq, threshold=250e-6, min_distance=1.):
+    """Find samples at which the signal exceeds an amplitude threshold.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The EEG signal (in volts).
+    picks : list of int
+        The channels (rows of `data`) to look for artefacts in.
+    sfreq : float
+        The sampling frequency.
+    threshold : float
+        Absolute amplitude above which a sample is considered an artefact.
+    min_distance : float
+        Samples closer than this (in seconds) to the previous artefact are
+        not checked.
+
+    Returns
+    -------
+    onsets : list of float
+        Sample index of each artefact.
+    channels : list of int
+        Channel (row of `data`) with the largest absolute amplitude at each
+        artefact.
+    """
+    onsets = []
+    channels = []
+
+    # loop through samples
+    for sample in range(0, data.shape[1]):
+        if len(onsets) > 0:
+            if sample <= (onsets[-1] + int(min_distance * sfreq)):
+                continue
+        peak = []
+        for channel in picks:
+            peak.append(abs(data[channel][sample]))
+        if max(peak) >= threshold:
+            onsets.append(float(sample))
+            channels.append(picks[int(np.argmax(peak))])
+
+    return onsets, channels
+
+
+def _robust_z_scores(values):
+    """Robust z-scores along the first axis (0 where the MAD is zero)."""
+    from scipy.stats import median_abs_deviation as mad
+
+    median = np.median(values, axis=0)
+    deviation = mad(values, scale=1, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_scores = 0.6745 * (values - median) / deviation
+    return np.where(deviation > 0, z_scores, 0.)
+
+
+def epoch_quality(data):
+    """Compute amplitude measures of each trial and channel.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        The epochs (in volts).
+
+    Returns
+    -------
+    quality : dict of ndarray, shape (n_trials, n_channels)
+        The peak-to-peak amplitude ('ptp', in volts), the largest step
+        between consecutive samples ('gradient', in volts, i.e., at the
+        sampling rate of the epochs), and the robust z-scores of both
+        across the trials of each channel ('ptp_z' and 'gradient_z').
+    """
+    n_trials, n_channels, _ = data.shape
+    ptp = np.empty((n_trials, n_channels))
+    gradient = np.empty((n_trials, n_channels))
+    # one channel at a time, so that temporary arrays stay small
+    for ch in range(n_channels):
+        ptp[:, ch] = np.ptp(data[:, ch], axis=-1)
+        gradient[:, ch] = np.abs(np.diff(data[:, ch], axis=-1)).max(axis=-1)
+
+    return dict(ptp=ptp,
+                gradient=gradient,
+                ptp_z=_robust_z_scores(ptp),
+                gradient_z=_robust_z_scores(gradient))
+
+
+def find_bad_epochs(quality, ch_names, ptp_threshold=150e-6,
+                    gradient_threshold=None, z_threshold=7.,
+                    max_interpolate=4):
+    """Find bad channels in each trial, and the trials to drop.
+
+    The thresholds are applied to the measures of `epoch_quality`, which
+    are computed once, so that they can be tuned without epoching the data
+    again.
+
+    Parameters
+    ----------
+    quality : dict of ndarray, shape (n_trials, n_channels)
+        The amplitude measures (see `epoch_quality`).
+    ch_names : list of str
+        The names of the channels.
+    ptp_threshold : float | None
+        Peak-to-peak amplitude (in volts) above which a channel is bad in a
+        trial. None disables the criterion.
+    gradient_threshold : float | None
+        Step between consecutive samples (in volts) above which a channel
+        is bad in a trial. None disables the criterion.
+    z_threshold : float | None
+        Robust z-score (of the peak-to-peak amplitude or the gradient,
+        across the trials of the channel; one-sided, i.e., trials with
+        unusually low amplitudes are kept) above which a channel is bad in
+        a trial (on clean data, about 1 in 34,000 channel-trials exceeds 7,
+        see config.py). None disables the criterion.
+    max_interpolate : int
+        Trials with up to this many bad channels are kept (and their bad
+        channels interpolated), trials with more are dropped.
+
+    Returns
+    -------
+    bad_epochs : dict
+        'bad', the bad channels of each trial (a boolean array, shape
+        (n_trials, n_channels)); 'drop', the trials to drop; 'interpolate',
+        the bad channels of each trial that is kept (a dict); and
+        'drop_log', the bad channels of each trial (a tuple of tuples, as
+        the drop log of MNE's Epochs).
+    """
+    bad = np.zeros(quality['ptp'].shape, dtype=bool)
+    if ptp_threshold is not None:
+        bad |= quality['ptp'] > ptp_threshold
+    if gradient_threshold is not None:
+        bad |= quality['gradient'] > gradient_threshold
+    if z_threshold is not None:
+        # only unusually large amplitudes, not unusually clean trials
+        bad |= quality['ptp_z'] > z_threshold
+        bad |= quality['gradient_z'] > z_threshold
+
+    n_bad = bad.sum(axis=1)
+    drop = np.flatnonzero(n_bad > max_interpolate)
+    interpolate = {int(trial): [ch_names[ch]
+                                for ch in np.flatnonzero(bad[trial])]
+                   for trial in np.flatnonzero((n_bad > 0) &
+                                               (n_bad <= max_interpolate))}
+    drop_log = tuple(tuple(ch_names[ch] for ch in np.flatnonzero(row))
+                     for row in bad)
+
+    return dict(bad=bad, drop=drop, interpolate=interpolate,
+                drop_log=drop_log)
+
+
+def repair_epochs(epochs, bad_epochs):
+    """Interpolate the bad channels of trials and drop the bad trials.
+
+    Parameters
+    ----------
+    epochs : instance of Epochs
+        The (preloaded) epochs, the trials of `bad_epochs`. Modified in
+        place.
+    bad_epochs : dict
+        The bad channels and trials (see `find_bad_epochs`).
+
+    Returns
+    -------
+    epochs : instance of Epochs
+        The repaired epochs. Dropped trials are logged with their bad
+        channels as the reason.
+    """
+    # trials with the same bad channels are interpolated together
+    groups = dict()
+    for trial, channels in bad_epochs['interpolate'].items():
+        groups.setdefault(tuple(channels), []).append(trial)
+
+    if groups:
+        data = epochs.get_data()
+        for channels, trials in groups.items():
+            repaired = epochs[trials]
+            repaired.info['bads'] = list(channels)
+            repaired.interpolate_bads(reset_bads=True, verbose=False)
+            data[trials] = repaired.get_data()
+        epochs.apply_function(lambda _: data, picks='all',
+                              channel_wise=False)
+
+    # trials with the same reason are dropped together (the indices of
+    # `drop` refer to the trials before any is dropped)
+    selection = epochs.selection.copy()
+    reasons = dict()
+    for trial in bad_epochs['drop']:
+        reasons.setdefault(bad_epochs['drop_log'][trial], []).append(
+            selection[trial])
+    for reason, dropped in reasons.items():
+        epochs.drop(np.flatnonzero(np.isin(epochs.selection, dropped)),
+                    reason=reason, verbose=False)
+
+    return epochs
+
+
+def robust_reference(raw, r_threshold=0.45, percent_threshold=0.05,
+                     time_step=1.0, max_iter=4):
+    """Estimate an average reference that is robust to noisy channels.
+
+    Starting from the median across channels, noisy channels (by deviation
+    or correlation) are repeatedly found in the referenced signal and
+    interpolated, and the reference is recomputed as the mean across
+    channels, until no further noisy channels are found.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The (preloaded) recording.
+    r_threshold : float
+        Correlation threshold of the correlation criterion.
+    percent_threshold : float
+        Fraction of time windows a channel has to be uncorrelated in.
+    time_step : float
+        Length of the time windows of the correlation criterion (in
+        seconds).
+    max_iter : int
+        Maximum number of iterations after the first.
+
+    Returns
+    -------
+    ref_signal : ndarray, shape (n_samples,)
+        The reference signal.
+    noisy : list of str
+        The channels interpolated to compute it.
+    """
+    from mne import pick_types
+
+    sfreq = raw.info['sfreq']
+    channels = [raw.ch_names[idx] for idx in pick_types(raw.info, eeg=True)]
+
+    # extract eeg signal
+    eeg_signal = raw.get_data(picks='eeg')
+
+    # reference signal to robust estimate of central tendency
+    ref_signal = np.nanmedian(eeg_signal, axis=0)
+
+    i = 0
+    noisy = []
+    while True:
+        # remove reference
+        eeg_temp = eeg_signal - ref_signal
+
+        # find bad channels by deviation (high variability in amplitude)
+        bad_dev = find_bad_channels(eeg_temp,
+                                    channels=channels,
+                                    method='deviation')['deviation']
+
+        # find channels that don't well with other channels
+        bad_corr = find_bad_channels(eeg_temp,
+                                     channels=channels,
+                                     sfreq=sfreq,
+                                     r_threshold=r_threshold,
+                                     percent_threshold=percent_threshold,
+                                     time_step=time_step,
+                                     method='correlation')['correlation']
+
+        # only keep unique values
+        bads = set(bad_dev) | set(bad_corr)
+
+        # save identified noisy channels
+        if bads:
+            noisy.extend(bads)
+            print('Found bad channels %s'
+                  % (', '.join([str(chan) for chan in bads])))
+
+            # interpolate noisy channels
+            raw_copy = raw.copy()
+            raw_copy.info['bads'] = noisy
+            raw_copy.interpolate_bads(mode='accurate')
+            eeg_signal = raw_copy.get_data(picks='eeg')
+
+        # compute new reference (mean of signal with interpolated channels)
+        ref_signal = np.nanmean(eeg_signal, axis=0)
+
+        # break if no (more) bad channels found
+        if (i > 0 and len(bads) == 0) or i > max_iter:
+            print('Finishing after i == %s' % i)
+            break
+
+        i = i + 1
+
+    return ref_signal, noisy
@@ -0,0 +1,88 @@
+"""
+======================================
+Benchmarks for the preprocessing steps
+======================================
+
+Times reading the recordings, `bads.find_bad_channels` (flat, deviation and
+correlation criteria) and `bads.find_artefacts` on simulated 64-channel
+recordings (see simulation.py) with a flat channel, a noisy channel and
+blinks, for several durations and sampling rates. The recordings are written
+to a temporary directory as BDF (as delivered by the BioSemi system) and FIF
+(as written by step 00).
+
+Run with:
+
+    python benchmarks/run.py -b bench_preprocessing
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import tempfile
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from mne.io import read_raw_bdf, read_raw_fif
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bads import find_bad_channels, find_artefacts  # noqa: E402
+from simulation import simulate_raw, write_bdf  # noqa: E402
+
+# recording length (in seconds) and sampling rate
+params = [[60., 300.], [256., 512.]]
+param_names = ['duration', 'sfreq']
+
+# removed when the interpreter exits
+_tmp_dir = tempfile.TemporaryDirectory(prefix='bench_preprocessing_')
+
+
+def setup(duration, sfreq):
+    raw = simulate_raw(duration=duration, sfreq=sfreq, flat=['Oz'],
+                       noisy=['T8'], blink_rate=0.2, seed=42)
+
+    name = os.path.join(_tmp_dir.name, 'sim_%ds_%dHz' % (duration, sfreq))
+    write_bdf(name + '.bdf', raw)
+    raw.save(name + '_raw.fif', overwrite=True, verbose=False)
+
+    eeg = raw.copy().pick('eeg')
+    data = eeg.get_data()
+    # as in 01_artefact_detection.py: referenced to the median, artefacts
+    # are searched without the fronto-polar channels and after the noisy
+    # channel has been interpolated
+    picks = [eeg.ch_names.index(ch) for ch in eeg.ch_names if ch not in
+             {'Fp1', 'Fpz', 'Fp2', 'AF7', 'AF3', 'AFz', 'AF4', 'AF8', 'T8'}]
+
+    return SimpleNamespace(raw=raw, bdf=name + '.bdf', fif=name + '_raw.fif',
+                           channels=eeg.ch_names, sfreq=sfreq,
+                           data=data - np.median(data, axis=0), picks=picks)
+
+
+def time_read_bdf(sim):
+    read_raw_bdf(sim.bdf, preload=True, verbose=False)
+
+
+def time_read_fif(sim):
+    read_raw_fif(sim.fif, preload=True, verbose=False)
+
+
+def time_find_flat(sim):
+    find_bad_channels(sim.raw, picks='eeg', method='flat')
+
+
+def time_find_deviation(sim):
+    find_bad_channels(sim.data, channels=sim.channels, method='deviation')
+
+
+def time_find_correlation(sim):
+    find_bad_channels(sim.data, channels=sim.channels, sfreq=sim.sfreq,
+                      r_threshold=0.45, percent_threshold=0.05,
+                      time_step=1.0, method='correlation')
+
+
+def time_find_artefacts(sim):
+    find_artefacts(sim.data, sim.picks, sim.sfreq, threshold=250e-6)
@@ -0,0 +1,59 @@
+"""
+==================================
+Benchmarks for raw-trace snapshots
+==================================
+
+Times the raw-trace figure of the HTML reports (steps 00 and 01): the
+min/max envelope of the full recording (`viz.plot_raw_envelope`) and the
+MNE browser previously used (``raw.plot`` with all channels), each rendered
+to PNG, on simulated recordings of 5 and 30 minutes.
+
+Run with:
+
+    python benchmarks/run.py -b bench_raw_plot
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import io
+import os
+import sys
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulation import simulate_raw  # noqa: E402
+from viz import plot_raw_envelope, minmax_envelope  # noqa: E402
+
+params = [300., 1800.]
+param_names = ['duration']
+
+scalings = dict(eeg=50e-6, eog=50e-6)
+
+
+def setup(duration):
+    raw = simulate_raw(duration=duration, sfreq=256., seed=42)
+    raw.set_eeg_reference(projection=True, verbose=False)
+    return raw
+
+
+def _render(fig):
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def time_raw_plot(raw):
+    _render(raw.plot(scalings=scalings, n_channels=len(raw.ch_names),
+                     show=False))
+
+
+def time_plot_raw_envelope(raw):
+    _render(plot_raw_envelope(raw, scalings=scalings))
+
+
+def time_minmax_envelope(raw):
+    minmax_envelope(raw.get_data(), 1550)
@@ -0,0 +1,71 @@
+"""
+=========================
+Benchmarks for start-up
+=========================
+
+Measures how long importing the pipeline modules takes in a fresh
+interpreter, using ``python -X importtime``. Each run is appended to
+``benchmarks/results/startup.jsonl`` so that start-up times can be tracked
+over time.
+
+Run with:
+
+    python benchmarks/bench_startup.py
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.join(root, 'benchmarks', 'results')
+
+# modules imported by the processing scripts and by doit
+modules = ['utils', 'config', 'dodo', 'bads', 'stats', 'viz', 'clusters']
+
+
+def import_time(module, repeat=5):
+    """Best cumulative import time of a module (in seconds)."""
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               'import %s' % module],
+                              cwd=root, capture_output=True, text=True,
+                              check=True)
+        # the last line of the report is the module itself:
+        # "import time: self [us] | cumulative | imported package"
+        cumulative = proc.stderr.strip().splitlines()[-1].split('|')[1]
+        times.append(int(cumulative) / 1e6)
+
+    return min(times)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    record = dict(benchmark='startup',
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  revision=git_revision(),
+                  machine=platform.node(),
+                  python=platform.python_version(),
+                  results={module: import_time(module) for module in modules})
+
+    for module, seconds in record['results'].items():
+        print('import %-30s %8.3f s' % (module, seconds))
+
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, 'startup.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
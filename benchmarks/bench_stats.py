@@ -0,0 +1,110 @@
+"""
+==============================
+Benchmarks for stats functions
+==============================
+
+Times `stats.within_subject_cis` against the original loop implementation
+on simulated ERPs (3 conditions x 100 subjects x 64 channels x 768 samples).
+
+Run with:
+
+    python benchmarks/bench_stats.py
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from scipy import stats
+
+from mne import create_info, grand_average, EvokedArray
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import within_subject_cis, within_subject_cis_array  # noqa: E402
+
+n_conditions = 3
+n_subjects = 100
+n_channels = 64
+n_times = 768
+
+
+def setup():
+    rng = np.random.default_rng(42)
+    info = create_info(['EEG%03d' % ch for ch in range(n_channels)],
+                       sfreq=256., ch_types='eeg')
+    data = rng.normal(scale=5e-6,
+                      size=(n_conditions, n_subjects, n_channels, n_times))
+    insts = [{'subj_%s' % subj: EvokedArray(data[cond, subj], info,
+                                            tmin=-1.5, verbose=False)
+              for subj in range(n_subjects)}
+             for cond in range(n_conditions)]
+    return data, insts
+
+
+def _within_subject_cis_loop(insts, ci=0.95):
+    # original implementation, kept as a reference
+    subjs = insts[0].keys()
+    n_subj = len(insts[0])
+    n_cond = len(insts)
+    corr_factor = np.sqrt(n_cond / (n_cond - 1))
+
+    subject_erp = {subj: grand_average([insts[cond][subj]
+                                        for cond in range(n_cond)])
+                   for subj in subjs}
+    grand_averages = [grand_average(list(cond.values()))
+                      for cond in insts]
+
+    n_channels, n_times = grand_averages[0].data.shape
+    norm_erps = np.zeros((n_cond, n_subj, n_channels, n_times))
+    for n_s, subj in enumerate(subjs):
+        for ic, cond in enumerate(insts):
+            erp_data = cond[subj].data.copy() - subject_erp[subj].data
+            erp_data = (erp_data + grand_averages[ic].data) * corr_factor
+            norm_erps[ic, n_s, :] = erp_data
+
+    confidence = np.zeros((n_cond, n_channels, n_times))
+    for n_c in range(n_cond):
+        confidence[n_c, :] = stats.sem(norm_erps[n_c, :], axis=0) * \
+            stats.t.ppf((1 + ci) / 2.0, n_subj - 1)
+
+    return confidence
+
+
+def time_within_subject_cis_loop(data, insts):
+    _within_subject_cis_loop(insts)
+
+
+def time_within_subject_cis(data, insts):
+    within_subject_cis(insts)
+
+
+def time_within_subject_cis_array(data, insts):
+    within_subject_cis_array(data)
+
+
+def time_within_subject_cis_array_chunked(data, insts):
+    within_subject_cis_array(data, chunk_size=8)
+
+
+if __name__ == '__main__':
+    data, insts = setup()
+
+    # make sure the implementations agree before timing them
+    reference = _within_subject_cis_loop(insts)
+    np.testing.assert_allclose(within_subject_cis(insts), reference)
+    np.testing.assert_allclose(within_subject_cis_array(data, chunk_size=8),
+                               reference)
+
+    for bench in (time_within_subject_cis_loop,
+                  time_within_subject_cis,
+                  time_within_subject_cis_array,
+                  time_within_subject_cis_array_chunked):
+        best = min(timeit.repeat(lambda: bench(data, insts),
+                                 number=1, repeat=3))
+        print('%-40s %8.3f s' % (bench.__name__, best))
@@ -0,0 +1,94 @@
+"""
+=============================
+Benchmarks for plotting steps
+=============================
+
+Times creating and rendering (to PNG, as for the HTML reports) the z-score
+plot of step 01 with `viz.plot_z_scores` and the original per-channel loop,
+for caps of 64 to 256 channels.
+
+Run with:
+
+    python benchmarks/run.py -b bench_viz
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import io
+import os
+import sys
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from viz import plot_z_scores  # noqa: E402
+
+params = [64, 128, 256]
+param_names = ['n_channels']
+
+
+def setup(n_channels):
+    rng = np.random.default_rng(42)
+    z_scores = rng.normal(size=n_channels)
+    z_scores[::20] *= 4
+    channels = ['EEG%03d' % ch for ch in range(n_channels)]
+    bads = channels[::20]
+    return z_scores, channels, bads
+
+
+def _plot_z_scores_loop(z_scores, channels, bads=None, cmap='inferno'):
+    # original implementation, kept as a reference (with sklearn's normalize
+    # replaced by the equivalent numpy expression)
+    cmap = plt.get_cmap(cmap)
+
+    z_colors = np.abs(z_scores) / np.linalg.norm(np.abs(z_scores))
+
+    props = dict(boxstyle='round', facecolor='white', alpha=0.5)
+    fig, ax = plt.subplots(figsize=(20, 6))
+    if z_scores.max() < 5.0:
+        y_lim = 5
+    else:
+        y_lim = int(z_scores.max() + 2)
+
+    for i in range(z_scores.shape[0]):
+        ch = channels[i]
+        if ch in bads:
+            col = 'crimson'
+        else:
+            col = 'k'
+        ax.axhline(y=5.0, xmin=-1.0, xmax=65,
+                   color='crimson', linestyle='dashed', linewidth=2.0)
+        ax.text(-5.0, 5.0, 'crit. Z-score', fontsize=14,
+                verticalalignment='center', horizontalalignment='center',
+                color='crimson', bbox=props)
+        ax.bar(i, np.abs(z_scores[i]), width=0.9, color=cmap(z_colors[i]))
+        ax.text(i, np.abs(z_scores[i]) + 0.25, ch, color=col,
+                fontweight='bold', fontsize=9,
+                ha='center', va='center', rotation=45)
+    ax.set_ylim(0, y_lim)
+    ax.set_xlim(-1, 64)
+    plt.close(fig)
+
+    return fig
+
+
+def _render(fig):
+    fig.savefig(io.BytesIO(), format='png')
+
+
+def time_plot_z_scores_loop(z_scores, channels, bads):
+    _render(_plot_z_scores_loop(z_scores, channels, bads))
+
+
+def time_plot_z_scores(z_scores, channels, bads):
+    _render(plot_z_scores(z_scores, channels, bads=bads))
+
+
+def time_plot_z_scores_data(z_scores, channels, bads):
+    plot_z_scores(z_scores, channels, bads=bads, return_data=True)
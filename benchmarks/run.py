@@ -0,0 +1,174 @@
+"""
+==================
+Run the benchmarks
+==================
+
+Discovers the ``time_*`` functions of the ``bench_*.py`` modules in this
+directory, times them and stores the results in ``benchmarks/results`` (one
+JSON file per run), e.g.:
+
+    python benchmarks/run.py                     # run all benchmarks
+    python benchmarks/run.py -b correlation      # only matching benchmarks
+    python benchmarks/run.py --compare latest    # compare to the last run
+
+Modules follow the conventions of asv: ``setup`` prepares the data passed to
+the timed functions (a tuple is unpacked into several arguments), and
+``params`` / ``param_names`` give the parameter grid ``setup`` is called
+with. Everything runs on simulated data, no network access or participant
+data is needed.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import argparse
+import glob
+import importlib
+import itertools
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(bench_dir)
+results_dir = os.path.join(bench_dir, 'results')
+
+parser = argparse.ArgumentParser(description='Run the benchmarks.')
+parser.add_argument('-b', '--bench', default=None,
+                    help='Only run benchmarks matching this regular '
+                         'expression (e.g., "bench_stats" or "flat").')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='Number of times each benchmark is timed.')
+parser.add_argument('--quick', action='store_true',
+                    help='Only use the first combination of parameters.')
+parser.add_argument('--compare', default=None, metavar='RESULTS',
+                    help='Results file to compare against, or "latest" for '
+                         'the most recent run.')
+parser.add_argument('--factor', type=float, default=1.2,
+                    help='Report benchmarks that got slower by more than '
+                         'this factor.')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def discover(pattern=None):
+    """Benchmark modules and their timed functions, by module name."""
+    sys.path.insert(0, bench_dir)
+
+    benchmarks = dict()
+    for path in sorted(glob.glob(os.path.join(bench_dir, 'bench_*.py'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        module = importlib.import_module(name)
+        funcs = [getattr(module, attr) for attr in sorted(dir(module))
+                 if attr.startswith('time_')]
+        if pattern is not None:
+            funcs = [func for func in funcs
+                     if re.search(pattern, '%s.%s' % (name, func.__name__))]
+        if funcs:
+            benchmarks[name] = module, funcs
+
+    return benchmarks
+
+
+def run_module(module, funcs, repeat=3, quick=False):
+    """Time the functions of a benchmark module for each set of params."""
+    params = getattr(module, 'params', [])
+    if params and not isinstance(params[0], (list, tuple)):
+        params = [params]
+    grid = list(itertools.product(*params))
+    if quick:
+        grid = grid[:1]
+
+    results = dict()
+    for values in grid:
+        args = module.setup(*values) if hasattr(module, 'setup') else ()
+        if not isinstance(args, tuple):
+            args = (args,)
+
+        for func in funcs:
+            name = '%s.%s' % (module.__name__, func.__name__)
+            if values:
+                name += '(%s)' % ', '.join(str(value) for value in values)
+            times = timeit.repeat(lambda: func(*args), number=1,
+                                  repeat=repeat)
+            results[name] = dict(min=min(times), median=np.median(times),
+                                 repeat=repeat)
+            print('%-65s %9.4f s' % (name, results[name]['min']))
+
+    return results
+
+
+def load_results(which):
+    """Load a results file ('latest' for the most recent one)."""
+    if which == 'latest':
+        files = sorted(glob.glob(os.path.join(results_dir, 'run_*.json')))
+        if not files:
+            raise ValueError('No previous results in %s' % results_dir)
+        which = files[-1]
+
+    with open(which) as f:
+        return json.load(f)
+
+
+def compare(previous, current, factor=1.2):
+    """Print timing ratios and return the benchmarks that got slower."""
+    print('\nCompared to %s (revision %s):'
+          % (previous['time'], previous['revision']))
+
+    slower = []
+    for name, result in current['results'].items():
+        if name not in previous['results']:
+            continue
+        ratio = result['min'] / previous['results'][name]['min']
+        mark = '+' if ratio > factor else '-' if ratio < 1. / factor else ' '
+        if mark == '+':
+            slower.append(name)
+        print('%s %-65s %9.4f s -> %9.4f s  %5.2fx'
+              % (mark, name, previous['results'][name]['min'],
+                 result['min'], ratio))
+
+    return slower
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    previous = load_results(args.compare) if args.compare else None
+
+    record = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  revision=git_revision(),
+                  machine=platform.node(),
+                  python=platform.python_version(),
+                  results=dict())
+    for module, funcs in discover(args.bench).values():
+        record['results'].update(run_module(module, funcs, args.repeat,
+                                            args.quick))
+
+    os.makedirs(results_dir, exist_ok=True)
+    output = os.path.join(results_dir, 'run_%s_%s.json'
+                          % (time.strftime('%Y%m%d-%H%M%S'),
+                             record['revision']))
+    with open(output, 'w') as f:
+        json.dump(record, f, indent=2)
+    print('\nResults saved to %s' % output)
+
+    if previous is not None:
+        slower = compare(previous, record, args.factor)
+        if slower:
+            print('\n%d benchmark(s) got slower by more than %.2fx'
+                  % (len(slower), args.factor))
+            sys.exit(1)
@@ -0,0 +1,166 @@
+"""
+===========================================
+Checkpoints of expensive processing stages
+===========================================
+
+Intermediate results of a processing step (e.g., the filtered recording)
+are stored as checkpoints, keyed by the step's input, so that a step that
+was interrupted resumes from the stages it had already completed, e.g.:
+
+    >>> checkpoints = Checkpoints(fname.checkpoints, 'repair_bads',
+    ...                           subject=2,
+    ...                           key=input_key(input_file, __file__))
+    >>> raw = checkpoints.get('filtered_raw',
+    ...                       lambda: raw.filter(l_freq=0.1, h_freq=40.),
+    ...                       kind='raw')
+
+Checkpoints are written with `utils.atomic_write`, so that a checkpoint
+either exists completely or not at all, and are only used if they match
+the checksum recorded when they were written. Checkpoints of other
+keys (i.e., of a previous input or version of the step) are not used and
+are removed when a new checkpoint is saved. Once a step has completed, its
+checkpoints are removed with `Checkpoints.clear`.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import glob
+import os
+import shutil
+
+import numpy as np
+
+from figcache import digest, digest_file
+from utils import atomic_write, verify_checksum
+
+# directory of the pipeline's scripts and modules, and the study
+# configuration (part of the key of all checkpoints)
+_source_dir = os.path.dirname(os.path.abspath(__file__))
+_config_file = os.path.join(_source_dir, 'config.py')
+
+
+def _write_raw(raw, fname):
+    # single precision, as the step's output (long recordings are split
+    # into several files, see utils.atomic_write); `Checkpoints.get` reads
+    # it back, so that resumed and uninterrupted runs continue from the
+    # same data
+    raw.save(fname, overwrite=True)
+
+
+def _read_raw(fname):
+    from mne.io import read_raw_fif
+    return read_raw_fif(fname, preload=True)
+
+
+def _write_arrays(arrays, fname):
+    with open(fname, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _read_arrays(fname):
+    with np.load(fname) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+# writer, reader and file name suffix of each kind of checkpoint
+kinds = dict(raw=(_write_raw, _read_raw, '-raw.fif'),
+             arrays=(_write_arrays, _read_arrays, '.npz'))
+
+
+def input_key(input_file, *sources):
+    """Key of the checkpoints of a step.
+
+    The input file is identified by its path, size and modification time
+    (rather than its content, so that it is not read an extra time); the
+    (small) source files, i.e., the step's script and the modules its
+    checkpointed stages call (e.g., 'bads.py', relative to the pipeline's
+    directory), and config.py by their content.
+    """
+    stat = os.stat(input_file)
+    return digest(os.path.abspath(input_file), stat.st_size,
+                  stat.st_mtime_ns,
+                  *[digest_file(os.path.join(_source_dir, source))
+                    for source in (_config_file,) + sources])
+
+
+class Checkpoints(object):
+    """Checkpoints of one processing step for one subject.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Directory the checkpoints of all steps and subjects are stored in.
+    step : str
+        The processing step (e.g., 'repair_bads').
+    subject : int
+        The subject that is processed.
+    key : str
+        Identifies the input of the step (see `input_key`). Only
+        checkpoints with this key are used.
+    """
+
+    def __init__(self, checkpoint_dir, step, subject, key):
+        self.path = os.path.join(checkpoint_dir, 'sub-%03d' % subject, step)
+        self.key = key
+
+    def _fname(self, stage, kind):
+        return os.path.join(self.path, '%s-%s%s'
+                            % (stage, self.key, kinds[kind][2]))
+
+    def load(self, stage, kind='arrays'):
+        """Load the checkpoint of a stage (None if there is no valid one)."""
+        fname = self._fname(stage, kind)
+        if not verify_checksum(fname):
+            return None
+        print('Resuming from checkpoint %s' % fname)
+
+        return kinds[kind][1](fname)
+
+    def save(self, stage, obj, kind='arrays'):
+        """Save the checkpoint of a stage (and remove its older ones)."""
+        write = kinds[kind][0]
+        fname = self._fname(stage, kind)
+        os.makedirs(self.path, exist_ok=True)
+
+        with atomic_write(fname) as tmp:
+            write(obj, tmp)
+
+        # (including the parts of split FIF files of this key)
+        current = os.path.join(self.path, '%s-%s' % (stage, self.key))
+        for old in glob.glob(os.path.join(self.path, '%s-*' % stage)):
+            if not old.startswith(current):
+                os.remove(old)
+
+    def get(self, stage, compute, kind='arrays'):
+        """Load the checkpoint of a stage, or compute and save it.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage (e.g., 'filtered_raw').
+        compute : callable
+            Computes the result of the stage when called without arguments.
+        kind : 'raw' | 'arrays'
+            What the stage computes: a Raw instance or a dict of arrays.
+
+        Returns
+        -------
+        obj : instance of Raw | dict
+            The result of the stage, as read back from the checkpoint (e.g.,
+            a Raw in single precision), so that a resumed run gives the
+            same result as an uninterrupted one.
+        """
+        obj = self.load(stage, kind=kind)
+        if obj is None:
+            self.save(stage, compute(), kind=kind)
+            obj = kinds[kind][1](self._fname(stage, kind))
+
+        return obj
+
+    def clear(self):
+        """Remove all checkpoints of the step."""
+        if not os.path.isdir(self.path):
+            return
+        # including temporary files left by interrupted runs
+        shutil.rmtree(self.path)
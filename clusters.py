@@ -0,0 +1,258 @@
+"""
+=================================
+Cluster-based permutation testing
+=================================
+
+Non-parametric one-sample cluster-based permutation test over channels x
+time points (Maris & Oostenveld, 2007), e.g., for paired contrasts such as
+ERN difference waves (incorrect - correct).
+
+Permutations flip the sign of each subject's difference wave. All sign-flip
+matrices are drawn up front from a single seed, so the results do not depend
+on the number of workers used to evaluate them.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils import mp_context
+
+# state shared with the worker processes (set by _init_worker)
+_worker = dict()
+
+
+def montage_adjacency(ch_names, montage):
+    """Compute the channel adjacency matrix for channels of a montage.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The channels (in order of the data) to compute the adjacency for.
+    montage : instance of DigMontage
+        The montage providing the channel positions (e.g. `config.montage`).
+
+    Returns
+    -------
+    adjacency : scipy.sparse.csr_matrix, shape (n_channels, n_channels)
+        Channel adjacency based on a Delaunay triangulation of the sensor
+        positions.
+    """
+    from mne import create_info
+    from mne.channels import find_ch_adjacency
+
+    info = create_info(list(ch_names), sfreq=1., ch_types='eeg')
+    info.set_montage(montage)
+    adjacency, _ = find_ch_adjacency(info, ch_type='eeg')
+
+    return adjacency.tocsr()
+
+
+def spatio_temporal_adjacency(adjacency, n_times):
+    """Combine channel adjacency with temporal adjacency.
+
+    Features are ordered as in ``data.reshape(n_channels * n_times)``, i.e.,
+    feature ``ch * n_times + t``. Neighbouring channels at the same time point
+    and neighbouring time points of the same channel are adjacent.
+    """
+    from scipy import sparse
+
+    adjacency = sparse.csr_matrix(adjacency, dtype=bool)
+    n_channels = adjacency.shape[0]
+    adjacency = adjacency - sparse.diags(adjacency.diagonal(), dtype=bool)
+
+    time_chain = sparse.diags([np.ones(n_times - 1), np.ones(n_times - 1)],
+                              [-1, 1], shape=(n_times, n_times), dtype=bool)
+    full = sparse.kron(adjacency, sparse.eye(n_times, dtype=bool)) + \
+        sparse.kron(sparse.eye(n_channels, dtype=bool), time_chain)
+
+    return full.tocsr()
+
+
+def sign_flips(n_permutations, n_subjects, seed=None):
+    """Draw a matrix of random sign flips, shape (n_permutations, n_subj)."""
+    rng = np.random.default_rng(seed)
+    return rng.choice(np.array([-1., 1.]), size=(n_permutations, n_subjects))
+
+
+def one_sample_t(signs, data, sum_sq=None):
+    """Compute one-sample t-values for a batch of sign flips.
+
+    Parameters
+    ----------
+    signs : ndarray, shape (n_batch, n_subjects)
+        Sign flips (one row per permutation).
+    data : ndarray, shape (n_subjects, n_features)
+        The data to test against zero.
+    sum_sq : ndarray, shape (n_features,) | None
+        Sum of squares of `data` over subjects. It does not change with the
+        signs, so it can be computed once and reused across batches.
+
+    Returns
+    -------
+    t_values : ndarray, shape (n_batch, n_features)
+    """
+    n_subj = data.shape[0]
+    if sum_sq is None:
+        sum_sq = np.sum(data ** 2, axis=0)
+
+    mean = (signs @ data) / n_subj
+    var = (sum_sq - n_subj * mean ** 2) / (n_subj - 1)
+
+    return mean / np.sqrt(var / n_subj)
+
+
+def find_clusters(t_values, threshold, adjacency, tail=0):
+    """Find clusters of supra-threshold features.
+
+    Parameters
+    ----------
+    t_values : ndarray, shape (n_features,)
+        The statistic for each feature.
+    threshold : float
+        The cluster-forming threshold (positive).
+    adjacency : scipy.sparse.csr_matrix, shape (n_features, n_features)
+        Feature adjacency (see `spatio_temporal_adjacency`).
+    tail : -1 | 0 | 1
+        Whether to look for negative, positive or both kinds of clusters.
+
+    Returns
+    -------
+    clusters : list of ndarray
+        Feature indices belonging to each cluster.
+    masses : ndarray, shape (n_clusters,)
+        Sum of the statistic within each cluster.
+    """
+    from scipy.sparse.csgraph import connected_components
+
+    clusters, masses = [], []
+    signs = {-1: [-1], 0: [1, -1], 1: [1]}[tail]
+
+    for sign in signs:
+        idx = np.flatnonzero(sign * t_values > threshold)
+        if idx.size == 0:
+            continue
+
+        n_comp, labels = connected_components(adjacency[idx][:, idx],
+                                              directed=False)
+        order = np.argsort(labels, kind='stable')
+        splits = np.flatnonzero(np.diff(labels[order])) + 1
+        clusters.extend(np.split(idx[order], splits))
+        masses.append(np.bincount(labels, weights=t_values[idx],
+                                  minlength=n_comp))
+
+    masses = np.concatenate(masses) if masses else np.zeros(0)
+
+    return clusters, masses
+
+
+def _max_masses(signs, data, sum_sq, threshold, adjacency, tail,
+                batch_size):
+    """Maximum (absolute) cluster mass for each sign flip."""
+    h0 = np.zeros(signs.shape[0])
+    for start in range(0, signs.shape[0], batch_size):
+        t_batch = one_sample_t(signs[start:start + batch_size], data, sum_sq)
+        for i, t_values in enumerate(t_batch):
+            _, masses = find_clusters(t_values, threshold, adjacency, tail)
+            if masses.size:
+                h0[start + i] = np.max(np.abs(masses))
+
+    return h0
+
+
+def _init_worker(data, threshold, adjacency, tail, batch_size):
+    _worker.update(data=data, sum_sq=np.sum(data ** 2, axis=0),
+                   threshold=threshold, adjacency=adjacency, tail=tail,
+                   batch_size=batch_size)
+
+
+def _run_worker(signs):
+    return _max_masses(signs, _worker['data'], _worker['sum_sq'],
+                       _worker['threshold'], _worker['adjacency'],
+                       _worker['tail'], _worker['batch_size'])
+
+
+def permutation_cluster_test(data, adjacency, threshold=None, p=0.05,
+                             tail=0, n_permutations=10000, seed=42,
+                             n_jobs=1, batch_size=128):
+    """Cluster-based permutation test of data against zero.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_subjects, n_channels, n_times)
+        The data (e.g., difference waves) of each subject.
+    adjacency : scipy.sparse matrix, shape (n_channels, n_channels)
+        The channel adjacency (see `montage_adjacency`).
+    threshold : float | None
+        The cluster-forming t-value. If None, it is derived from `p`.
+    p : float
+        Two-sided p-value used to derive the threshold.
+    tail : -1 | 0 | 1
+        Test for negative, positive or both kinds of effects.
+    n_permutations : int
+        Number of sign-flip permutations.
+    seed : int | None
+        Seed used to draw the sign flips.
+    n_jobs : int
+        Number of worker processes used to evaluate the permutations.
+    batch_size : int
+        Number of permutations for which the t-values are computed at once.
+
+    Returns
+    -------
+    t_obs : ndarray, shape (n_channels, n_times)
+        The observed t-values.
+    clusters : list of ndarray of bool, shape (n_channels, n_times)
+        Mask of the features in each observed cluster.
+    cluster_pv : ndarray, shape (n_clusters,)
+        Permutation p-value of each cluster.
+    h0 : ndarray, shape (n_permutations,)
+        Maximum absolute cluster mass of each permutation.
+    """
+    from scipy import stats
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim != 3:
+        raise ValueError('data must be of shape (n_subjects, n_channels, '
+                         'n_times), got %s' % (data.shape,))
+    n_subj, n_channels, n_times = data.shape
+    if adjacency.shape != (n_channels, n_channels):
+        raise ValueError('adjacency must be of shape (%s, %s)'
+                         % (n_channels, n_channels))
+    if threshold is None:
+        threshold = stats.t.ppf(1 - p / 2., n_subj - 1)
+
+    data = data.reshape(n_subj, n_channels * n_times)
+    adjacency = spatio_temporal_adjacency(adjacency, n_times)
+
+    # observed statistic and clusters
+    t_obs = one_sample_t(np.ones((1, n_subj)), data)[0]
+    clusters, masses = find_clusters(t_obs, threshold, adjacency, tail)
+
+    # null distribution of the maximum cluster mass
+    signs = sign_flips(n_permutations, n_subj, seed)
+    if n_jobs == 1:
+        h0 = _max_masses(signs, data, np.sum(data ** 2, axis=0), threshold,
+                         adjacency, tail, batch_size)
+    else:
+        chunks = np.array_split(signs, min(n_permutations, n_jobs * 4))
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=mp_context(),
+                                 initializer=_init_worker,
+                                 initargs=(data, threshold, adjacency, tail,
+                                           batch_size)) as pool:
+            h0 = np.concatenate(list(pool.map(_run_worker, chunks)))
+
+    cluster_pv = (np.sum(h0[:, np.newaxis] >= np.abs(masses), axis=0) + 1) \
+        / (n_permutations + 1.)
+
+    masks = []
+    for cluster in clusters:
+        mask = np.zeros(n_channels * n_times, dtype=bool)
+        mask[cluster] = True
+        masks.append(mask.reshape(n_channels, n_times))
+
+    return t_obs.reshape(n_channels, n_times), masks, cluster_pv, h0
@@ -0,0 +1,137 @@
+"""
+========================================
+Bitmap index of the experimental factors
+========================================
+
+A bitmap (a packed bit array with one bit per trial) for each level of
+each experimental factor (e.g., the metadata columns 'block' and
+'reaction', and the event name), built once per subject. The trials of any
+combination of factor levels are then found by a bitwise AND of the level
+bitmaps, without querying the metadata or copying the epochs, e.g.:
+
+    >>> index = condition_index(epochs)
+    >>> trials = index.select(block=1, event='incorrect_incongruent')
+    >>> data = epochs[trials].get_data()
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import numpy as np
+
+
+def _to_python(value):
+    """Numpy scalars as Python scalars (so that 1 and np.int8(1) match)."""
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ConditionIndex(object):
+    """Bitmaps of the trials at each level of the experimental factors.
+
+    Parameters
+    ----------
+    factors : dict
+        The value of each factor (e.g., 'block' or 'event') for each trial,
+        as a sequence of length n_trials.
+    """
+
+    def __init__(self, factors):
+        lengths = {len(values) for values in factors.values()}
+        if len(lengths) > 1:
+            raise ValueError('All factors must have a value for each trial')
+        self.n_trials = lengths.pop() if lengths else 0
+
+        self.bitmaps = dict()
+        for factor, values in factors.items():
+            # level of each trial as an integer code
+            codes = dict()
+            inverse = np.array([codes.setdefault(_to_python(value),
+                                                 len(codes))
+                                for value in values], dtype=int)
+            self.bitmaps[factor] = {level: np.packbits(inverse == code)
+                                    for level, code in codes.items()}
+
+    @property
+    def factors(self):
+        return list(self.bitmaps)
+
+    def levels(self, factor):
+        """The levels of a factor (in order of first occurrence)."""
+        return list(self._bitmaps(factor))
+
+    def _bitmaps(self, factor):
+        if factor not in self.bitmaps:
+            raise ValueError('No factor %r, the factors are %s'
+                             % (factor, ', '.join(self.bitmaps)))
+        return self.bitmaps[factor]
+
+    def bitmap(self, **levels):
+        """The packed bitmap of the trials of a combination of levels.
+
+        Parameters
+        ----------
+        **levels
+            The level of each factor, e.g., ``block=1,
+            event='incorrect_incongruent'``. A list of levels selects the
+            trials at any of them (e.g., ``block=[2, 3]``).
+
+        Returns
+        -------
+        bitmap : ndarray of uint8
+            The trials as bits (see `numpy.packbits`).
+        """
+        selected = np.full((self.n_trials + 7) // 8, 0xFF, dtype=np.uint8)
+        empty = np.zeros_like(selected)
+        for factor, level in levels.items():
+            bitmaps = self._bitmaps(factor)
+            if isinstance(level, (list, tuple, set)):
+                bitmap = empty
+                for value in level:
+                    bitmap = bitmap | bitmaps.get(value, empty)
+            else:
+                bitmap = bitmaps.get(level, empty)
+            selected &= bitmap
+
+        return selected
+
+    def mask(self, **levels):
+        """Boolean mask of the trials of a combination of levels."""
+        return np.unpackbits(self.bitmap(**levels),
+                             count=self.n_trials).astype(bool)
+
+    def select(self, **levels):
+        """Indices of the trials of a combination of levels (see `bitmap`).
+        """
+        return np.flatnonzero(np.unpackbits(self.bitmap(**levels),
+                                            count=self.n_trials))
+
+    def count(self, **levels):
+        """Number of trials of a combination of levels."""
+        return int(np.unpackbits(self.bitmap(**levels),
+                                 count=self.n_trials).sum())
+
+
+def condition_index(epochs, factors=None):
+    """Index the trials of epochs by metadata columns and event names.
+
+    Parameters
+    ----------
+    epochs : instance of Epochs
+        The epochs.
+    factors : list of str | None
+        The metadata columns to index (all columns if None). The event
+        names are indexed as the factor 'event'.
+
+    Returns
+    -------
+    index : instance of ConditionIndex
+        The index.
+    """
+    names = {code: name for name, code in epochs.event_id.items()}
+    columns = dict()
+    if epochs.metadata is not None:
+        for factor in (factors or epochs.metadata.columns):
+            columns[factor] = epochs.metadata[factor].to_numpy()
+    columns['event'] = [names[code] for code in epochs.events[:, 2]]
+
+    return ConditionIndex(columns)
@@ -17,9 +17,9 @@ import argparse
 
 import multiprocessing
 
-from utils import FileNames
+from functools import lru_cache
 
-from mne.channels import make_standard_montage
+from utils import FileNames
 
 
 ###############################################################################
@@ -66,6 +66,10 @@ else:
     data_dir = '../data'
     n_jobs = 1
 
+# The data location can be overridden from the environment, e.g., to run the
+# pipeline on a synthetic data set (see make_synthetic_dataset.py)
+data_dir = os.environ.get('ERNSOC_DATA_DIR', data_dir)
+
 # For BLAS to use the right amount of cores
 use_cores = multiprocessing.cpu_count()//2
 if use_cores < 2:
@@ -78,13 +82,68 @@ sample_rate = 256.  # Hz
 task_name = 'ernsoc'
 task_description = 'effects of social interaction on neural correlates of ' \
                    'error processing in the flanker task'
-# eeg channel names and locations
-montage = make_standard_montage(kind='standard_1020')
+# eeg channel names and locations (`montage`, built on first access, see
+# get_montage below)
 # channels to be exclude from import
 exclude = ['EXG4', 'EXG5', 'EXG6', 'EXG7', 'EXG8']
-
-# subjects to use for analysis
+# time windows (in seconds, relative to the response) and polarity of the
+# response-locked ERP components of interest
+erp_windows = {'ern': (0.0, 0.1, 'negative'),
+               'pe': (0.2, 0.4, 'positive')}
+# pre-response baseline
+baseline = (-0.8, -0.5)
+# channels used for single-trial features
+feature_channels = ['Fz', 'FCz', 'Cz']
+# maximum size of the report figure cache (in bytes)
+figure_cache_size = 500e6
+# group-level scripts read the epochs of the next subjects in the background
+# while the current one is processed: how many subjects ahead, and the
+# maximum memory of the epochs in flight (in bytes)
+prefetch_subjects = 2
+prefetch_max_bytes = 4e9
+# write-ahead logging for the quality-control index (see qc.py), only if the
+# derivatives are on a local disk (not on NFS or SMB)
+qc_wal = False
+# epoch rejection (see bads.find_bad_epochs): a channel is bad in a trial if
+# its peak-to-peak amplitude (in V), its largest step between consecutive
+# samples (in V, at the sampling rate of the decimated epochs, about 128 Hz;
+# clean EEG changes far less than 50 uV within 8 ms) or the robust z-score
+# of either (across the trials of the channel, high values only) is above
+# threshold. Trials with up to `reject_max_interpolate` bad channels are
+# interpolated, trials with more are dropped. The z-scores of clean data have
+# a heavy upper tail: on Gaussian noise (400 trials of 64 channels) a
+# threshold of 5 flags about 1 in 1,100 channel-trials, one of 7 about 1 in
+# 34,000.
+reject_ptp = 150e-6
+reject_gradient = 50e-6
+reject_z = 7.
+reject_max_interpolate = 4
+# time-frequency analysis (see tfr.py): frequencies (in Hz), number of cycles
+# of the Morlet wavelets (half the frequency), decimation of the time points,
+# and the memory used for the convolution of one chunk of trials (in bytes)
+tfr_freqs = [float(freq) for freq in range(4, 31)]
+tfr_n_cycles = [freq / 2. for freq in tfr_freqs]
+tfr_decim = 2
+tfr_max_bytes = 256e6
+
+
+def parse_subjects(spec):
+    """Parse a list of subjects such as '2,35,36' or '1-120'."""
+    subjects = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            subjects.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            subjects.append(int(part))
+    return subjects
+
+
+# subjects to use for analysis (can be overridden from the environment,
+# e.g., ERNSOC_SUBJECTS=1-120)
 subjects = [2, 35, 36]
+if 'ERNSOC_SUBJECTS' in os.environ:
+    subjects = parse_subjects(os.environ['ERNSOC_SUBJECTS'])
 
 # relevant events in the paradigm
 event_ids = {'flanker_onset': 71,
@@ -135,6 +194,14 @@ fname.add('bids_data', '{data_dir}/sub-{subject:03d}')
 fname.add('derivatives_dir', '{data_dir}/derivatives')
 # path for reports on processing steps
 fname.add('reports_dir', '{derivatives_dir}/reports')
+# rendered report figures, reused while their input does not change
+fname.add('figure_cache', '{reports_dir}/figure_cache')
+# log of the runtime profile of each processing step
+fname.add('profile_log', '{derivatives_dir}/profile.jsonl')
+# quality-control records of all subjects and processing steps
+fname.add('qc_index', '{derivatives_dir}/qc.sqlite')
+# intermediate results of interrupted steps
+fname.add('checkpoints', '{derivatives_dir}/checkpoints')
 # path for results and figures
 fname.add('results', '{derivatives_dir}/results')
 fname.add('figures', '{results}/figures')
@@ -154,9 +221,10 @@ fname.add('source',
 
 
 # create path for files that are produced in each analysis step
+# (resolving a path has no side effects, output directories are created with
+# make_output_dirs before a step writes its files)
 def output_path(path, processing_step, subject, file_type):
     path = op.join(path.derivatives_dir, processing_step, 'sub-%03d' % subject)
-    os.makedirs(path, exist_ok=True)
     return op.join(path, 'sub-%03d-%s-%s' % (subject, processing_step, file_type))  # noqa: E501
 
 
@@ -164,6 +232,33 @@ def output_path(path, processing_step, subject, file_type):
 fname.add('output', output_path)
 
 
+def output_dirs(processing_step, subjects):
+    """The output directories of a processing step (sorted list of str)."""
+    return sorted({op.dirname(fname.output(processing_step=processing_step,
+                                           subject=subject,
+                                           file_type=''))
+                   for subject in subjects})
+
+
+def make_output_dirs(processing_step, subjects):
+    """Create the output directories of a processing step in one pass.
+
+    The directories of all subjects are created by the `output_dirs` task
+    of dodo.py. The scripts call this again for their own subject, which
+    only checks that the directory exists (e.g., when a script is run on
+    its own).
+
+    Parameters
+    ----------
+    processing_step : str
+        The processing step (e.g., 'repair_bads').
+    subjects : list of int
+        The subjects the step is about to process.
+    """
+    for path in output_dirs(processing_step, subjects):
+        os.makedirs(path, exist_ok=True)
+
+
 # create path for files that are produced by mne.report()
 def report_path(path, subject):
     h5_path = op.join(path.reports_dir, 'sub-%03d.h5' % subject)
@@ -176,3 +271,20 @@ fname.add('report', report_path)
 
 # path for file produced by check_system.py
 fname.add('system_check', './system_check.txt')
+
+
+###############################################################################
+# Objects that are expensive to build are created on first access. This keeps
+# importing config (e.g., by dodo.py) fast.
+@lru_cache(maxsize=None)
+def get_montage():
+    """Get the standard 10-20 montage (built once and cached)."""
+    from mne.channels import make_standard_montage
+    return make_standard_montage(kind='standard_1020')
+
+
+def __getattr__(name):
+    # supports `from config import montage`
+    if name == 'montage':
+        return get_montage()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -7,7 +7,11 @@ Notes
 -----
 - for more on doit: http://pydoit.org
 """
-from config import fname, subjects
+from config import fname, subjects, make_output_dirs, output_dirs
+from qc import StepDone, excluded_subjects
+
+# subjects marked as 'excluded' in the quality-control index are skipped
+subjects = sorted(set(subjects) - excluded_subjects(fname.qc_index))
 
 # Configuration for the "doit" tool.
 DOIT_CONFIG = dict(
@@ -30,6 +34,24 @@ def task_check():
     )
 
 
+def task_output_dirs():
+    """Create the output directories of all steps and subjects."""
+    # Once for the whole cohort, rather than by each script for its subject
+    # (the scripts only create a directory if it is missing, e.g., when they
+    # are run on their own).
+    steps = ['raw_files', 'repair_bads', 'fit_ica', 'repaired_with_ica',
+             'reaction_epochs', 'time_frequency']
+    return dict(
+        actions=[(make_output_dirs, [step, subjects]) for step in steps],
+
+        # The directories; the task only runs again if one of them is
+        # missing (e.g., for a new subject)
+        targets=[path for step in steps
+                 for path in output_dirs(step, subjects)],
+        uptodate=[True]
+    )
+
+
 # This task executes a single analysis script for each subject, giving
 # the subject as a command line parameter to the script.
 def task_eeg_to_bids():
@@ -37,8 +59,8 @@ def task_eeg_to_bids():
     # Run the script for each subject in a sub-task.
     for subject in subjects:
         yield dict(
-            # This task should come after `task_check`
-            task_dep=['check'],
+            # This task should come after `task_check` and `output_dirs`
+            task_dep=['check', 'output_dirs'],
 
             # A name for the sub-task: set to the name of the subject
             name=subject,
@@ -56,7 +78,11 @@ def task_eeg_to_bids():
 
             # How the script needs to be called. Here we indicate it should
             # have one command line parameter: the name of the subject.
-            actions=['python 00_eeg_to_bids.py %s' % subject]
+            actions=['python 00_eeg_to_bids.py %s' % subject],
+
+            # Re-run if the step has not marked the subject as done in the
+            # quality-control index (e.g., after `python qc.py requeue`)
+            uptodate=[StepDone(fname.qc_index, 'eeg_to_bids', subject)]
         )
 
 
@@ -82,7 +108,11 @@ def task_repair_bad_channels():
 
             # How the script needs to be called. Here we indicate it should
             # have one command line parameter: the name of the subject.
-            actions=['python 01_artefact_detection.py %s' % subject]
+            actions=['python 01_artefact_detection.py %s' % subject],
+
+            # Re-run if the step has not marked the subject as done in the
+            # quality-control index (e.g., after `python qc.py requeue`)
+            uptodate=[StepDone(fname.qc_index, 'repair_bads', subject)]
         )
 
 
@@ -110,7 +140,11 @@ def task_fit_ica():
 
             # How the script needs to be called. Here we indicate it should
             # have one command line parameter: the name of the subject.
-            actions=['python 02_fit_ica.py %s' % subject]
+            actions=['python 02_fit_ica.py %s' % subject],
+
+            # Re-run if the step has not marked the subject as done in the
+            # quality-control index (e.g., after `python qc.py requeue`)
+            uptodate=[StepDone(fname.qc_index, 'fit_ica', subject)]
         )
 
 
@@ -138,7 +172,11 @@ def task_repair_eeg_artefacts():
 
             # How the script needs to be called. Here we indicate it should
             # have one command line parameter: the name of the subject.
-            actions=['python 03_repair_eeg_artefacts.py %s' % subject]
+            actions=['python 03_repair_eeg_artefacts.py %s' % subject],
+
+            # Re-run if the step has not marked the subject as done in the
+            # quality-control index (e.g., after `python qc.py requeue`)
+            uptodate=[StepDone(fname.qc_index, 'repaired_with_ica', subject)]
         )
 
 
@@ -163,11 +201,82 @@ def task_extract_epochs():
             # The files produced by the script
             targets=[fname.output(processing_step='reaction_epochs',
                                   subject=subject,
-                                  file_type='epo.fif')],
+                                  file_type='epo.fif'),
+                     fname.output(processing_step='reaction_epochs',
+                                  subject=subject,
+                                  file_type='epo.npy'),
+                     fname.output(processing_step='reaction_epochs',
+                                  subject=subject,
+                                  file_type='quality.npz')],
+
+            # How the script needs to be called. Here we indicate it should
+            # have one command line parameter: the name of the subject.
+            actions=['python 04_extract_epochs.py %s' % subject],
+
+            # Re-run if the step has not marked the subject as done in the
+            # quality-control index (e.g., after `python qc.py requeue`)
+            uptodate=[StepDone(fname.qc_index, 'reaction_epochs', subject)]
+        )
+
+
+def task_extract_features():
+    """Step 07: Extract single-trial ERP features."""
+    # Run the script for each subject in a sub-task.
+    for subject in subjects:
+        yield dict(
+            # This task should come after `extract_epochs`
+            task_dep=['extract_epochs'],
+
+            # A name for the sub-task: set to the name of the subject
+            name=subject,
+
+            # If any of these files change, the script needs to be re-run. Make
+            # sure that the script itself is part of this list!
+            file_dep=[fname.output(processing_step='reaction_epochs',
+                                   subject=subject,
+                                   file_type='epo.fif'),
+                      '07_extract_features.py'],
+
+            # The files produced by the script
+            targets=[fname.dataframes +
+                     '/features_sub-%s.tsv' % str(subject).rjust(3, '0')],
+
+            # How the script needs to be called. Here we indicate it should
+            # have one command line parameter: the name of the subject.
+            actions=['python 07_extract_features.py %s' % subject]
+        )
+
+
+def task_time_frequency():
+    """Step 08: Compute power and ITC of the reaction epochs."""
+    # Run the script for each subject in a sub-task (subjects are run in
+    # parallel with, e.g., `doit -n 4 time_frequency`).
+    for subject in subjects:
+        yield dict(
+            # This task should come after `extract_epochs`
+            task_dep=['extract_epochs'],
+
+            # A name for the sub-task: set to the name of the subject
+            name=subject,
+
+            # If any of these files change, the script needs to be re-run. Make
+            # sure that the script itself is part of this list!
+            file_dep=[fname.output(processing_step='reaction_epochs',
+                                   subject=subject,
+                                   file_type='epo.npy'),
+                      '08_time_frequency.py'],
+
+            # The files produced by the script
+            targets=[fname.output(processing_step='time_frequency',
+                                  subject=subject,
+                                  file_type='tfr.npy'),
+                     fname.output(processing_step='time_frequency',
+                                  subject=subject,
+                                  file_type='tfr_trials.npy')],
 
             # How the script needs to be called. Here we indicate it should
             # have one command line parameter: the name of the subject.
-            actions=['python 04_extract_epochs.py %s' % subject]
+            actions=['python 08_time_frequency.py %s' % subject]
         )
 
 #
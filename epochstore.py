@@ -0,0 +1,225 @@
+"""
+=================================
+Array store of single-trial epochs
+=================================
+
+The data of a subject's epochs as one .npy array (trials x channels x
+times), which can be memory-mapped, with a JSON sidecar holding channels,
+times, events and metadata. Trials are sorted by condition (e.g., by block
+and event), so that the trials of a condition are a contiguous range of
+the array and can be taken without copying. Any other combination of
+metadata columns is found with a bitmap index of the trials (see
+conditions.py):
+
+    >>> write_epoch_store(fname.output(processing_step='reaction_epochs',
+    ...                                subject=2, file_type='epo.npy'),
+    ...                   epochs, sort_by=['block'])
+    >>> store = read_epoch_store(fname.output(...))
+    >>> data = store.get_data(block=1, event='incorrect_incongruent')
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+
+import numpy as np
+
+from conditions import ConditionIndex, _to_python
+from utils import atomic_write
+
+
+def _sidecar(fname):
+    return os.path.splitext(fname)[0] + '.json'
+
+
+def _as_slice(indices):
+    """A slice selecting consecutive indices (else the indices)."""
+    indices = np.asarray(indices, dtype=int)
+    if len(indices) == 0:
+        return slice(0, 0)
+    if np.array_equal(indices, np.arange(indices[0], indices[-1] + 1)):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+class EpochStore(object):
+    """Single-trial data of one subject, sorted by condition.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        The data (e.g., a memory-mapped array).
+    info : dict
+        Channel names and types, sampling frequency, first time point,
+        events, metadata and the trials of each condition (``groups``).
+    """
+
+    def __init__(self, data, info):
+        self.data = data
+        self.info = info
+        self._metadata = None
+        self._index = None
+
+    @property
+    def ch_names(self):
+        return self.info['ch_names']
+
+    @property
+    def times(self):
+        return self.info['tmin'] + \
+            np.arange(self.data.shape[2]) / self.info['sfreq']
+
+    @property
+    def events(self):
+        return np.array(self.info['events'], dtype=int).reshape(-1, 3)
+
+    @property
+    def metadata(self):
+        """Metadata of the (sorted) trials, as a data frame (or None)."""
+        if self._metadata is None and 'metadata' in self.info:
+            import pandas as pd
+            self._metadata = pd.DataFrame(
+                self.info['metadata']['data'],
+                columns=self.info['metadata']['columns'])
+        return self._metadata
+
+    @property
+    def index(self):
+        """Bitmap index of the metadata columns and the event names (see
+        conditions.py), built on first access."""
+        if self._index is None:
+            names = {code: name
+                     for name, code in self.info['event_id'].items()}
+            factors = dict()
+            if 'metadata' in self.info:
+                rows = self.info['metadata']['data']
+                for col, column in enumerate(
+                        self.info['metadata']['columns']):
+                    factors[column] = [row[col] for row in rows]
+            factors['event'] = [names[code] for code in self.events[:, 2]]
+            self._index = ConditionIndex(factors)
+        return self._index
+
+    def trials(self, **keys):
+        """The trials of a condition.
+
+        Parameters
+        ----------
+        **keys
+            Levels of the metadata columns or the event, e.g.,
+            ``event='correct_incongruent'`` or ``block=1,
+            reaction='incorrect'`` (see `ConditionIndex.bitmap`).
+
+        Returns
+        -------
+        trials : slice | ndarray of int
+            A slice if the trials are contiguous (e.g., if the condition is
+            given by the first sort keys), else their indices.
+        """
+        return _as_slice(self.index.select(**keys))
+
+    def picks(self, picks=None):
+        """Channel selection as a slice (if contiguous), indices or int."""
+        if picks is None:
+            return slice(None)
+        if isinstance(picks, str):
+            return self.ch_names.index(picks)
+        return _as_slice([self.ch_names.index(ch) for ch in picks])
+
+    def get_data(self, picks=None, **keys):
+        """The data of a condition and channels.
+
+        Parameters
+        ----------
+        picks : str | list of str | None
+            Channel name(s) (all channels if None). A single name drops the
+            channel axis.
+        **keys
+            The condition (see `trials`).
+
+        Returns
+        -------
+        data : ndarray, shape (n_trials, n_channels, n_times)
+            A view of the stored data if the trials (and channels) are
+            contiguous, else a copy.
+        """
+        trials = self.trials(**keys) if keys else slice(None)
+        channels = self.picks(picks)
+        if isinstance(trials, slice) or isinstance(channels, (slice, int)):
+            return self.data[trials][:, channels]
+        return self.data[np.ix_(trials, channels)]
+
+
+def write_epoch_store(fname, epochs, sort_by=(), dtype=np.float32):
+    """Store the data of epochs, sorted by condition.
+
+    Parameters
+    ----------
+    fname : str
+        The .npy file (the sidecar is stored next to it as .json).
+    epochs : instance of Epochs
+        The (preloaded) epochs.
+    sort_by : list of str
+        Metadata columns to sort the trials by, before the event (stored as
+        the sort key 'event').
+    dtype : dtype
+        Data type of the stored data (FIF files store single precision).
+    """
+    sort_by = list(sort_by)
+    names = {code: name for name, code in epochs.event_id.items()}
+    keys = [list(epochs.metadata[col]) for col in sort_by] \
+        if sort_by else []
+    keys.append([names[code] for code in epochs.events[:, 2]])
+
+    # stable sort, trials keep their order within a condition
+    order = sorted(range(len(epochs)),
+                   key=lambda idx: tuple(key[idx] for key in keys))
+
+    groups = []
+    for pos, idx in enumerate(order):
+        values = [_to_python(key[idx]) for key in keys]
+        if not groups or groups[-1]['values'] != values:
+            groups.append(dict(values=values, start=pos, stop=pos + 1))
+        else:
+            groups[-1]['stop'] = pos + 1
+
+    info = dict(ch_names=epochs.ch_names,
+                ch_types=epochs.get_channel_types(),
+                sfreq=float(epochs.info['sfreq']),
+                tmin=float(epochs.times[0]),
+                event_id={name: int(code)
+                          for name, code in epochs.event_id.items()},
+                events=epochs.events[order].tolist(),
+                order=[int(idx) for idx in order],
+                sort_by=sort_by + ['event'],
+                groups=[dict(zip(sort_by + ['event'], group['values']),
+                             start=group['start'], stop=group['stop'])
+                        for group in groups])
+    if epochs.metadata is not None:
+        metadata = epochs.metadata.iloc[order]
+        info['metadata'] = json.loads(metadata.to_json(orient='split',
+                                                       index=False,
+                                                       double_precision=15))
+
+    # written condition by condition, not holding a sorted copy of the data
+    shape = (len(epochs), len(epochs.ch_names), len(epochs.times))
+    with atomic_write(fname) as tmp:
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype,
+                                         shape=shape)
+        for group in groups:
+            data[group['start']:group['stop']] = \
+                epochs[order[group['start']:group['stop']]].get_data()
+        data.flush()
+        del data
+    with atomic_write(_sidecar(fname)) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+
+
+def read_epoch_store(fname, mmap_mode='r'):
+    """Read stored epochs (memory-mapped by default)."""
+    with open(_sidecar(fname)) as f:
+        info = json.load(f)
+    return EpochStore(np.load(fname, mmap_mode=mmap_mode), info)
@@ -0,0 +1,209 @@
+"""
+============================
+Cache figures of the reports
+============================
+
+Rendered report figures are stored as image files, keyed by a hash of the
+data and parameters they show, so that rerunning a step only renders the
+figures whose input changed, e.g.:
+
+    >>> figures = FigureCache(fname.figure_cache)
+    >>> image = figures.get('z_scores',
+    ...                     lambda: plot_z_scores(z_scores, channels),
+    ...                     z_scores, channels=channels)
+    >>> report.add_images_to_section(image, captions='Robust Z-Scores')
+
+The cache is bounded in size; when it grows beyond `max_bytes`, the least
+recently used images are removed (but not images used in the last
+`grace_period` seconds, which another process may just have been given).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from utils import atomic_write
+
+
+def _update(h, obj):
+    """Feed an array, string, number or list of them to a hash."""
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        obj = np.ascontiguousarray(obj)
+        h.update(('%s%s' % (obj.dtype.str, obj.shape)).encode())
+        h.update(memoryview(obj).cast('B'))
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        h.update(b'[')
+        for item in obj:
+            _update(h, item)
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode())
+    h.update(b'|')
+
+
+def digest(*inputs, **params):
+    """Hash arrays, strings, numbers (and lists of them) and parameters.
+
+    Arrays are hashed by dtype, shape and content. The digest of large
+    inputs can be computed once and passed on as a string.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for obj in inputs:
+        _update(h, obj)
+    for name in sorted(params):
+        _update(h, name)
+        _update(h, params[name])
+
+    return h.hexdigest()
+
+
+def digest_raw(raw, chunk_duration=60.):
+    """Hash the data, channels, annotations and projectors of a recording.
+
+    The data is read in chunks of `chunk_duration` seconds, so that
+    recordings that are not preloaded are hashed without loading them
+    entirely.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for obj in (raw.ch_names, raw.get_channel_types(), raw.info['sfreq'],
+                raw.first_samp, sorted(raw.info['bads']),
+                raw.annotations.onset, raw.annotations.duration,
+                list(raw.annotations.description),
+                [proj['data']['data'] for proj in raw.info['projs']]):
+        _update(h, obj)
+
+    chunk = max(int(chunk_duration * raw.info['sfreq']), 1)
+    for start in range(0, raw.n_times, chunk):
+        _update(h, raw.get_data(start=start, stop=start + chunk))
+
+    return h.hexdigest()
+
+
+def digest_file(fname, chunk_size=2 ** 20):
+    """Hash the content of a file, read in chunks of `chunk_size` bytes."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class FigureCache(object):
+    """Cache of rendered figures.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory the images are stored in.
+    max_bytes : float
+        Maximum size of the cache (in bytes).
+    image_format : 'png' | 'svg'
+        Format of the stored images.
+    dpi : int | None
+        Resolution of the stored images (None uses the figure's dpi).
+    grace_period : float
+        Images used within this many seconds are not removed, even if the
+        cache is larger than `max_bytes` (e.g., so that an image returned
+        to another process is still there when it is added to a report).
+    """
+
+    def __init__(self, cache_dir, max_bytes=500e6, image_format='png',
+                 dpi=None, grace_period=600.):
+        import matplotlib
+        import mne
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.image_format = image_format
+        self.dpi = dpi
+        self.grace_period = grace_period
+        self.hits = 0
+        self.misses = 0
+        # figures rendered by other versions of the libraries are not reused
+        self._salt = (matplotlib.__version__, mne.__version__, image_format,
+                      dpi)
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        """Image file for a key."""
+        return os.path.join(self.cache_dir,
+                            '%s.%s' % (key, self.image_format))
+
+    def get(self, name, render, *inputs, **params):
+        """Get the image of a figure, rendering it if it is not cached.
+
+        Parameters
+        ----------
+        name : str
+            Name of the figure (e.g., 'z_scores').
+        render : callable
+            Creates the figure (an instance of matplotlib Figure) when
+            called without arguments.
+        *inputs
+            The data shown in the figure (arrays, strings, numbers or their
+            digest).
+        **params
+            The plotting parameters.
+
+        Returns
+        -------
+        fname : str
+            The image file.
+        """
+        fname = self.path(digest(name, self._salt, *inputs, **params))
+
+        if os.path.exists(fname):
+            try:
+                # mark as recently used (i.e., protect it from eviction)
+                os.utime(fname)
+            except OSError:  # just removed by another process
+                pass
+            else:
+                self.hits += 1
+                return fname
+
+        self.misses += 1
+        fig = render()
+        try:
+            with atomic_write(fname, manifest=False) as tmp:
+                fig.savefig(tmp, format=self.image_format, dpi=self.dpi)
+        finally:
+            import matplotlib.pyplot as plt
+            plt.close(fig)
+
+        self.evict()
+
+        return fname
+
+    def evict(self):
+        """Remove the least recently used images beyond `max_bytes`.
+
+        Images used within the last `grace_period` seconds are kept.
+        """
+        import time
+
+        recent = time.time() - self.grace_period
+        files = []
+        for fname in glob.glob(os.path.join(self.cache_dir, '*.*')):
+            try:
+                stat = os.stat(fname)
+            except OSError:  # removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, fname))
+
+        total = sum(size for _, size, _ in files)
+        for mtime, size, fname in sorted(files):
+            if total <= self.max_bytes or mtime > recent:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
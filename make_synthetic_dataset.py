@@ -0,0 +1,175 @@
+"""
+==========================
+Create a synthetic dataset
+==========================
+
+Writes simulated recordings of the flanker task (see simulation.py) and
+demographics for a number of subjects to the paths the pipeline expects
+(``fname.source``), so that the pipeline can be run end to end, e.g., to
+measure its throughput and memory use with many subjects:
+
+    export ERNSOC_DATA_DIR=/tmp/ernsoc_synthetic ERNSOC_SUBJECTS=1-120
+    python make_synthetic_dataset.py --n-trials 248 --n-jobs 4
+    doit
+
+The Status channel follows the trigger sequence of the task: flanker onset
+(71), target (11, 12, 21, 22) and response (101, 102 correct, 201, 202
+incorrect), with an end of block marker (245) after the practice block and
+after each block of 400 trials. Error trials carry an ERN and a Pe, correct
+trials a smaller CRN.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import argparse
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from os import path as op
+
+import numpy as np
+import pandas as pd
+
+# All parameters are defined in config.py
+from config import fname, subjects, LoggingFormat
+from simulation import simulate_raw, add_evoked, write_bdf
+from utils import mp_context
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('--n-trials', type=int, default=1248,
+                    help='Number of trials per subject (48 practice trials '
+                         'followed by blocks of 400).')
+parser.add_argument('--sfreq', type=float, default=256.,
+                    help='Sampling frequency of the recordings.')
+parser.add_argument('--n-channels', type=int, default=64,
+                    choices=[16, 32, 64],
+                    help='Number of EEG channels (BioSemi cap layout).')
+parser.add_argument('--error-rate', type=float, default=0.15,
+                    help='Proportion of incorrect responses.')
+parser.add_argument('--seed', type=int, default=42,
+                    help='Seed of the random number generator.')
+parser.add_argument('--n-jobs', type=int, default=1,
+                    help='Number of subjects simulated in parallel.')
+
+# target codes, the second digit gives the direction of the flankers
+# (1: left, 2: right); the correct button is the direction of the target
+targets = {11: 101,  # congruent, left
+           12: 102,  # congruent, right
+           21: 102,  # incongruent, flankers left
+           22: 101}  # incongruent, flankers right
+incorrect = {101: 202, 102: 201}
+
+# block structure of the task (in trials)
+block_ends = [48, 448, 848, 1248]
+
+
+def task_events(n_trials, sfreq, error_rate, rng, soa=0.1,
+                break_duration=10.):
+    """Simulate the trigger sequence of the flanker task.
+
+    Returns
+    -------
+    events : ndarray, shape (n_events, 3)
+        The events (sample, 0, code).
+    duration : float
+        Length of the recording (in seconds).
+    """
+    events = []
+    t = 2.
+    for trial in range(n_trials):
+        target = rng.choice(list(targets))
+        # errors are more frequent in incongruent trials
+        congruent = target < 20
+        p_error = error_rate * (0.4 if congruent else 1.6)
+        outcome = rng.choice(['correct', 'incorrect', 'missed', 'too_soon'],
+                             p=[1 - p_error - 0.02, p_error, 0.01, 0.01])
+
+        events.append((t, 71))
+        if outcome == 'too_soon':
+            events.append((t + soa / 2, targets[target]))
+            events.append((t + soa, target))
+            t += soa + 1.
+        elif outcome == 'missed':
+            events.append((t + soa, target))
+            t += soa + 1.5
+        else:
+            # incorrect responses are faster
+            rt = rng.lognormal(np.log(0.33 if outcome == 'incorrect'
+                                      else 0.42), 0.2)
+            button = targets[target] if outcome == 'correct' \
+                else incorrect[targets[target]]
+            events.append((t + soa, target))
+            events.append((t + soa + rt, button))
+            t += soa + rt
+        # inter-trial interval
+        t += rng.uniform(0.8, 1.2)
+
+        if trial + 1 in block_ends or trial + 1 == n_trials:
+            events.append((t, 245))
+            t += break_duration
+
+    events = np.array([(int(round(onset * sfreq)), 0, code)
+                       for onset, code in events])
+
+    return events, t + 2.
+
+
+def response_waveforms(sfreq):
+    """ERN / CRN and Pe time courses at FCz (starting at the response)."""
+    times = np.arange(0., 0.6, 1. / sfreq)
+
+    def peak(latency, width, amplitude):
+        return amplitude * np.exp(-(times - latency) ** 2 / (2 * width ** 2))
+
+    return dict(incorrect=peak(0.05, 0.025, -8e-6) + peak(0.3, 0.08, 6e-6),
+                correct=peak(0.05, 0.025, -2e-6))
+
+
+def simulate_subject(subject, args):
+    """Simulate and write the recording and demographics of a subject."""
+    rng = np.random.default_rng([args.seed, subject])
+    sfreq = args.sfreq
+
+    events, duration = task_events(args.n_trials, sfreq, args.error_rate,
+                                   rng)
+    raw = simulate_raw(duration=duration, sfreq=sfreq, flat=[], noisy=['T8'],
+                       blink_rate=0.1, events=events,
+                       montage='biosemi%d' % args.n_channels,
+                       seed=rng.integers(2 ** 32))
+
+    waveforms = response_waveforms(sfreq)
+    for kind, codes in (('correct', {101, 102}), ('incorrect', {201, 202})):
+        onsets = events[np.isin(events[:, 2], list(codes)), 0]
+        add_evoked(raw, onsets, waveforms[kind], center='FCz')
+
+    eeg_file = fname.source(subject=subject, source_type='eeg')
+    os.makedirs(op.dirname(eeg_file), exist_ok=True)
+    write_bdf(eeg_file, raw)
+
+    demo_file = fname.source(subject=subject, source_type='demographics')
+    os.makedirs(op.dirname(demo_file), exist_ok=True)
+    pd.DataFrame(dict(subject_id=[subject],
+                      age=[int(rng.integers(18, 35))],
+                      sex=[int(rng.integers(1, 3))])).to_csv(demo_file,
+                                                             sep='\t',
+                                                             index=False)
+
+    return subject, duration, op.getsize(eeg_file)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print(LoggingFormat.PURPLE +
+          LoggingFormat.BOLD +
+          'Simulating %d subjects in %s' % (len(subjects), fname.data_dir) +
+          LoggingFormat.END)
+
+    with ProcessPoolExecutor(max_workers=args.n_jobs,
+                             mp_context=mp_context()) as pool:
+        for subject, duration, size in pool.map(simulate_subject, subjects,
+                                                [args] * len(subjects)):
+            print('sub-%03d: %.0f s of data, %.1f MB'
+                  % (subject, duration, size / 1e6))
@@ -0,0 +1,209 @@
+"""
+=====================================
+Multi-resolution overviews of the data
+=====================================
+
+A compact summary of a recording: the minimum, maximum and RMS of each
+channel in time bins of several sizes (e.g., 0.25 s, 1 s, 4 s, ...). The
+summary is stored next to the derivative it describes as a .npy file, which
+can be memory-mapped, and a JSON sidecar describing its layout:
+
+    >>> overview = compute_overview(raw)
+    >>> overview.save(fname.output(processing_step='repair_bads',
+    ...                            subject=2, file_type='overview.npy'))
+    >>> overview = read_overview(fname.output(processing_step='repair_bads',
+    ...                                       subject=2,
+    ...                                       file_type='overview.npy'))
+    >>> times, mins, maxs = overview.envelope(n_bins=1500)
+
+The array has shape (3, n_channels, n_bins), with the statistics (min, max,
+RMS) along the first axis and the bins of all levels, from fine to coarse,
+along the last axis.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+
+import numpy as np
+
+from utils import atomic_write, ssp_projector
+
+# order of the statistics in the array
+stats = ('min', 'max', 'rms')
+
+
+def _sidecar(fname):
+    return os.path.splitext(fname)[0] + '.json'
+
+
+class Overview(object):
+    """Multi-resolution summary of a recording.
+
+    Parameters
+    ----------
+    data : ndarray, shape (3, n_channels, n_bins)
+        Minimum, maximum and RMS of each channel in the bins of all levels.
+    info : dict
+        Layout of the data: channel names and types, sampling frequency,
+        number of samples, and for each level the size of its bins (in
+        samples), its first bin and its number of bins.
+    """
+
+    def __init__(self, data, info):
+        self.data = data
+        self.info = info
+
+    @property
+    def ch_names(self):
+        return self.info['ch_names']
+
+    @property
+    def levels(self):
+        return self.info['levels']
+
+    def level(self, idx):
+        """Bin start times and min, max, RMS of one level.
+
+        Returns
+        -------
+        times : ndarray, shape (n_bins,)
+            Start of each bin (in seconds from the first sample).
+        mins, maxs, rms : ndarray, shape (n_channels, n_bins)
+        """
+        level = self.levels[idx]
+        data = self.data[:, :, level['start']:level['start'] +
+                         level['n_bins']]
+        times = np.arange(level['n_bins']) * level['bin_size'] / \
+            self.info['sfreq']
+        return times, data[0], data[1], data[2]
+
+    def envelope(self, n_bins, picks=None):
+        """Min/max envelope of the recording in (about) `n_bins` bins.
+
+        Uses the coarsest level that still has at least `n_bins` bins (or
+        the finest level) and merges its bins as needed.
+
+        Parameters
+        ----------
+        n_bins : int
+            Number of bins (e.g., the width of a plot in pixels).
+        picks : list of str | None
+            The channels to return (all if None).
+
+        Returns
+        -------
+        times : ndarray, shape (n_bins,)
+            Start of each bin (in seconds from the first sample).
+        mins, maxs : ndarray, shape (n_channels, n_bins)
+        """
+        idx = 0
+        for i, level in enumerate(self.levels):
+            if level['n_bins'] >= n_bins:
+                idx = i
+        times, mins, maxs, _ = self.level(idx)
+
+        if picks is not None:
+            ch_idx = [self.ch_names.index(ch) for ch in picks]
+            mins, maxs = mins[ch_idx], maxs[ch_idx]
+
+        n_level = len(times)
+        n_bins = max(min(int(n_bins), n_level), 1)
+        edges = (np.arange(n_bins) * n_level) // n_bins
+
+        return (times[edges], np.minimum.reduceat(mins, edges, axis=1),
+                np.maximum.reduceat(maxs, edges, axis=1))
+
+    def save(self, fname):
+        """Save the data (.npy) and its layout (.json sidecar)."""
+        with atomic_write(fname) as tmp:
+            np.save(tmp, self.data)
+        with atomic_write(_sidecar(fname)) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.info, f, indent=2)
+
+
+def read_overview(fname, mmap_mode='r'):
+    """Read an overview (memory-mapped by default)."""
+    with open(_sidecar(fname)) as f:
+        info = json.load(f)
+    return Overview(np.load(fname, mmap_mode=mmap_mode), info)
+
+
+def compute_overview(raw, picks=('eeg', 'eog'), bin_duration=0.25, factor=4,
+                     min_bins=100, proj=True, chunk_duration=60.):
+    """Summarise a recording at several time scales.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The recording.
+    picks : list of str
+        Channel types or names to summarise.
+    bin_duration : float
+        Length of the bins of the finest level (in seconds).
+    factor : int
+        Each level merges this many bins of the previous one.
+    min_bins : int
+        No further levels are added once a level has fewer bins.
+    proj : bool
+        Whether to apply the SSP projectors (e.g., the average reference).
+    chunk_duration : float
+        The data is read in chunks of (about) this length (in seconds).
+
+    Returns
+    -------
+    overview : instance of Overview
+    """
+    picks = [picks] if isinstance(picks, str) else list(picks)
+    ch_idx = [idx for idx, (ch, ch_type) in
+              enumerate(zip(raw.ch_names, raw.get_channel_types()))
+              if ch in picks or ch_type in picks]
+    ch_names = [raw.ch_names[idx] for idx in ch_idx]
+    sfreq = raw.info['sfreq']
+    projector = ssp_projector(raw.info, ch_names) if proj else None
+
+    # finest level, computed chunk by chunk (whole bins per chunk)
+    bin_size = max(int(round(bin_duration * sfreq)), 1)
+    chunk = max(int(chunk_duration * sfreq) // bin_size, 1) * bin_size
+    mins, maxs, sum_sq = [], [], []
+    for start in range(0, raw.n_times, chunk):
+        data = raw.get_data(picks=ch_idx, start=start, stop=start + chunk)
+        if projector is not None:
+            data = projector @ data
+        edges = np.arange(0, data.shape[1], bin_size)
+        mins.append(np.minimum.reduceat(data, edges, axis=1))
+        maxs.append(np.maximum.reduceat(data, edges, axis=1))
+        sum_sq.append(np.add.reduceat(data ** 2, edges, axis=1))
+    mins, maxs, sum_sq = [np.concatenate(stat, axis=1)
+                          for stat in (mins, maxs, sum_sq)]
+    counts = np.diff(np.append(np.arange(0, raw.n_times, bin_size),
+                               raw.n_times))
+
+    # coarser levels merge the bins of the previous one
+    levels, blocks, start = [], [], 0
+    while True:
+        levels.append(dict(bin_size=int(bin_size), start=int(start),
+                           n_bins=int(mins.shape[1])))
+        blocks.append(np.stack([mins, maxs, np.sqrt(sum_sq / counts)]))
+        start += mins.shape[1]
+        if mins.shape[1] < min_bins * factor:
+            break
+
+        edges = np.arange(0, mins.shape[1], factor)
+        mins = np.minimum.reduceat(mins, edges, axis=1)
+        maxs = np.maximum.reduceat(maxs, edges, axis=1)
+        sum_sq = np.add.reduceat(sum_sq, edges, axis=1)
+        counts = np.add.reduceat(counts, edges)
+        bin_size *= factor
+
+    info = dict(ch_names=ch_names,
+                ch_types=raw.get_channel_types(picks=ch_idx),
+                sfreq=float(sfreq), n_times=int(raw.n_times),
+                first_time=float(raw.first_time),
+                proj=projector is not None,
+                stats=list(stats), levels=levels)
+
+    return Overview(np.concatenate(blocks, axis=2).astype(np.float32), info)
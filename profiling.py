@@ -0,0 +1,203 @@
+"""
+==================
+Runtime profiling
+==================
+
+Record wall time, CPU time, peak memory and disk I/O of the stages of a
+processing step, e.g.:
+
+    >>> profiler = StepProfiler('repair_bads', subject=2,
+    ...                         log_file=fname.profile_log)
+    >>> with profiler.stage('filter'):
+    ...     raw.filter(l_freq=0.1, h_freq=40.)
+
+Functions decorated with `profiled` are recorded as (nested) stages whenever
+they are called while a profiler stage is active.
+
+Each record is appended as one line of JSON to the log file, and
+`StepProfiler.to_html` summarises the records of a step for the HTML report.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# stack of profilers with an active stage (innermost last)
+_active = []
+
+
+def _peak_rss():
+    """Peak resident set size of the process so far (in MB).
+
+    This is a high-water mark over the lifetime of the process, it only
+    grows, and a stage only raises it if it uses more memory than all
+    earlier stages.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in kilobytes on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def _io_counters():
+    """Bytes read from and written to storage by the process so far."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().split('\n')
+                            if line)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class StepProfiler(object):
+    """Profile the stages of a processing step for one subject.
+
+    Parameters
+    ----------
+    step : str
+        The processing step (e.g., 'repair_bads').
+    subject : int | None
+        The subject that is processed.
+    log_file : str | None
+        JSONL file the records are appended to. If None, records are only
+        kept in memory.
+    """
+
+    def __init__(self, step, subject=None, log_file=None):
+        self.step = step
+        self.subject = subject
+        self.log_file = log_file
+        self.records = []
+        self._stages = []
+
+        if log_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)),
+                        exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """Record a stage of the step.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage. Nested stages are recorded as
+            '<outer>/<inner>'.
+        **extra
+            Additional fields to store with the record (e.g., subject=2 for
+            group-level steps).
+        """
+        self._stages.append(name)
+        _active.append(self)
+
+        read_start, written_start = _io_counters()
+        peak_start = _peak_rss()
+        started = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = dict(step=self.step,
+                          subject=self.subject,
+                          stage='/'.join(self._stages),
+                          started=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                time.localtime(started)),
+                          wall_time=time.perf_counter() - wall_start,
+                          cpu_time=time.process_time() - cpu_start,
+                          peak_rss_mb=_peak_rss())
+            # how much the stage raised the process's peak memory
+            if peak_start is not None:
+                record['peak_rss_increase_mb'] = \
+                    record['peak_rss_mb'] - peak_start
+            read_end, written_end = _io_counters()
+            if read_start is not None and read_end is not None:
+                record.update(bytes_read=read_end - read_start,
+                              bytes_written=written_end - written_start)
+            record.update(extra)
+
+            _active.pop()
+            self._stages.pop()
+            self._log(record)
+
+    def _log(self, record):
+        self.records.append(record)
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        """Totals per stage, in the order the stages first finished."""
+        totals = dict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'],
+                                      dict(calls=0, wall_time=0.,
+                                           cpu_time=0., peak_rss_mb=None,
+                                           peak_rss_increase_mb=None,
+                                           bytes_read=None,
+                                           bytes_written=None))
+            total['calls'] += 1
+            total['wall_time'] += record['wall_time']
+            total['cpu_time'] += record['cpu_time']
+            for key in ('bytes_read', 'bytes_written'):
+                if record.get(key) is not None:
+                    total[key] = (total[key] or 0) + record[key]
+            for key in ('peak_rss_mb', 'peak_rss_increase_mb'):
+                if record.get(key) is not None:
+                    total[key] = max(total[key] or 0, record[key])
+        return totals
+
+    def to_html(self):
+        """Summary table of the recorded stages, e.g., for an MNE report."""
+        def fmt(value, scale=1., pattern='%.1f'):
+            return '-' if value is None else pattern % (value / scale)
+
+        rows = []
+        for stage, total in self.summary().items():
+            rows.append('<tr><td>%s</td><td>%d</td><td>%.2f</td>'
+                        '<td>%.2f</td><td>%s</td><td>%s</td><td>%s</td>'
+                        '<td>%s</td></tr>'
+                        % (stage, total['calls'], total['wall_time'],
+                           total['cpu_time'],
+                           fmt(total['peak_rss_increase_mb']),
+                           fmt(total['peak_rss_mb']),
+                           fmt(total['bytes_read'], 1e6),
+                           fmt(total['bytes_written'], 1e6)))
+
+        return ('<table class="table table-hover">'
+                '<thead><tr><th>Stage</th><th>Calls</th><th>Wall time (s)</th>'
+                '<th>CPU time (s)</th><th>Peak RSS increase (MB)</th>'
+                '<th>Process peak RSS (MB)</th>'
+                '<th>Read (MB)</th><th>Written (MB)</th></tr></thead>'
+                '<tbody>%s</tbody></table>' % ''.join(rows))
+
+
+def profiled(name):
+    """Decorate a function so that its calls are recorded as stages.
+
+    Calls are only recorded when they happen inside an active stage of a
+    `StepProfiler`, otherwise the function runs without overhead.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return func(*args, **kwargs)
+            with _active[-1].stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
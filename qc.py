@@ -0,0 +1,242 @@
+"""
+========================================
+Cohort-level quality-control (QC) index
+========================================
+
+The processing steps write their QC facts (e.g., the bad channels found in
+step 01 or the epochs dropped in step 04) into one SQLite database in the
+derivatives directory, e.g.:
+
+    >>> qc = QCIndex(fname.qc_index)
+    >>> qc.record('repair_bads', subject=2, bad_channels=['T8', 'Oz'],
+    ...           total_time=42.)
+    >>> qc.mark('repair_bads', subject=2)
+
+Values are stored as JSON, so that cohort QC is one query, e.g., subjects
+with more than a minute of annotated data:
+
+    >>> qc.query("SELECT subject, value FROM records "
+    ...          "WHERE step = 'repair_bads' AND name = 'total_time' "
+    ...          "AND CAST(value AS REAL) > 60")
+
+Each step marks a subject as 'done' once it has processed it. The doit
+driver (dodo.py) uses these marks: subjects marked 'requeue' are processed
+again and subjects marked 'excluded' are skipped in all steps. From the
+command line:
+
+    python qc.py show --step repair_bads
+    python qc.py requeue repair_bads 2 3
+    python qc.py exclude repair_bads 5
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+import sqlite3
+import time
+
+from contextlib import closing
+
+statuses = ('done', 'requeue', 'excluded')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS records (
+    subject INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (subject, step, name)
+);
+CREATE INDEX IF NOT EXISTS records_step_name ON records (step, name);
+CREATE TABLE IF NOT EXISTS status (
+    subject INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (subject, step)
+);
+"""
+
+
+def _to_json(value):
+    """Encode a value as JSON (numpy scalars, arrays and sets included)."""
+    def default(obj):
+        if hasattr(obj, 'tolist'):
+            return obj.tolist()
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        raise TypeError('Cannot store %r in the QC index' % (obj,))
+
+    return json.dumps(value, default=default)
+
+
+class QCIndex(object):
+    """Index of the QC records of all subjects.
+
+    Parameters
+    ----------
+    db_file : str
+        The SQLite database (created if it does not exist).
+    timeout : float
+        How long to wait for other processes writing to the database (in
+        seconds).
+    read_only : bool
+        Open the (existing) database for reading only, without creating or
+        changing it (e.g., when doit lists or checks tasks).
+    wal : bool
+        Use write-ahead logging, so that readers do not block the (one)
+        writer. Requires shared memory between the processes, i.e., a local
+        disk (not NFS or SMB). Otherwise the default rollback journal is
+        used.
+    """
+
+    def __init__(self, db_file, timeout=60., read_only=False, wal=False):
+        self.db_file = db_file
+        self.timeout = timeout
+        self.read_only = read_only
+
+        if read_only:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        with closing(self._connect()) as con:
+            # the journal mode is stored in the database, set it either way
+            con.execute('PRAGMA journal_mode=%s' % ('WAL' if wal else
+                                                     'DELETE'))
+            con.executescript(_schema)
+
+    def _connect(self):
+        if self.read_only:
+            from urllib.request import pathname2url
+
+            uri = 'file:%s?mode=ro' % pathname2url(
+                os.path.abspath(self.db_file))
+            return sqlite3.connect(uri, timeout=self.timeout, uri=True)
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def record(self, step, subject, **values):
+        """Store (or replace) QC values of a subject for a step."""
+        now = time.time()
+        with closing(self._connect()) as con, con:
+            con.executemany(
+                'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                [(int(subject), step, name, _to_json(value), now)
+                 for name, value in values.items()])
+
+    def mark(self, step, subject, status='done'):
+        """Set the status of subject(s) for a step."""
+        if status not in statuses:
+            raise ValueError('status must be one of %s, got %r'
+                             % (', '.join(statuses), status))
+        subjects = [subject] if isinstance(subject, int) else subject
+        now = time.time()
+        with closing(self._connect()) as con, con:
+            con.executemany(
+                'INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)',
+                [(int(sub), step, status, now) for sub in subjects])
+
+    def status(self, step=None, subject=None):
+        """Status of each (subject, step) pair."""
+        rows = self.query('SELECT subject, step, status FROM status'
+                          + self._where(step=step, subject=subject),
+                          *[v for v in (step, subject) if v is not None])
+        return {(sub, stp): status for sub, stp, status in rows}
+
+    def get(self, step=None, subject=None, name=None):
+        """QC values as a dict of {(subject, step, name): value}."""
+        params = [v for v in (step, subject, name) if v is not None]
+        rows = self.query('SELECT subject, step, name, value FROM records'
+                          + self._where(step=step, subject=subject,
+                                        name=name), *params)
+        return {(sub, stp, nm): json.loads(value)
+                for sub, stp, nm, value in rows}
+
+    def query(self, sql, *params):
+        """Run a (read) query and return all rows."""
+        with closing(self._connect()) as con:
+            return con.execute(sql, params).fetchall()
+
+    def to_dataframe(self, step=None):
+        """QC values as a data frame, one row per subject.
+
+        Columns are named '<step>.<name>'.
+        """
+        import pandas as pd
+
+        values = self.get(step=step)
+        df = pd.DataFrame([dict(subject=sub, column='%s.%s' % (stp, name),
+                                value=value)
+                           for (sub, stp, name), value in values.items()],
+                          columns=['subject', 'column', 'value'])
+        return df.pivot(index='subject', columns='column', values='value')
+
+    @staticmethod
+    def _where(**conditions):
+        names = [name for name, value in conditions.items()
+                 if value is not None]
+        if not names:
+            return ''
+        return ' WHERE ' + ' AND '.join('%s = ?' % name for name in names)
+
+
+def excluded_subjects(db_file):
+    """Subjects marked as 'excluded' in any step."""
+    if not os.path.exists(db_file):
+        return set()
+    rows = QCIndex(db_file, read_only=True).query(
+        "SELECT DISTINCT subject FROM status WHERE status = 'excluded'")
+    return {sub for sub, in rows}
+
+
+class StepDone(object):
+    """doit 'uptodate' check: has the step marked the subject as done?
+
+    Parameters
+    ----------
+    db_file : str
+        The QC index.
+    step : str
+        The processing step (e.g., 'repair_bads').
+    subject : int
+        The subject.
+    """
+
+    def __init__(self, db_file, step, subject):
+        self.db_file = db_file
+        self.step = step
+        self.subject = subject
+
+    def __call__(self):
+        if not os.path.exists(self.db_file):
+            return False
+        status = QCIndex(self.db_file, read_only=True).status(
+            step=self.step, subject=self.subject)
+        return status.get((self.subject, self.step)) in ('done', 'excluded')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from config import fname, qc_wal
+
+    parser = argparse.ArgumentParser(description='Query and edit the QC '
+                                                 'index.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('show', help='print the QC values')
+    show.add_argument('--step', default=None)
+    marks = dict(requeue='requeue', exclude='excluded')
+    for command, status in marks.items():
+        sub_parser = commands.add_parser(command, help='mark subjects as %r'
+                                                       % status)
+        sub_parser.add_argument('step')
+        sub_parser.add_argument('subjects', type=int, nargs='+')
+    args = parser.parse_args()
+
+    qc = QCIndex(fname.qc_index, read_only=args.command == 'show',
+                 wal=qc_wal)
+    if args.command == 'show':
+        print(qc.to_dataframe(step=args.step).to_string())
+    else:
+        qc.mark(args.step, args.subjects, status=marks[args.command])
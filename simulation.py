@@ -0,0 +1,271 @@
+"""
+=====================
+Simulate EEG datasets
+=====================
+
+Synthetic EEG recordings (BioSemi layout, 64 channels by default) with known
+artefacts, e.g., for benchmarking the processing steps without access to
+participant data:
+
+    >>> raw = simulate_raw(duration=60., sfreq=256., flat=['Oz'],
+    ...                    noisy=['T8'], blink_rate=0.2, seed=42)
+    >>> write_bdf('sub-01.bdf', raw)
+
+The background activity is spatially correlated 1/f noise. Flat channels
+are zeroed, noisy channels carry additional broadband noise and blinks are
+added to the frontal channels and the EOG channels. The onsets of the blinks
+are stored as 'blink' annotations.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import numpy as np
+
+# external channels of the BioSemi system (EXG1-3 record eye movements)
+eog_channels = ['EXG1', 'EXG2', 'EXG3']
+misc_channels = ['EXG4', 'EXG5', 'EXG6', 'EXG7', 'EXG8']
+
+# physical and digital range of BioSemi recordings (in microvolt)
+_physical_range = (-262144, 262143)
+_digital_range = (-8388608, 8388607)
+
+
+def pink_noise(n_signals, n_samples, sfreq, rng):
+    """Generate 1/f noise with unit variance, shape (n_signals, n_samples)."""
+    freqs = np.fft.rfftfreq(n_samples, 1. / sfreq)
+    scale = np.zeros_like(freqs)
+    scale[1:] = 1. / np.sqrt(freqs[1:])
+
+    spectrum = rng.standard_normal((n_signals, freqs.size)) + \
+        1j * rng.standard_normal((n_signals, freqs.size))
+    noise = np.fft.irfft(spectrum * scale, n=n_samples, axis=1)
+
+    return noise / noise.std(axis=1, keepdims=True)
+
+
+def simulate_raw(duration=60., sfreq=256., flat=('Oz',), noisy=('T8',),
+                 blink_rate=0.2, n_sources=20, amplitude=15e-6, events=None,
+                 montage='biosemi64', seed=None):
+    """Simulate a raw EEG recording with artefacts.
+
+    Parameters
+    ----------
+    duration : float
+        Length of the recording (in seconds).
+    sfreq : float
+        The sampling frequency.
+    flat : list of str
+        EEG channels without any signal.
+    noisy : list of str
+        EEG channels with additional high amplitude noise.
+    blink_rate : float
+        Average number of blinks per second.
+    n_sources : int
+        Number of (1/f noise) sources generating the background EEG.
+    amplitude : float
+        Standard deviation of the background EEG (in volts).
+    events : ndarray, shape (n_events, 3) | None
+        Events to write into the 'Status' channel (sample, 0, code).
+    montage : str
+        The BioSemi cap layout ('biosemi16', 'biosemi32' or 'biosemi64').
+    seed : int | None
+        Seed of the random number generator.
+
+    Returns
+    -------
+    raw : instance of RawArray
+        The simulated recording with the EEG channels, the external BioSemi
+        channels (EXG1-8) and a 'Status' channel.
+    """
+    from mne import create_info, Annotations
+    from mne.channels import make_standard_montage
+    from mne.io import RawArray
+
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(duration * sfreq))
+
+    montage = make_standard_montage(montage)
+    positions = montage.get_positions()['ch_pos']
+    eeg_channels = montage.ch_names
+    pos = np.array([positions[ch] for ch in eeg_channels])
+
+    # background activity, sources projected through a smooth (distance
+    # based) mixing matrix so that neighbouring channels are correlated
+    source_pos = rng.standard_normal((n_sources, 3))
+    source_pos *= np.linalg.norm(pos, axis=1).mean() / \
+        np.linalg.norm(source_pos, axis=1, keepdims=True)
+    dist = np.linalg.norm(pos[:, np.newaxis] - source_pos, axis=2)
+    mixing = np.exp(-dist ** 2 / (2 * 0.08 ** 2))
+
+    eeg = mixing @ pink_noise(n_sources, n_samples, sfreq, rng)
+    eeg += 0.2 * rng.standard_normal((len(eeg_channels), n_samples))
+    eeg *= amplitude / eeg.std(axis=1, keepdims=True)
+
+    # external channels: EOG with a little background, unused EXG4-8
+    eog = 0.2 * amplitude * rng.standard_normal((len(eog_channels),
+                                                 n_samples))
+    misc = np.zeros((len(misc_channels), n_samples))
+
+    # blinks, raised cosines of ~250 ms, strongest at the frontal channels
+    n_blinks = rng.poisson(blink_rate * duration)
+    width = int(0.25 * sfreq)
+    shape = np.hanning(width)
+    onsets = np.sort(rng.integers(0, max(n_samples - width, 1), n_blinks))
+
+    eye = np.array([0., 1., 0.]) * np.linalg.norm(pos, axis=1).max()
+    eeg_weights = np.exp(-np.linalg.norm(pos - eye, axis=1) / 0.04)
+    eog_weights = np.array([1., -0.8, 0.3])
+    for onset in onsets:
+        blink = rng.uniform(150e-6, 400e-6) * shape
+        eeg[:, onset:onset + width] += eeg_weights[:, np.newaxis] * blink
+        eog[:, onset:onset + width] += eog_weights[:, np.newaxis] * blink
+
+    # channel artefacts
+    for ch in noisy:
+        eeg[eeg_channels.index(ch)] += \
+            10 * amplitude * rng.standard_normal(n_samples)
+    for ch in flat:
+        eeg[eeg_channels.index(ch)] = 0.
+
+    status = np.zeros((1, n_samples))
+    if events is not None:
+        events = np.asarray(events, dtype=int)
+        status[0, events[:, 0]] = events[:, 2]
+
+    info = create_info(eeg_channels + eog_channels + misc_channels +
+                       ['Status'], sfreq=sfreq,
+                       ch_types=['eeg'] * len(eeg_channels) +
+                       ['eog'] * len(eog_channels) +
+                       ['misc'] * len(misc_channels) + ['stim'])
+    raw = RawArray(np.concatenate([eeg, eog, misc, status]), info,
+                   verbose=False)
+    raw.set_montage(montage)
+    raw.set_annotations(Annotations(onsets / sfreq,
+                                    np.repeat(width / sfreq, n_blinks),
+                                    np.repeat('blink', n_blinks)))
+
+    return raw
+
+
+def add_evoked(raw, onsets, waveform, tmin=0., center='FCz', spread=0.05):
+    """Add an evoked response to the EEG channels of a recording.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The recording (with channel positions), modified in place.
+    onsets : array of int
+        Samples the response is time-locked to.
+    waveform : ndarray, shape (n_times,)
+        Time course of the response (in volts) at `center`.
+    tmin : float
+        Start of the waveform relative to the onsets (in seconds).
+    center : str
+        Channel at which the response is strongest.
+    spread : float
+        Spatial spread of the response (in meters); the amplitude decays
+        with the distance to `center`.
+
+    Returns
+    -------
+    raw : instance of Raw
+        The modified recording.
+    """
+    eeg = raw.copy().pick('eeg')
+    positions = eeg.get_montage().get_positions()['ch_pos']
+    pos = np.array([positions[ch] for ch in eeg.ch_names])
+    weights = np.exp(-np.linalg.norm(pos - positions[center], axis=1) /
+                     spread)
+
+    start = int(round(tmin * raw.info['sfreq']))
+    n_times = len(waveform)
+
+    def add(data):
+        for onset in np.asarray(onsets) + start:
+            if onset < 0 or onset + n_times > data.shape[1]:
+                continue
+            data[:, onset:onset + n_times] += \
+                weights[:, np.newaxis] * waveform
+        return data
+
+    return raw.apply_function(add, picks=eeg.ch_names, channel_wise=False)
+
+
+def write_bdf(fname, raw, event_duration=0.01):
+    """Write a raw recording to a BioSemi Data Format (24 bit) file.
+
+    Parameters
+    ----------
+    fname : str
+        The output file.
+    raw : instance of Raw
+        The recording. Data channels are stored in microvolt, a 'Status'
+        channel holds the trigger codes. The recording is padded with zeros
+        to a whole number of seconds.
+    event_duration : float
+        How long (in seconds) trigger codes are held in the 'Status' channel.
+    """
+    sfreq = raw.info['sfreq']
+    if sfreq != int(sfreq):
+        raise ValueError('BDF files require an integer sampling frequency, '
+                         'got %s' % sfreq)
+    sfreq = int(sfreq)
+
+    ch_names = raw.ch_names
+    data = raw.get_data()
+    n_records = int(np.ceil(data.shape[1] / sfreq))
+
+    # digital values (24 bit integers)
+    digital = np.zeros((len(ch_names), n_records * sfreq), dtype='<i4')
+    phys_min, phys_max = _physical_range
+    dig_min, dig_max = _digital_range
+    gain = (dig_max - dig_min) / (phys_max - phys_min)
+    for idx, ch in enumerate(ch_names):
+        if ch == 'Status':
+            codes = data[idx].astype(int)
+            onsets = np.flatnonzero(codes)
+            hold = max(int(event_duration * sfreq), 1)
+            for onset in onsets:
+                digital[idx, onset:onset + hold] = codes[onset]
+        else:
+            values = np.clip(data[idx] * 1e6, phys_min, phys_max)
+            digital[idx, :data.shape[1]] = \
+                np.round((values - phys_min) * gain + dig_min)
+
+    meas_date = raw.info['meas_date']
+    start_date = meas_date.strftime('%d.%m.%y') if meas_date else '01.01.20'
+    start_time = meas_date.strftime('%H.%M.%S') if meas_date else '00.00.00'
+
+    def field(value, width):
+        return str(value)[:width].ljust(width).encode('ascii')
+
+    n_channels = len(ch_names)
+    header = [b'\xffBIOSEMI', field('X X X X', 80),
+              field('Startdate X X X X', 80), field(start_date, 8),
+              field(start_time, 8), field(256 * (n_channels + 1), 8),
+              field('24BIT', 44), field(n_records, 8), field(1, 8),
+              field(n_channels, 4)]
+    status = [ch == 'Status' for ch in ch_names]
+    for values in ([field(ch, 16) for ch in ch_names],
+                   [field('Triggers and Status' if s else 'Active Electrode',
+                          80) for s in status],
+                   [field('Boolean' if s else 'uV', 8) for s in status],
+                   [field(dig_min if s else phys_min, 8) for s in status],
+                   [field(dig_max if s else phys_max, 8) for s in status],
+                   [field(dig_min, 8)] * n_channels,
+                   [field(dig_max, 8)] * n_channels,
+                   [field('No filtering' if s else 'HP:DC; LP:417 Hz', 80)
+                    for s in status],
+                   [field(sfreq, 8)] * n_channels,
+                   [field('', 32)] * n_channels):
+        header.extend(values)
+
+    # records are stored one after another, each holding one second of all
+    # channels as 3-byte little endian integers
+    records = digital.reshape(n_channels, n_records, sfreq).transpose(1, 0, 2)
+    samples = records.reshape(-1, 1).view(np.uint8)[:, :3]
+
+    with open(fname, 'wb') as f:
+        f.write(b''.join(header))
+        f.write(samples.tobytes())
@@ -5,12 +5,8 @@ License: BSD (3-clause)
 """
 import numpy as np
 
-from scipy import stats
 
-from mne import grand_average
-
-
-def within_subject_cis(insts, ci=0.95):
+def within_subject_cis(insts, ci=0.95, chunk_size=None):
     # see Morey (2008): Confidence Intervals from Normalized Data:
     # A correction to Cousineau (2005)
 
@@ -28,42 +24,527 @@ def within_subject_cis(insts, ci=0.95):
     else:
         subjs = np.arange(0, len(insts[0]))
 
+    # stack all ERPs into one array (conditions x subjects x channels x times)
+    data = np.stack([np.stack([cond[subj].data for subj in subjs])
+                     for cond in insts])
+
+    return within_subject_cis_array(data, ci=ci, chunk_size=chunk_size)
+
+
+def within_subject_cis_array(data, ci=0.95, chunk_size=None):
+    """Compute within-subject confidence intervals from an array of ERPs.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_conditions, n_subjects, n_channels, n_times)
+        The subject ERPs for each condition.
+    ci : float
+        The confidence level.
+    chunk_size : int | None
+        If given, the normalised ERPs are computed for at most `chunk_size`
+        channels at a time, which caps the size of the temporary arrays for
+        large cohorts.
+
+    Returns
+    -------
+    confidence : ndarray, shape (n_conditions, n_channels, n_times)
+        Half-width of the confidence interval for each condition.
+    """
+    from scipy import stats
+
+    data = np.asarray(data)
+    if data.ndim != 4:
+        raise ValueError('data must be of shape (n_conditions, n_subjects, '
+                         'n_channels, n_times), got %s' % (data.shape,))
+
+    n_cond, n_subj, n_channels, n_times = data.shape
+    if n_cond < 2 or n_subj < 2:
+        raise ValueError('At least two conditions and two subjects are '
+                         'needed to compute within-subject intervals')
+
     # correction factor for number of conditions
-    n_cond = len(insts)
     corr_factor = np.sqrt(n_cond / (n_cond - 1))
+    # critical value of the t-distribution
+    t_crit = stats.t.ppf((1 + ci) / 2.0, n_subj - 1)
+
+    if chunk_size is None:
+        chunk_size = n_channels
+    confidence = np.empty((n_cond, n_channels, n_times))
+
+    for start in range(0, n_channels, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        erps = data[:, :, chunk]
+
+        # overall subject ERPs
+        subject_erp = erps.mean(axis=0)
+
+        # normed ERPs are
+        # ((condition ERP - subject ERP) + grand average) * corr_factor,
+        # adding the grand average shifts all subjects by the same amount and
+        # scaling is linear, so the SEM only needs the centred ERPs
+        norm_erps = erps - subject_erp
+        erp_sem = norm_erps.std(axis=1, ddof=1) / np.sqrt(n_subj)
+        confidence[:, chunk] = erp_sem * corr_factor * t_crit
+
+    return confidence
+
+
+class GrandAverage(object):
+    """Streaming grand average across subjects.
+
+    Subjects are folded into the average one at a time, keeping only the
+    running mean and the running sum of squared deviations for each channel
+    and time point (Welford's algorithm, with the weighted update of West,
+    1979). Accumulators computed in parallel workers can be combined with
+    `merge` (Chan et al., 1979).
+
+    Parameters
+    ----------
+    weights : 'equal' | 'nave'
+        How subjects are weighted when no explicit weight is passed to `add`.
+        'equal' gives every subject the same weight (as `mne.grand_average`),
+        'nave' weights each subject by the number of averaged epochs (as
+        `mne.combine_evoked(..., weights='nave')`).
+
+    Notes
+    -----
+        >>> ga = GrandAverage()
+        >>> for subj in subjects:
+        ...     ga.add(read_subject_evoked(subj))
+        >>> evoked, sem = ga.to_evoked(), ga.sem
+    """
+
+    def __init__(self, weights='equal'):
+        if weights not in ('equal', 'nave'):
+            raise ValueError('weights must be "equal" or "nave", got %s'
+                             % weights)
+        self.weights = weights
+        self.n = 0
+        self._sum_w = 0.
+        self._sum_w2 = 0.
+        self._mean = None
+        self._m2 = None
+        self._info = None
+        self._tmin = None
+
+    def add(self, inst, weight=None):
+        """Fold one subject into the average.
+
+        Parameters
+        ----------
+        inst : instance of Evoked | ndarray, shape (n_channels, n_times)
+            The subject's evoked response.
+        weight : float | None
+            Weight of this subject. If None, it is derived from `weights`.
+        """
+        data = inst.data if hasattr(inst, 'data') else np.asarray(inst)
+        if weight is None:
+            weight = inst.nave if self.weights == 'nave' else 1.
+        if weight <= 0:
+            raise ValueError('weight must be positive, got %s' % weight)
+
+        if self._mean is None:
+            self._mean = np.zeros(data.shape)
+            self._m2 = np.zeros(data.shape)
+            if hasattr(inst, 'info'):
+                self._info = inst.info.copy()
+                self._tmin = inst.times[0]
+        elif data.shape != self._mean.shape:
+            raise ValueError('Data shape %s does not match the shape of the '
+                             'average %s' % (data.shape, self._mean.shape))
+        if self._info is not None and hasattr(inst, 'info') \
+                and inst.ch_names != self._info['ch_names']:
+            raise ValueError('Channels of the added instance do not match '
+                             'the channels of the average')
+
+        self.n += 1
+        self._sum_w += weight
+        self._sum_w2 += weight ** 2
+
+        # weighted Welford update
+        delta = data - self._mean
+        self._mean += (weight / self._sum_w) * delta
+        self._m2 += weight * delta * (data - self._mean)
+
+        return self
+
+    def merge(self, other):
+        """Combine with an accumulator computed on other subjects."""
+        if other.weights != self.weights:
+            raise ValueError('Cannot merge averages with different weights')
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n = other.n
+            self._sum_w, self._sum_w2 = other._sum_w, other._sum_w2
+            self._mean, self._m2 = other._mean.copy(), other._m2.copy()
+            self._info, self._tmin = other._info, other._tmin
+            return self
+        if other._mean.shape != self._mean.shape:
+            raise ValueError('Cannot merge averages of different shape')
+
+        sum_w = self._sum_w + other._sum_w
+        delta = other._mean - self._mean
+        self._mean += delta * (other._sum_w / sum_w)
+        self._m2 += other._m2 + \
+            delta ** 2 * (self._sum_w * other._sum_w / sum_w)
+
+        self.n += other.n
+        self._sum_w = sum_w
+        self._sum_w2 += other._sum_w2
+
+        return self
+
+    @property
+    def mean(self):
+        """The grand average, shape (n_channels, n_times)."""
+        if self.n == 0:
+            raise ValueError('No subjects have been added yet')
+        return self._mean.copy()
+
+    @property
+    def var(self):
+        """Unbiased between-subject variance (reliability weights)."""
+        if self.n < 2:
+            raise ValueError('At least two subjects are needed to compute '
+                             'the variance')
+        return self._m2 / (self._sum_w - self._sum_w2 / self._sum_w)
+
+    @property
+    def sem(self):
+        """Standard error of the (weighted) grand average."""
+        return np.sqrt(self.var * self._sum_w2) / self._sum_w
+
+    def to_evoked(self, data=None):
+        """Return the grand average (or `data`) as an Evoked instance."""
+        if self._info is None:
+            raise ValueError('Only arrays have been added, no measurement '
+                             'info is available')
+        from mne import EvokedArray
+
+        data = self.mean if data is None else data
+        return EvokedArray(data, self._info, tmin=self._tmin, nave=self.n,
+                           comment='Grand average (n = %d)' % self.n)
+
+
+def erp_measures(data, times, windows):
+    """Compute peak and mean amplitude measures in time windows.
+
+    Parameters
+    ----------
+    data : ndarray, shape (..., n_times)
+        The ERP(s), e.g. (n_resamples, n_channels, n_times).
+    times : ndarray, shape (n_times,)
+        The time points of the data.
+    windows : dict
+        Maps the name of a component to a tuple (tmin, tmax, polarity), where
+        polarity is either 'negative' or 'positive' and determines whether the
+        peak is the minimum or the maximum in the window.
+
+    Returns
+    -------
+    measures : dict
+        For each window, a dict with 'peak_amplitude', 'peak_latency' and
+        'mean_amplitude', each of shape ``data.shape[:-1]``.
+    """
+    measures = dict()
+    for name, (tmin, tmax, polarity) in windows.items():
+        if polarity not in ('negative', 'positive'):
+            raise ValueError('polarity must be "negative" or "positive", '
+                             'got %s' % polarity)
+        mask = (times >= tmin) & (times <= tmax)
+        if not mask.any():
+            raise ValueError('Window %s (%s, %s) does not contain any time '
+                             'points' % (name, tmin, tmax))
+
+        segment = data[..., mask]
+        if polarity == 'negative':
+            peak = np.argmin(segment, axis=-1)
+        else:
+            peak = np.argmax(segment, axis=-1)
+
+        measures[name] = dict(
+            peak_amplitude=np.take_along_axis(
+                segment, peak[..., np.newaxis], axis=-1)[..., 0],
+            peak_latency=times[mask][peak],
+            mean_amplitude=segment.mean(axis=-1))
 
-    # compute overall subject ERPs
-    subject_erp = {subj: grand_average([insts[cond][subj]
-                                        for cond in range(n_cond)])
-                   for subj in subjs}
+    return measures
+
+
+def _baseline_mask(times, baseline):
+    """Mask of the time points in a baseline window."""
+    times = np.asarray(times)
+    mask = (times >= baseline[0]) & (times <= baseline[1])
+    if not mask.any():
+        raise ValueError('Baseline %s does not contain any time points'
+                         % (baseline,))
+    return mask
+
+
+def baseline_correct(data, times, baseline):
+    """Subtract the baseline mean of each trial and channel.
+
+    Parameters
+    ----------
+    data : ndarray, shape (..., n_times)
+        The data, e.g. (n_trials, n_channels, n_times).
+    times : ndarray, shape (n_times,)
+        The time points of the data.
+    baseline : tuple of float
+        The baseline window (tmin, tmax).
+
+    Returns
+    -------
+    data : ndarray, shape (..., n_times)
+        The baseline corrected data (a new array, double precision).
+    """
+    mask = _baseline_mask(times, baseline)
+    return data - data[..., mask].mean(axis=-1, keepdims=True,
+                                       dtype=np.float64)
+
+
+def condition_averages(data, labels, times, baseline=None, method='mean',
+                       proportiontocut=0.1):
+    """Baseline corrected average of each condition.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        The single-trial data of all conditions (e.g., a memory-mapped
+        array). It is not modified or copied as a whole.
+    labels : array-like, shape (n_trials,)
+        The condition of each trial. Trials labelled None are left out.
+    times : ndarray, shape (n_times,)
+        The time points of the data.
+    baseline : tuple of float | None
+        The baseline window (tmin, tmax), subtracted from each trial and
+        channel. If None, no baseline correction.
+    method : 'mean' | 'trimmed' | 'median'
+        How trials are averaged. 'trimmed' leaves out `proportiontocut` of
+        the trials at both ends of each channel and time point.
+    proportiontocut : float
+        The proportion of trials trimmed at each end (if 'trimmed').
+
+    Returns
+    -------
+    averages : dict of ndarray, shape (n_channels, n_times)
+        The average of each condition (in order of first occurrence).
+    counts : dict of int
+        The number of trials of each condition.
+    """
+    if method not in ('mean', 'trimmed', 'median'):
+        raise ValueError('method must be "mean", "trimmed" or "median", '
+                         'got %s' % method)
+    labels = np.asarray(labels, dtype=object)
+    if len(labels) != len(data):
+        raise ValueError('Expected %d labels (one per trial), got %d'
+                         % (len(data), len(labels)))
+
+    codes = dict()
+    for label in labels:
+        if label is not None:
+            codes.setdefault(label, len(codes))
+    trials = {label: np.flatnonzero(labels == label) for label in codes}
+    counts = {label: len(trials[label]) for label in codes}
+
+    # baseline mean of each trial and channel
+    if baseline is not None:
+        mask = _baseline_mask(times, baseline)
+        baseline_mean = data[..., mask].mean(axis=-1, dtype=np.float64)
+
+    averages = dict()
+    if method == 'mean':
+        # condition means as one matrix product per channel, the mean of the
+        # baseline corrected trials is the mean minus the mean baseline
+        weights = np.zeros((len(codes), len(data)))
+        for label, code in codes.items():
+            weights[code, trials[label]] = 1. / counts[label]
+
+        means = np.empty((len(codes),) + data.shape[1:])
+        for ch in range(data.shape[1]):
+            means[:, ch] = weights @ data[:, ch].astype(np.float64)
+        if baseline is not None:
+            means -= (weights @ baseline_mean)[..., np.newaxis]
+
+        for label, code in codes.items():
+            averages[label] = means[code]
+    else:
+        from scipy.stats import trim_mean
+
+        for label in codes:
+            cond_data = data[trials[label]].astype(np.float64)
+            if baseline is not None:
+                cond_data -= baseline_mean[trials[label], :, np.newaxis]
+            if method == 'trimmed':
+                averages[label] = trim_mean(cond_data, proportiontocut,
+                                            axis=0)
+            else:
+                averages[label] = np.median(cond_data, axis=0)
+
+    return averages, counts
+
+
+# state shared with the bootstrap worker processes
+_bootstrap = dict()
+
+
+def _bootstrap_block(seed, data, times, windows, n_resamples):
+    """Group ERP measures for one block of two-level bootstrap resamples."""
+    rng = np.random.default_rng(seed)
+    n_subj = len(data)
+
+    # resample subjects: index matrix (n_resamples, n_subjects) and the
+    # number of times each subject was drawn in each resample
+    subj_idx = rng.integers(0, n_subj, size=(n_resamples, n_subj))
+    subj_counts = np.zeros((n_resamples, n_subj), dtype=int)
+    np.add.at(subj_counts, (np.arange(n_resamples)[:, np.newaxis], subj_idx),
+              1)
+
+    group_erp = np.zeros((n_resamples,) + data[0].shape[1:])
+    for subj, subj_data in enumerate(data):
+        n_trials = subj_data.shape[0]
+        # resample trials within the subject, once for every time the subject
+        # was drawn (the trial counts of all draws are pooled)
+        trial_counts = rng.multinomial(subj_counts[:, subj] * n_trials,
+                                       np.full(n_trials, 1. / n_trials))
+        group_erp += np.tensordot(trial_counts, subj_data, axes=1) / n_trials
+    group_erp /= n_subj
+
+    return erp_measures(group_erp, times, windows)
+
+
+def _init_bootstrap(data, times, windows):
+    _bootstrap.update(data=data, times=times, windows=windows)
+
+
+def _run_bootstrap(args):
+    seed, n_resamples = args
+    return _bootstrap_block(seed, _bootstrap['data'], _bootstrap['times'],
+                            _bootstrap['windows'], n_resamples)
+
+
+def bootstrap_erp_measures(data, times, windows, n_resamples=5000, seed=42,
+                           block_size=50, n_jobs=1, max_bytes=512e6):
+    """Two-level bootstrap of ERP peak and mean amplitude measures.
+
+    Subjects are resampled with replacement and, for every drawn subject,
+    trials are resampled with replacement. The group ERP of each resample is
+    the mean of the resampled subject ERPs.
+
+    Parameters
+    ----------
+    data : list of ndarray, shape (n_trials, n_channels, n_times)
+        The (baseline corrected) single-trial data of each subject, e.g. only
+        channel FCz.
+    times : ndarray, shape (n_times,)
+        The time points of the data.
+    windows : dict
+        The windows to measure in (see `erp_measures`).
+    n_resamples : int
+        Number of bootstrap resamples.
+    seed : int | None
+        Seed for the random number generator. Each block of resamples gets
+        its own child seed, so results do not depend on `n_jobs`.
+    block_size : int
+        Number of resamples drawn and evaluated at once.
+    n_jobs : int
+        Number of worker processes.
+    max_bytes : float
+        Upper bound for the memory used by the resampled group ERPs of all
+        blocks in flight. Fewer workers are used if needed.
+
+    Returns
+    -------
+    measures : dict
+        As returned by `erp_measures`, with arrays of shape
+        (n_resamples, n_channels).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    from utils import mp_context
+
+    if len(data) < 2:
+        raise ValueError('At least two subjects are needed for bootstrapping')
+    if len({subj_data.shape[1:] for subj_data in data}) > 1:
+        raise ValueError('All subjects must have the same channels and times')
+
+    # only keep time points needed for the measures
+    times = np.asarray(times)
+    keep = np.zeros(times.shape, dtype=bool)
+    for tmin, tmax, _ in windows.values():
+        keep |= (times >= tmin) & (times <= tmax)
+    data = [np.asarray(subj_data)[..., keep] for subj_data in data]
+    times = times[keep]
+
+    # memory used by the group ERPs (and one temporary copy) of one block
+    block_bytes = 2 * 8 * block_size * np.prod(data[0].shape[1:])
+    if block_bytes > max_bytes:
+        raise ValueError('A block of %s resamples needs %.0f MB, which '
+                         'exceeds max_bytes. Use a smaller block_size or '
+                         'fewer channels.' % (block_size, block_bytes / 1e6))
+    n_jobs = int(max(1, min(n_jobs, max_bytes // block_bytes)))
+
+    sizes = [min(block_size, n_resamples - start)
+             for start in range(0, n_resamples, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    if n_jobs == 1:
+        blocks = [_bootstrap_block(block_seed, data, times, windows, size)
+                  for block_seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=mp_context(),
+                                 initializer=_init_bootstrap,
+                                 initargs=(data, times, windows)) as pool:
+            blocks = list(pool.map(_run_bootstrap, zip(seeds, sizes)))
 
-    # compute condition grand averages
-    grand_averages = [grand_average(list(cond.values()))
-                      for cond in insts]
+    return {name: {measure: np.concatenate([block[name][measure]
+                                            for block in blocks])
+                   for measure in blocks[0][name]}
+            for name in windows}
 
-    # place holder for results
-    n_channels = grand_averages[0].data.shape[0]
-    n_times = grand_averages[0].data.shape[1]
-    norm_erps = np.zeros((n_cond, int(n_subj), n_channels, n_times))
 
-    # compute normed ERPs,
-    # ((condition ERP - subject ERP) + grand average) * corr_factor
-    for n_s, subj in enumerate(subjs):
+def bootstrap_ci(values, ci=0.95):
+    """Percentile confidence interval of bootstrap resamples (along axis 0)."""
+    return np.percentile(values, [100 * (1 - ci) / 2, 100 * (1 + ci) / 2],
+                         axis=0)
 
-        for ic, cond in enumerate(insts):
-            erp_data = cond[subj].data.copy() - subject_erp[subj].data
-            erp_data = (erp_data + grand_averages[ic].data) * corr_factor
 
-            norm_erps[ic, n_s, :] = erp_data
+def trial_features(data, times, ch_names, windows, baseline):
+    """Compute single-trial ERP features.
 
-    erp_sem = np.zeros((n_cond, n_channels, n_times))
-    for n_c in range(n_cond):
-        erp_sem[n_c, :] = stats.sem(norm_erps[n_c, :], axis=0)
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        The single-trial data (not baseline corrected).
+    times : ndarray, shape (n_times,)
+        The time points of the data.
+    ch_names : list of str
+        The names of the channels in `data`.
+    windows : dict
+        The windows to measure in (see `erp_measures`).
+    baseline : tuple of float
+        The (pre-response) baseline window, subtracted from each trial before
+        computing the features.
 
-    confidence = np.zeros((n_cond, n_channels, n_times))
+    Returns
+    -------
+    features : dict of ndarray, shape (n_trials,)
+        Columns named '<component>_<measure>_<channel>', plus the baseline
+        mean of each channel as 'baseline_<channel>'.
+    """
+    times = np.asarray(times)
+    baseline_mean = data[..., _baseline_mask(times, baseline)].mean(axis=-1)
+    measures = erp_measures(data - baseline_mean[..., np.newaxis], times,
+                            windows)
 
-    for n_c in range(n_cond):
-        confidence[n_c, :] = erp_sem[n_c, :] * \
-                             stats.t.ppf((1 + ci) / 2.0, int(n_subj) - 1)
+    features = dict()
+    for ch, ch_name in enumerate(ch_names):
+        features['baseline_%s' % ch_name] = baseline_mean[:, ch]
+        for component, component_measures in measures.items():
+            for measure, values in component_measures.items():
+                features['%s_%s_%s' % (component, measure, ch_name)] = \
+                    values[:, ch]
 
-    return confidence
\ No newline at end of file
+    return features
@@ -0,0 +1,62 @@
+"""
+=====================================
+Tests of the time-frequency functions
+=====================================
+
+Run with:
+
+    python -m pytest tests
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tfr import read_tfr, stack_conditions, tfr_morlet, write_tfr  # noqa: E402
+
+
+def test_no_trials_in_any_condition(tmp_path):
+    """A subject without trials in any condition gives an empty result."""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(5, 3, 256))
+    freqs = [8., 10.]
+    decim = 2
+    single_trials = np.zeros((5, 1, len(freqs), 128), dtype=np.float32)
+
+    power, itc, counts = tfr_morlet(data, 128., freqs, [None] * 5,
+                                    n_cycles=3., decim=decim,
+                                    single_trials=single_trials,
+                                    single_trial_picks=[0])
+    assert power == itc == counts == {}
+    # the single trials are computed regardless of the conditions
+    assert np.all(single_trials > 0)
+
+    conditions = [cond for cond in ['a', 'b'] if cond in counts]
+    averages = stack_conditions(power, itc, conditions, (3, len(freqs), 128))
+    assert averages.shape == (0, 2, 3, len(freqs), 128)
+
+    fname = str(tmp_path / 'tfr.npy')
+    write_tfr(fname, averages, dict(conditions=conditions, counts=[]))
+    stored, info = read_tfr(fname)
+    assert stored.shape == (0, 2, 3, len(freqs), 128)
+    assert info['conditions'] == []
+
+
+def test_stack_conditions():
+    """The power and ITC of each condition, in the given order."""
+    shape = (2, 3, 4)
+    power = {'a': np.full(shape, 1.), 'b': np.full(shape, 2.)}
+    itc = {'a': np.full(shape, .1), 'b': np.full(shape, .2)}
+
+    averages = stack_conditions(power, itc, ['b', 'a'], shape)
+    assert averages.shape == (2, 2) + shape
+    assert averages.dtype == np.float32
+    np.testing.assert_allclose(averages[0, 0], 2.)
+    np.testing.assert_allclose(averages[0, 1], .2)
+    np.testing.assert_allclose(averages[1, 0], 1.)
@@ -0,0 +1,258 @@
+"""
+=================================
+Time-frequency analysis of epochs
+=================================
+
+Power and inter-trial phase coherence (ITC) of single-trial data, computed
+by convolution with complex Morlet wavelets (the same wavelets as MNE's
+`tfr_array_morlet`). The convolution is done with FFTs, for all trials and
+channels of a chunk at once, and the chunks are limited in size so that
+memory use does not grow with the number of trials, e.g.:
+
+    >>> store = read_epoch_store(fname.output(...))
+    >>> power, itc, counts = tfr_morlet(store.data, store.info['sfreq'],
+    ...                                 freqs=[4., 5., 6., 7.],
+    ...                                 labels=labels)
+
+The results are stored as .npy arrays with a JSON sidecar (see
+`write_tfr` and `read_tfr`).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import json
+import os
+
+import numpy as np
+
+from utils import atomic_write
+
+
+def _sidecar(fname):
+    return os.path.splitext(fname)[0] + '.json'
+
+
+def morlet_wavelets(sfreq, freqs, n_cycles=7.):
+    """Complex Morlet wavelets (zero mean, as used by MNE).
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    freqs : array-like, shape (n_freqs,)
+        The frequencies of the wavelets.
+    n_cycles : float | array-like, shape (n_freqs,)
+        The number of cycles of each wavelet.
+
+    Returns
+    -------
+    wavelets : list of ndarray
+        The wavelets (of increasing length for decreasing frequency).
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    n_cycles = np.broadcast_to(np.asarray(n_cycles, dtype=float),
+                               freqs.shape)
+
+    wavelets = []
+    for freq, cycles in zip(freqs, n_cycles):
+        # standard deviation of the gaussian window, the wavelet spans
+        # 5 standard deviations on each side of t = 0
+        sigma_t = cycles / (2. * np.pi * freq)
+        t = np.arange(0., 5. * sigma_t, 1. / sfreq)
+        t = np.r_[-t[::-1], t[1:]]
+        oscillation = np.exp(2. * 1j * np.pi * freq * t) - \
+            np.exp(-2 * (np.pi * freq * sigma_t) ** 2)
+        wavelet = oscillation * np.exp(-t ** 2 / (2. * sigma_t ** 2))
+        wavelets.append(wavelet / (np.sqrt(0.5) * np.linalg.norm(wavelet)))
+
+    return wavelets
+
+
+def tfr_morlet(data, sfreq, freqs, labels, n_cycles=7., decim=1,
+               single_trials=None, single_trial_picks=None, max_bytes=256e6,
+               workers=1):
+    """Power and inter-trial phase coherence of each condition.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        The single-trial data (e.g., a memory-mapped array), read in chunks
+        of trials.
+    sfreq : float
+        The sampling frequency.
+    freqs : array-like, shape (n_freqs,)
+        The frequencies.
+    labels : array-like, shape (n_trials,)
+        The condition of each trial. Trials labelled None are left out of
+        the averages.
+    n_cycles : float | array-like, shape (n_freqs,)
+        The number of cycles of the wavelet of each frequency.
+    decim : int
+        Decimation factor of the time points (after convolution).
+    single_trials : ndarray, shape (n_trials, n_picks, n_freqs, n_times_out)
+        | None
+        If given, the power of each trial at the channels
+        `single_trial_picks` is written to it (e.g., a memory-mapped
+        array).
+    single_trial_picks : list of int | None
+        The channels of `single_trials` (all channels if None).
+    max_bytes : float
+        Approximate memory used for the convolution of one chunk of trials
+        (in bytes).
+    workers : int
+        Number of threads used for the FFTs (see `scipy.fft.fft`).
+
+    Returns
+    -------
+    power : dict of ndarray, shape (n_channels, n_freqs, n_times_out)
+        The average power of each condition (single precision).
+    itc : dict of ndarray, shape (n_channels, n_freqs, n_times_out)
+        The inter-trial phase coherence of each condition (single
+        precision).
+    counts : dict of int
+        The number of trials of each condition.
+    """
+    from scipy.fft import fft, ifft, next_fast_len
+
+    n_trials, n_channels, n_times = data.shape
+    labels = np.asarray(labels, dtype=object)
+    if len(labels) != n_trials:
+        raise ValueError('Expected %d labels (one per trial), got %d'
+                         % (n_trials, len(labels)))
+
+    wavelets = morlet_wavelets(sfreq, freqs, n_cycles)
+    longest = max(len(wavelet) for wavelet in wavelets)
+    if longest > n_times:
+        raise ValueError('The wavelet of the lowest frequency is longer '
+                         '(%d samples) than the epochs (%d samples), use '
+                         'fewer cycles or higher frequencies'
+                         % (longest, n_times))
+    n_fft = next_fast_len(n_times + longest - 1)
+    wavelets_fft = [fft(wavelet, n_fft) for wavelet in wavelets]
+    times_out = slice(0, n_times, decim)
+    n_times_out = len(range(n_times)[times_out])
+
+    codes = dict()
+    for label in labels:
+        if label is not None:
+            codes.setdefault(label, len(codes))
+    counts = {label: int(np.sum(labels == label)) for label in codes}
+    trial_codes = np.array([-1 if label is None else codes[label]
+                            for label in labels])
+
+    if single_trial_picks is None:
+        single_trial_picks = np.arange(n_channels)
+
+    # sums of power and of unit phase vectors of each condition
+    shape = (len(codes), n_channels, len(wavelets), n_times_out)
+    power_sum = np.zeros(shape)
+    phase_sum = np.zeros(shape, dtype=np.complex128)
+
+    # trials per chunk: the FFT of the chunk and the product with one wavelet
+    # (complex, n_fft points per channel)
+    chunk = max(int(max_bytes // (2 * 16 * n_channels * n_fft)), 1)
+    for start in range(0, n_trials, chunk):
+        stop = min(start + chunk, n_trials)
+        # one-hot weights of the trials' conditions
+        weights = (trial_codes[start:stop] ==
+                   np.arange(len(codes))[:, np.newaxis]).astype(np.float64)
+
+        signals = np.asarray(data[start:stop], dtype=np.float64)
+        signals_fft = fft(signals, n_fft, axis=-1, workers=workers)
+        for idx, (wavelet, wavelet_fft) in enumerate(zip(wavelets,
+                                                         wavelets_fft)):
+            # centre of the full convolution (i.e., mode 'same')
+            offset = (len(wavelet) - 1) // 2
+            coefs = ifft(signals_fft * wavelet_fft, axis=-1,
+                         workers=workers)[..., offset:offset + n_times]
+            coefs = coefs[..., times_out]
+
+            power = coefs.real ** 2 + coefs.imag ** 2
+            with np.errstate(invalid='ignore', divide='ignore'):
+                phase = np.nan_to_num(coefs / np.sqrt(power))
+
+            n_chunk = stop - start
+            power_sum[:, :, idx] += (weights @ power.reshape(n_chunk, -1)) \
+                .reshape(len(codes), n_channels, n_times_out)
+            phase_sum[:, :, idx] += (weights @ phase.reshape(n_chunk, -1)) \
+                .reshape(len(codes), n_channels, n_times_out)
+
+            if single_trials is not None:
+                single_trials[start:stop, :, idx] = \
+                    power[:, single_trial_picks]
+
+    power = {label: (power_sum[code] / counts[label]).astype(np.float32)
+             for label, code in codes.items()}
+    itc = {label: (np.abs(phase_sum[code]) / counts[label])
+           .astype(np.float32)
+           for label, code in codes.items()}
+
+    return power, itc, counts
+
+
+def stack_conditions(power, itc, conditions, shape):
+    """Power and ITC of conditions as one array (e.g., for `write_tfr`).
+
+    Parameters
+    ----------
+    power, itc : dict of ndarray, shape (n_channels, n_freqs, n_times)
+        The power and ITC of each condition (see `tfr_morlet`).
+    conditions : list of str
+        The conditions, in the order of the array. May be empty (e.g., if
+        a subject has no trials in any condition).
+    shape : tuple of int
+        The shape of the data of one condition, (n_channels, n_freqs,
+        n_times), so that the shape of the array is defined without
+        conditions.
+
+    Returns
+    -------
+    data : ndarray, shape (n_conditions, 2, n_channels, n_freqs, n_times)
+        The power and ITC (single precision) of each condition.
+    """
+    data = np.empty((len(conditions), 2) + tuple(shape), dtype=np.float32)
+    for idx, cond in enumerate(conditions):
+        data[idx, 0] = power[cond]
+        data[idx, 1] = itc[cond]
+
+    return data
+
+
+def write_tfr(fname, data, info):
+    """Store time-frequency data (the sidecar is stored next to it as .json).
+
+    Parameters
+    ----------
+    fname : str
+        The .npy file.
+    data : ndarray | None
+        The data (e.g., of shape (n_conditions, n_measures, n_channels,
+        n_freqs, n_times)). If None, only the sidecar is written (e.g., of
+        data that was written in place).
+    info : dict
+        What the axes of the data are (e.g., conditions, channel names,
+        frequencies and times), stored as JSON.
+    """
+    if data is not None:
+        with atomic_write(fname) as tmp:
+            with open(tmp, 'wb') as f:
+                np.save(f, data)
+    with atomic_write(_sidecar(fname)) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+
+
+def read_tfr(fname, mmap_mode='r'):
+    """Read stored time-frequency data (memory-mapped by default).
+
+    Returns
+    -------
+    data : ndarray
+        The data.
+    info : dict
+        The sidecar.
+    """
+    with open(_sidecar(fname)) as f:
+        info = json.load(f)
+    return np.load(fname, mmap_mode=mmap_mode), info
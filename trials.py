@@ -0,0 +1,95 @@
+"""
+=====================================
+Compact records of the flanker trials
+=====================================
+
+The trials of the flanker task as a NumPy structured array, one record per
+trial, with the categorical variables (reaction, target congruency and
+flanker direction) stored as small integer codes rather than strings. The
+same records are filled while parsing the events, exported as the epochs
+metadata and used to select the trials that have epochs, e.g.:
+
+    >>> records = empty_trials(n_trials)
+    >>> records[0] = (0, 1, encode('reaction', 'correct'), 0.42,
+    ...               encode('target', 'congruent'), encode('flanker', 'left'))
+    >>> metadata = to_dataframe(records[has_reaction(records)])
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+import numpy as np
+
+# categories of the coded fields, a trial's code is the position of its
+# category (`missing` if there is none, e.g., no reaction in missed trials)
+categories = {'reaction': ('correct', 'incorrect'),
+              'target': ('congruent', 'incongruent'),
+              'flanker': ('left', 'right')}
+missing = -1
+
+# one record per trial
+trial_dtype = np.dtype([('trial', np.int32),
+                        ('reaction', np.int8),
+                        ('rt', np.float64),
+                        ('target', np.int8),
+                        ('flanker', np.int8),
+                        ('block', np.int8)])
+
+# code of the reaction events (i.e., `reaction_ids` of the epochs) of each
+# reaction and target congruency
+reaction_event_ids = {'correct_congruent': 11,
+                      'correct_incongruent': 12,
+                      'incorrect_congruent': 13,
+                      'incorrect_incongruent': 14}
+
+
+def empty_trials(n_trials):
+    """Records of `n_trials` trials, without reaction (rt is NaN) and
+    block (`missing`)."""
+    records = np.zeros(n_trials, dtype=trial_dtype)
+    for field in list(categories) + ['block']:
+        records[field] = missing
+    records['rt'] = np.nan
+
+    return records
+
+
+def encode(field, value):
+    """The code of a category (e.g., ``encode('reaction', 'correct')``)."""
+    return categories[field].index(value)
+
+
+def decode(field, codes):
+    """The categories of codes (None for missing ones)."""
+    names = np.array(categories[field] + (None,), dtype=object)
+    return names[np.asarray(codes)]
+
+
+def has_reaction(records):
+    """Mask of the trials with a (timely) reaction, i.e., with an epoch."""
+    return records['reaction'] != missing
+
+
+def reaction_events(records):
+    """The code of the reaction event of each trial (see
+    `reaction_event_ids`), e.g., 12 for a correct reaction to an incongruent
+    target. Only valid for trials with a reaction."""
+    return 11 + records['target'] + 2 * records['reaction']
+
+
+def to_dataframe(records):
+    """The records as a data frame (e.g., for the epochs metadata).
+
+    The coded fields are categorical columns, with missing codes as NaN.
+    """
+    import pandas as pd
+
+    columns = {}
+    for field in records.dtype.names:
+        if field in categories:
+            columns[field] = pd.Categorical.from_codes(
+                records[field], categories=list(categories[field]))
+        else:
+            columns[field] = records[field]
+
+    return pd.DataFrame(columns)
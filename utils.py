@@ -6,7 +6,14 @@ Authors: José C. García Alanis <alanis.jcg@gmail.com>
 License: BSD (3-clause)
 """
 
+import hashlib
+import json
+import multiprocessing
+import os
 import string
+import tempfile
+
+from contextlib import contextmanager
 
 
 class FileNames(object):
@@ -240,3 +247,293 @@ def _prefill_placeholders(placeholders, files, user_values):
             placeholder_values[placeholder] = path
 
     return placeholder_values
+
+
+def mp_context():
+    """Get the multiprocessing context used for process pools.
+
+    The processing scripts run at module level, so worker processes are
+    forked where possible to avoid re-importing the calling script in each
+    of them.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def ssp_projector(info, ch_names):
+    """Matrix applying the SSP projectors of `info` to the given channels.
+
+    Returns None if there are no projectors.
+    """
+    import numpy as np
+
+    vectors = []
+    for proj in info['projs']:
+        cols = [proj['data']['col_names'].index(ch) if
+                ch in proj['data']['col_names'] else None for ch in ch_names]
+        for row in proj['data']['data']:
+            vectors.append([row[col] if col is not None else 0.
+                            for col in cols])
+    if not vectors:
+        return None
+
+    u, s, _ = np.linalg.svd(np.array(vectors).T, full_matrices=False)
+    u = u[:, s > s.max() * 1e-10]
+
+    return np.eye(len(ch_names)) - u @ u.T
+
+
+def file_checksum(fname, chunk_size=2 ** 20):
+    """SHA-256 checksum of a file (as written by ``sha256sum``)."""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _fsync(path):
+    """Flush a file (or directory entry) to disk."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # directories cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def manifest_file(fname):
+    """The checksum manifest of the directory a file is in."""
+    return os.path.join(os.path.dirname(os.path.abspath(fname)),
+                        'manifest.jsonl')
+
+
+@contextmanager
+def _locked(fname):
+    """Hold an exclusive lock on `fname` + '.lock' (where supported)."""
+    try:
+        import fcntl
+    except ImportError:  # e.g., on Windows
+        fcntl = None
+
+    with open(fname + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_manifest(manifest):
+    """The last entry of each file in a manifest."""
+    entries = dict()
+    if not os.path.exists(manifest):
+        return entries
+    with open(manifest) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # incomplete line of an interrupted write
+                continue
+            entries[entry.get('file')] = entry
+
+    return entries
+
+
+def _record_checksum(fname, parts=()):
+    """Replace the manifest entry of a file (and keep one entry per file)."""
+    manifest = manifest_file(fname)
+    name = os.path.basename(fname)
+    entry = dict(file=name,
+                 sha256=file_checksum(fname),
+                 size=os.path.getsize(fname))
+    if parts:
+        entry['parts'] = [dict(file=os.path.basename(part),
+                               sha256=file_checksum(part),
+                               size=os.path.getsize(part))
+                          for part in parts]
+
+    # processes writing to the same directory (e.g., the data frames of
+    # several subjects) update the manifest one at a time
+    with _locked(manifest):
+        entries = _read_manifest(manifest)
+        entries.pop(name, None)
+        entries[name] = entry
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='-manifest.jsonl',
+                                   dir=os.path.dirname(manifest))
+        with os.fdopen(fd, 'w') as f:
+            for item in entries.values():
+                f.write(json.dumps(item) + '\n')
+        os.chmod(tmp, _default_mode(manifest))
+        os.replace(tmp, manifest)
+
+
+def _default_mode(fname):
+    """Permissions of a new file: those of `fname` if it exists, else the
+    default permissions given by the umask."""
+    try:
+        return os.stat(fname).st_mode & 0o777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+@contextmanager
+def atomic_write(fname, manifest=True):
+    """Write a file so that it either exists completely or not at all.
+
+    Yields a temporary path with the same name as `fname`, in a temporary
+    directory next to it (so that, e.g., MNE accepts it as a FIF file
+    name). Once the block completes, the file is flushed to disk and moved
+    to `fname`; if the block fails, it is removed:
+
+        >>> with atomic_write(output_path) as tmp:
+        ...     raw.save(tmp, overwrite=True)
+
+    Other files written to the temporary directory (e.g., the parts of a
+    FIF file split by MNE, such as ``<name>-1.fif``, which are linked by
+    name) are moved next to `fname` as well, before it. The files get the
+    permissions of the file they replace (or those given by the umask).
+
+    Parameters
+    ----------
+    fname : str
+        The file to write.
+    manifest : bool
+        Whether to record the checksum of the file (and of its parts) in the
+        manifest of its directory (see `verify_checksum`).
+    """
+    import shutil
+
+    path, name = os.path.split(os.path.abspath(fname))
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=path)
+    tmp = os.path.join(tmp_dir, name)
+
+    parts = []
+    try:
+        yield tmp
+        mode = _default_mode(fname)
+        for part in sorted(os.listdir(tmp_dir)):
+            if part == name:
+                continue
+            os.chmod(os.path.join(tmp_dir, part), mode)
+            _fsync(os.path.join(tmp_dir, part))
+            os.replace(os.path.join(tmp_dir, part), os.path.join(path, part))
+            parts.append(os.path.join(path, part))
+        os.chmod(tmp, mode)
+        _fsync(tmp)
+        os.replace(tmp, fname)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    _fsync(path)
+
+    if manifest:
+        _record_checksum(fname, parts)
+
+
+def verify_checksum(fname):
+    """Whether a file (and its parts) match the checksums last recorded in
+    its manifest.
+
+    Returns False if the file does not exist or has no recorded checksum.
+    """
+    if not os.path.exists(fname):
+        return False
+    entry = _read_manifest(manifest_file(fname)).get(os.path.basename(fname))
+    if entry is None or file_checksum(fname) != entry['sha256']:
+        return False
+
+    path = os.path.dirname(os.path.abspath(fname))
+    for part in entry.get('parts', []):
+        part_file = os.path.join(path, part['file'])
+        if not os.path.exists(part_file) or \
+                file_checksum(part_file) != part['sha256']:
+            return False
+
+    return True
+
+
+def prefetch(func, items, n_ahead=2, max_bytes=None, size=None):
+    """Iterate over ``func(item)``, computing the next items in the background.
+
+    While the caller processes the result for one item, the results for the
+    next `n_ahead` items are computed (e.g., read from disk) in a thread
+    pool, so that reading and processing overlap.
+
+    Parameters
+    ----------
+    func : callable
+        Computes the result for an item (e.g., reads a subject's epochs).
+    items : iterable
+        The items (e.g., subjects).
+    n_ahead : int
+        Maximum number of results computed ahead of the current one.
+    max_bytes : float | None
+        Maximum memory (in bytes) of the results in flight, including the
+        one last yielded (it is counted until the next one is yielded, as
+        the caller holds it until then). Items are not computed ahead if
+        this would exceed `max_bytes` (but an item is always computed once
+        it is the next one). Requires `size`.
+    size : callable | None
+        Estimates the memory of the result for an item before it is
+        computed (e.g., from the size of the file it is read from).
+
+    Yields
+    ------
+    item : object
+        The item.
+    result : object
+        ``func(item)``.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    if max_bytes is not None and size is None:
+        raise ValueError('max_bytes requires a size function')
+
+    items = iter(items)
+    # (item, future, estimated size) of the next and the prefetched items,
+    # and the estimated size of the result held by the caller
+    pending = deque()
+    deferred = []
+    held = 0
+
+    pool = ThreadPoolExecutor(max_workers=max(n_ahead, 1))
+    try:
+        while True:
+            while len(pending) < n_ahead + 1:
+                if deferred:
+                    item, nbytes = deferred.pop()
+                else:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    nbytes = size(item) if size is not None else 0
+                if pending and max_bytes is not None and \
+                        held + sum(p[2] for p in pending) + nbytes > \
+                        max_bytes:
+                    # computed once the caller has moved on
+                    deferred.append((item, nbytes))
+                    break
+                pending.append((item, pool.submit(func, item), nbytes))
+
+            if not pending:
+                break
+
+            item, future, nbytes = pending.popleft()
+            result = future.result()
+            held = nbytes
+            yield item, result
+            del result
+    finally:
+        for _, future, _ in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
@@ -7,45 +7,136 @@ License: BSD (3-clause)
 """
 import numpy as np
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+from utils import ssp_projector
 
-from sklearn.preprocessing import normalize
 
+def z_score_plot_data(z_scores, channels, bads=None, threshold=5.0,
+                      cmap='inferno'):
+    """Compute what `plot_z_scores` draws, without creating a figure.
 
-def plot_z_scores(z_scores, channels, bads=None, cmap='inferno', show=False):
+    Returns
+    -------
+    data : dict
+        Bar positions (``x``), heights and colors, channel labels and their
+        colors, the critical z-score and the upper y-limit.
+    """
+    import matplotlib.pyplot as plt
 
-    cmap = cm.get_cmap(cmap)
+    z_scores = np.asarray(z_scores, dtype=float)
+    if len(channels) != z_scores.shape[0]:
+        raise ValueError('Number of channels (%s) and z-scores (%s) do not '
+                         'match' % (len(channels), z_scores.shape[0]))
 
-    # plot results
-    z_colors = normalize(
-        np.abs(z_scores).reshape((1, z_scores.shape[0]))).ravel()
+    heights = np.abs(z_scores)
+    # bar colors scale with the (unit-norm) absolute z-scores
+    norm = np.linalg.norm(heights)
+    colors = plt.get_cmap(cmap)(heights / norm if norm else heights)
+
+    # show channel names in red if bad
+    bads = set() if bads is None else set(bads)
+    label_colors = ['crimson' if ch in bads else 'k' for ch in channels]
+
+    y_lim = threshold if heights.max() < threshold \
+        else int(heights.max() + 2)
+
+    return dict(x=np.arange(len(channels)), heights=heights, colors=colors,
+                labels=list(channels), label_colors=label_colors,
+                threshold=threshold, y_lim=y_lim)
+
+
+def _label_paths(labels, fontsize=9, rotation=45):
+    """Text outlines (in points), centered on and rotated about (0, 0)."""
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.path import Path
+    from matplotlib.textpath import TextPath
+    from matplotlib.transforms import Affine2D
+
+    prop = FontProperties(weight='bold')
+    paths = []
+    for label in labels:
+        path = TextPath((0, 0), label, size=fontsize, prop=prop)
+        # center of the control points, close enough to the center of the
+        # outline and much cheaper than Path.get_extents
+        center = (path.vertices.min(axis=0) + path.vertices.max(axis=0)) / 2.
+        transform = Affine2D().translate(*-center).rotate_deg(rotation)
+        paths.append(Path(transform.transform(path.vertices), path.codes))
+
+    return paths
+
+
+def plot_z_scores(z_scores, channels, bads=None, threshold=5.0,
+                  cmap='inferno', show=False, return_data=False):
+    """Plot the absolute (robust) z-score of each channel.
+
+    Parameters
+    ----------
+    z_scores : ndarray, shape (n_channels,)
+        The z-score of each channel.
+    channels : list of str
+        The channel names.
+    bads : list of str | None
+        Channels to label in red.
+    threshold : float
+        Critical z-score (drawn as a dashed line).
+    cmap : str
+        Colormap for the bars.
+    show : bool
+        Whether to show the figure.
+    return_data : bool
+        If True, only return the data of the plot (see `z_score_plot_data`),
+        e.g., to render the figure later.
+
+    Returns
+    -------
+    fig : instance of Figure | dict
+        The figure, or the data of the plot if `return_data` is True.
+    """
+    data = z_score_plot_data(z_scores, channels, bads=bads,
+                             threshold=threshold, cmap=cmap)
+    if return_data:
+        return data
+
+    import matplotlib.pyplot as plt
+
+    from matplotlib.collections import PathCollection, PolyCollection
+    from matplotlib.transforms import Affine2D
+
+    n_channels = len(data['x'])
+    y_lim = data['y_lim']
 
     props = dict(boxstyle='round', facecolor='white', alpha=0.5)
-    fig, ax = plt.subplots(figsize=(20, 6))
-    if z_scores.max() < 5.0:
-        y_lim = 5
-    else:
-        y_lim = int(z_scores.max() + 2)
-
-    for i in range(z_scores.shape[0]):
-        ch = channels[i]
-        # show channel names in red if bad by correlation
-        if ch in bads:
-            col = 'crimson'
-        else:
-            col = 'k'
-        ax.axhline(y=5.0, xmin=-1.0, xmax=65,
-                   color='crimson', linestyle='dashed', linewidth=2.0)
-        ax.text(-5.0, 5.0, 'crit. Z-score', fontsize=14,
-                verticalalignment='center', horizontalalignment='center',
-                color='crimson', bbox=props)
-        ax.bar(i, np.abs(z_scores[i]), width=0.9, color=cmap(z_colors[i]))
-        ax.text(i, np.abs(z_scores[i]) + 0.25, ch, color=col,
-                fontweight='bold', fontsize=9,
-                ha='center', va='center', rotation=45)
+    fig, ax = plt.subplots(figsize=(max(20, 0.3 * n_channels), 6))
+
+    ax.axhline(y=threshold, color='crimson', linestyle='dashed',
+               linewidth=2.0)
+    ax.text(-0.06, threshold, 'crit. Z-score', fontsize=14,
+            verticalalignment='center', horizontalalignment='center',
+            color='crimson', bbox=props, transform=ax.get_yaxis_transform())
+
+    # all bars as one collection of rectangles
+    x, heights = data['x'], data['heights']
+    bars = PolyCollection(
+        np.stack([np.column_stack([x - 0.45, np.zeros_like(heights)]),
+                  np.column_stack([x - 0.45, heights]),
+                  np.column_stack([x + 0.45, heights]),
+                  np.column_stack([x + 0.45, np.zeros_like(heights)])],
+                 axis=1),
+        facecolors=data['colors'], edgecolors='none')
+    ax.add_collection(bars, autolim=False)
+
+    # all channel labels as one collection of text outlines, placed (in
+    # data coordinates) just above the bars
+    labels = PathCollection(_label_paths(data['labels']),
+                            offsets=np.column_stack([x, heights + 0.25]),
+                            offset_transform=ax.transData,
+                            transform=Affine2D().scale(1. / 72.) +
+                            fig.dpi_scale_trans,
+                            facecolors=data['label_colors'],
+                            edgecolors='none')
+    ax.add_collection(labels, autolim=False)
+
     ax.set_ylim(0, y_lim)
-    ax.set_xlim(-1, 64)
+    ax.set_xlim(-1, n_channels)
 
     plt.title('EEG channel deviation', {'fontsize': 15, 'fontweight': 'bold'})
     plt.xlabel('Channels', {'fontsize': 13}, labelpad=10)
@@ -63,3 +154,178 @@ def plot_z_scores(z_scores, channels, bads=None, cmap='inferno', show=False):
         plt.close(fig)
 
     return fig.show() if show else fig
+
+
+def minmax_envelope(data, n_bins=None, edges=None):
+    """Minimum and maximum of the data in (nearly) equal-sized time bins.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The data.
+    n_bins : int | None
+        Number of bins (e.g., the width of the plot in pixels). If there are
+        fewer samples than bins, each sample is its own bin.
+    edges : ndarray of int | None
+        First sample of each bin, instead of `n_bins`.
+
+    Returns
+    -------
+    edges : ndarray, shape (n_bins,)
+        First sample of each bin.
+    mins, maxs : ndarray, shape (n_channels, n_bins)
+        The envelope of the data.
+    """
+    if edges is None:
+        n_samples = data.shape[1]
+        n_bins = max(min(int(n_bins), n_samples), 1)
+        edges = (np.arange(n_bins) * n_samples) // n_bins
+
+    return (edges, np.minimum.reduceat(data, edges, axis=1),
+            np.maximum.reduceat(data, edges, axis=1))
+
+
+def _raw_envelope(raw, ch_idx, n_bins, proj=True, chunk_duration=60.):
+    """Min/max envelope of a recording, read chunk by chunk."""
+    ch_names = [raw.ch_names[idx] for idx in ch_idx]
+    projector = ssp_projector(raw.info, ch_names) if proj else None
+    n_bins = max(min(n_bins, raw.n_times), 1)
+    edges = (np.arange(n_bins) * raw.n_times) // n_bins
+
+    # whole bins per chunk
+    per_chunk = max(int(chunk_duration * raw.info['sfreq'] * n_bins /
+                        raw.n_times), 1)
+    mins, maxs = [], []
+    for first in range(0, n_bins, per_chunk):
+        chunk_edges = edges[first:first + per_chunk]
+        stop = edges[first + per_chunk] if first + per_chunk < n_bins \
+            else raw.n_times
+        data = raw.get_data(picks=ch_idx, start=chunk_edges[0], stop=stop)
+        if projector is not None:
+            data = projector @ data
+        _, chunk_mins, chunk_maxs = \
+            minmax_envelope(data, edges=chunk_edges - chunk_edges[0])
+        mins.append(chunk_mins)
+        maxs.append(chunk_maxs)
+
+    return (edges / raw.info['sfreq'], np.concatenate(mins, axis=1),
+            np.concatenate(maxs, axis=1))
+
+
+def plot_raw_envelope(raw, picks=('eeg', 'eog'), scalings=None, title=None,
+                      proj=True, clipping=1.5, chunk_duration=60.,
+                      overview=None, show=False):
+    """Plot all channels of a recording as min/max envelopes.
+
+    A static overview of the full recording for the HTML reports: for each
+    pixel column, the range of the data within that column is drawn. All
+    channels are drawn as one collection, bad segments (annotations starting
+    with 'bad') are shaded.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The recording.
+    picks : str | list
+        Channels (types or names) to plot.
+    scalings : dict | None
+        Amplitude per channel type that fills the space of one channel
+        (defaults to 50 microvolts for EEG and EOG).
+    title : str | None
+        Title of the figure.
+    proj : bool
+        Whether to apply the SSP projectors (e.g., the average reference).
+    clipping : float | None
+        Clip traces at this many times the space of one channel, so that
+        noisy channels do not hide their neighbours.
+    chunk_duration : float
+        The data is read in chunks of this length (in seconds), so that
+        only one chunk needs to be held in memory at once.
+    overview : instance of Overview | None
+        Overview of the recording (see `overview.compute_overview`). If
+        given, the envelope is taken from it instead of the data; it must
+        contain the picked channels (`proj` is then ignored).
+    show : bool
+        Whether to show the figure.
+
+    Returns
+    -------
+    fig : instance of Figure
+    """
+    import matplotlib.pyplot as plt
+
+    from matplotlib.collections import PolyCollection
+
+    scalings = dict(dict(eeg=50e-6, eog=50e-6), **(scalings or {}))
+
+    picks = [picks] if isinstance(picks, str) else list(picks)
+    ch_idx = [idx for idx, (ch, ch_type) in
+              enumerate(zip(raw.ch_names, raw.get_channel_types()))
+              if ch in picks or ch_type in picks]
+    ch_names = [raw.ch_names[idx] for idx in ch_idx]
+    ch_types = raw.get_channel_types(picks=ch_idx)
+    n_channels = len(ch_names)
+    sfreq = raw.info['sfreq']
+
+    scale = np.array([scalings.get(ch_type, 1.) for ch_type in ch_types])
+
+    fig, ax = plt.subplots(figsize=(20, max(6, 0.15 * n_channels)))
+    n_bins = int(ax.get_window_extent().width)
+
+    if overview is not None:
+        times, mins, maxs = overview.envelope(n_bins, picks=ch_names)
+    else:
+        times, mins, maxs = _raw_envelope(raw, ch_idx, n_bins, proj=proj,
+                                          chunk_duration=chunk_duration)
+
+    # scaled so that +/- scaling covers the space of one channel
+    lower = mins / (2 * scale[:, np.newaxis])
+    upper = maxs / (2 * scale[:, np.newaxis])
+    if clipping is not None:
+        lower = np.clip(lower, -clipping / 2., clipping / 2.)
+        upper = np.clip(upper, -clipping / 2., clipping / 2.)
+    offsets = np.arange(n_channels)[:, np.newaxis]
+    lower, upper = offsets - lower, offsets - upper
+
+    # one polygon per channel: upper envelope forward, lower backward
+    x = np.concatenate([times, times[::-1]])
+    verts = np.stack([np.broadcast_to(x, (n_channels, x.size)),
+                      np.concatenate([upper, lower[:, ::-1]], axis=1)],
+                     axis=-1)
+    bads = set(raw.info['bads'])
+    colors = ['crimson' if ch in bads else
+              'steelblue' if ch_type == 'eog' else 'k'
+              for ch, ch_type in zip(ch_names, ch_types)]
+    ax.add_collection(PolyCollection(verts, facecolors=colors,
+                                     edgecolors=colors, linewidths=0.5),
+                      autolim=False)
+
+    # shade bad segments
+    onsets = raw.annotations.onset
+    if raw.annotations.orig_time is not None:
+        onsets = onsets - raw.first_time
+    bad = np.array([desc.lower().startswith('bad')
+                    for desc in raw.annotations.description], dtype=bool)
+    if bad.any():
+        segments = [[(onset, -1), (onset, n_channels),
+                     (onset + duration, n_channels), (onset + duration, -1)]
+                    for onset, duration in
+                    zip(onsets[bad], raw.annotations.duration[bad])]
+        ax.add_collection(PolyCollection(segments, facecolors='crimson',
+                                         edgecolors='none', alpha=0.2),
+                          autolim=False)
+
+    ax.set_xlim(0, raw.n_times / sfreq)
+    ax.set_ylim(n_channels, -1)
+    ax.set_yticks(np.arange(n_channels))
+    ax.set_yticklabels(ch_names, fontsize=7)
+    ax.set_xlabel('Time (s)')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    if title is not None:
+        ax.set_title(title, fontweight='bold')
+
+    if not show:
+        plt.close(fig)
+
+    return fig.show() if show else fig